@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# Author: Sean Pesce
+
+# Accelerometer telemetry, served at /telemetry. Every stream chunk carries the device's XYZ accelerometer
+# reading packed into its arg1 field; the ingest pipeline appends each raw reading to an AccelRing (a single
+# array store, so the video path isn't slowed down), and readings are only decoded in batches when they're
+# requested. Decoding uses NumPy if it's installed.
+#
+# Each sample has a sequence number (the number of samples appended before it), so pollers can request
+# only the samples they haven't seen with /telemetry?since=<sequence number>, and streaming clients
+# (Server-Sent Events or NDJSON) can resume where they left off.
+
+
+import array
+import json
+import urllib.parse
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import spade_msg
+
+
+FORMAT_JSON = 'json'      # One JSON object holding the requested window of samples (as columns)
+FORMAT_NDJSON = 'ndjson'  # Stream of JSON objects, one sample per line
+FORMAT_SSE = 'sse'        # Server-Sent Events stream, each event holding a batch of samples (as columns)
+
+CONTENT_TYPES = {
+    FORMAT_JSON: 'application/json',
+    FORMAT_NDJSON: 'application/x-ndjson',
+    FORMAT_SSE: 'text/event-stream',
+}
+
+STREAM_INTERVAL = 0.1  # Seconds between batches sent to streaming clients
+KEEPALIVE = 15.0       # Seconds without samples before a keep-alive is sent to streaming clients
+
+# Sent to streaming clients while no samples arrive, so disconnected clients are detected (and stop holding
+# the stream open)
+KEEPALIVES = {
+    FORMAT_NDJSON: b'\n',   # Empty line; skipped by NDJSON readers
+    FORMAT_SSE: b':\n\n',  # Comment
+}
+
+
+class AccelRing:
+    """
+    Fixed-size ring buffer of raw accelerometer samples, backed by a single flat buffer rather than
+    per-sample objects (so it can also live in shared memory; see spade_shm).
+    
+    Only one thread (the ingest thread) appends samples, so appending doesn't lock; readers copy samples
+    out and then discard any that were overwritten while they were copying.
+    """
+    CAPACITY = 65536
+    
+    def __init__(self, capacity=CAPACITY, buffer=None):
+        self.capacity = int(capacity)
+        if buffer is None:
+            buffer = bytearray(self.__class__.size(self.capacity))
+        buffer = memoryview(buffer)
+        self._timestamps = buffer[:8 * self.capacity].cast('d')                      # time.time() of each sample
+        self._raw = buffer[8 * self.capacity:12 * self.capacity].cast('I')           # Packed arg1 value of each sample
+        self._count = buffer[12 * self.capacity:12 * self.capacity + 8].cast('Q')   # See count
+        return
+    
+    
+    @staticmethod
+    def size(capacity=CAPACITY):
+        """
+        Returns the size of the buffer that backs a ring of the given capacity
+        """
+        return 12 * int(capacity) + 8
+    
+    
+    @property
+    def count(self):
+        """
+        Samples appended so far (and the sequence number of the next sample)
+        """
+        return self._count[0]
+    
+    
+    def release(self):
+        """
+        Releases the ring's views of its buffer (so that shared memory backing it can be closed). The ring
+        can't be used afterwards.
+        """
+        for view in (self._timestamps, self._raw, self._count):
+            view.release()
+    
+    
+    def append(self, timestamp, raw):
+        count = self._count[0]
+        i = count % self.capacity
+        self._timestamps[i] = timestamp
+        self._raw[i] = raw
+        self._count[0] = count + 1
+    
+    
+    def _slice(self, values, start, end):
+        i = start % self.capacity
+        j = end % self.capacity
+        copy = array.array(values.format)
+        if start == end:
+            return copy
+        if i < j:
+            copy.frombytes(values[i:j].cast('B'))
+        else:
+            copy.frombytes(values[i:].cast('B'))
+            copy.frombytes(values[:j].cast('B'))
+        return copy
+    
+    
+    def read(self, since=None):
+        """
+        Copies the buffered samples starting at sequence number since (by default, the oldest sample still
+        buffered). Returns the sequence number of the first sample copied, the samples' timestamps and raw
+        values (as arrays), and the sequence number of the next sample.
+        """
+        end = self.count
+        oldest = max(0, end - self.capacity)
+        start = oldest if since is None else min(max(int(since), oldest), end)
+        timestamps = self._slice(self._timestamps, start, end)
+        raw = self._slice(self._raw, start, end)
+        overwritten = self.count - self.capacity - start
+        if overwritten > 0:
+            # Samples that were replaced by newer ones while copying
+            overwritten = min(overwritten, end - start)
+            del timestamps[:overwritten]
+            del raw[:overwritten]
+            start += overwritten
+        return start, timestamps, raw, end
+
+
+def decode(raw):
+    """
+    Decodes an array of packed accelerometer samples. Returns lists of the X, Y and Z coordinates.
+    """
+    if numpy is not None:
+        packed = numpy.frombuffer(raw, dtype=numpy.uint32)
+        return (packed >> 20).tolist(), ((packed >> 10) & 0x3ff).tolist(), (packed & 0x3ff).tolist()
+    if len(raw) == 0:
+        return [], [], []
+    return tuple(list(c) for c in zip(*map(spade_msg.decode_coordinates, raw)))
+
+
+def parse_request(query, accept=None, last_event_id=None):
+    """
+    Resolves a /telemetry request. The format is set with ?format=json|ndjson|sse, or else chosen from the
+    Accept header (JSON by default). Returns the format and the sequence number of the first sample to send
+    (None for all buffered samples, in JSON responses, or for only new samples, in streams). Raises
+    ValueError for invalid parameters.
+    """
+    params = urllib.parse.parse_qs(query)
+    accept = accept or ''
+    if 'format' in params:
+        fmt = params['format'][0]
+        if fmt not in CONTENT_TYPES:
+            raise ValueError(f'format must be one of: {", ".join(CONTENT_TYPES)}')
+    elif CONTENT_TYPES[FORMAT_SSE] in accept:
+        fmt = FORMAT_SSE
+    elif CONTENT_TYPES[FORMAT_NDJSON] in accept:
+        fmt = FORMAT_NDJSON
+    else:
+        fmt = FORMAT_JSON
+    since = None
+    if 'since' in params:
+        since = int(params['since'][0])
+    elif fmt == FORMAT_SSE and last_event_id:
+        # Reconnecting SSE client; event IDs are the sequence number of the next sample
+        since = int(last_event_id)
+    return fmt, since
+
+
+def format_batch(fmt, start, timestamps, raw, end):
+    """
+    Formats a batch of samples (as returned by AccelRing.read) for a response
+    """
+    x, y, z = decode(raw)
+    if fmt == FORMAT_NDJSON:
+        return ''.join(json.dumps({'seq': start + i, 't': t, 'x': x[i], 'y': y[i], 'z': z[i]}) + '\n'
+                       for i, t in enumerate(timestamps)).encode('ascii')
+    batch = json.dumps({'start': start, 'next': end, 't': timestamps.tolist(), 'x': x, 'y': y, 'z': z})
+    if fmt == FORMAT_SSE:
+        return f'id: {end}\ndata: {batch}\n\n'.encode('ascii')
+    return batch.encode('ascii')
@@ -0,0 +1,636 @@
+#!/usr/bin/env python3
+# Author: Sean Pesce
+
+# asyncio implementation of the HTTP mirror. Serves the same routes as spade_mirror.HttpHandler, but
+# receives the device stream with a DatagramProtocol and writes to viewers without blocking, so the
+# number of OS threads doesn't grow with the number of connected viewers.
+
+
+import asyncio
+import email.utils
+import http
+import socket
+import ssl
+import threading
+import time
+import urllib.parse
+
+import spade_accel
+import spade_ws
+from spade_metrics import Metrics
+from spade_mirror import FrameSubscriber, HttpHandler
+
+
+class AsyncFrameSubscriber(FrameSubscriber):
+    """
+    FrameSubscriber that can be awaited from an asyncio event loop
+    """
+    
+    def __init__(self, loop, queue_max=None):
+        super().__init__(queue_max)
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+        self._event = asyncio.Event()
+        return
+    
+    
+    def _wake(self):
+        if threading.get_ident() == self._loop_thread:
+            self._event.set()
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:
+            # Event loop already closed
+            pass
+    
+    
+    def put(self, frame):
+        super().put(frame)
+        self._wake()
+    
+    
+    def close(self):
+        super().close()
+        self._wake()
+    
+    
+    async def get_async(self):
+        """
+        Waits for the next published frame. Returns None if the subscription has ended.
+        """
+        while True:
+            with self._cond:
+                if self.closed:
+                    return None
+                if self._frames:
+                    self.frames_delivered += 1
+                    return self._frames.popleft()
+                self._event.clear()
+            await self._event.wait()
+
+
+class StreamProtocol(asyncio.DatagramProtocol):
+    """
+    Receives the device's video stream and feeds it to the client's reassembly pipeline
+    """
+    
+    def __init__(self, spade_client):
+        self.spade_client = spade_client
+        self.transport = None
+        return
+    
+    
+    def connection_made(self, transport):
+        self.transport = transport
+        server_address = (self.spade_client.server, self.spade_client.__class__.STREAM_PORT)
+        transport.sendto(self.spade_client.__class__.READ_STREAM_REQUEST, server_address)
+    
+    
+    def datagram_received(self, data, addr):
+        spade_client = self.spade_client
+        spade_client.last_datagram_time = time.monotonic()
+        spade_client.recv_datagrams += 1
+        try:
+            spade_client.process_datagram(memoryview(data))
+        except Exception as e:
+            print(f'[ERROR] Stream ingest failed: {e}')
+            self.transport.close()
+            spade_client.broadcaster.close()
+    
+    
+    def error_received(self, exc):
+        print(f'[ERROR] Stream socket error: {exc}')
+
+
+class AsyncMirrorServer:
+    REQUEST_HEADER_MAX = 65536
+    
+    def __init__(self, spade_client, cert_fpath=None, privkey_fpath=None, host='0.0.0.0', port=HttpHandler.PORT, devices=None):
+        self.spade_client = spade_client
+        self.devices = devices  # In hub mode (see spade_hub), the (unstarted) server of each device, by name
+        self.host = host
+        self.port = int(port)
+        self.ssl_context = None
+        if None not in (cert_fpath, privkey_fpath):
+            self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.ssl_context.load_cert_chain(certfile=cert_fpath, keyfile=privkey_fpath, password='')
+        self.protocol = 'http' if self.ssl_context is None else 'https'
+        self._stream_lock = None
+        self._stream_transport = None
+        self._watchdog = None
+        self._hold_subscriber = None
+        self._hold_until = 0.0
+        self._hold_timer = None
+        return
+    
+    
+    async def serve_forever(self):
+        server = await asyncio.start_server(self._handle, self.host, self.port, ssl=self.ssl_context,
+                                            limit=self.__class__.REQUEST_HEADER_MAX)
+        print(f'Serving {self.protocol.upper()} on {self.protocol}://{self.host}:{self.port} (asyncio)')
+        await self._start()
+        for child in (self.devices or {}).values():
+            await child._start()
+        async with server:
+            await server.serve_forever()
+    
+    
+    async def _start(self):
+        """
+        Prepares to serve the client's routes from the running event loop, and starts the client's recorder,
+        transcoder and local preview (if set)
+        """
+        self._stream_lock = asyncio.Lock()
+        if self.spade_client is None:
+            return
+        # The recorder, variant pipelines and local preview run in their own threads, but their subscriptions
+        # must go through this event loop (which runs the stream)
+        for service in (self.spade_client.recorder, self.spade_client.transcoder, self.spade_client.preview):
+            if service is not None:
+                service.start(*self._threadsafe_subscription())
+    
+    
+    def _threadsafe_subscription(self):
+        """
+        Returns subscribe(queue_max) and unsubscribe(subscriber) functions that other threads can call to
+        subscribe to the stream through the running event loop
+        """
+        loop = asyncio.get_running_loop()
+        subscribe = lambda queue_max: asyncio.run_coroutine_threadsafe(self._subscribe(queue_max), loop).result()
+        unsubscribe = lambda subscriber: loop.call_soon_threadsafe(self._unsubscribe, subscriber)
+        return subscribe, unsubscribe
+    
+    
+    def run(self):
+        asyncio.run(self.serve_forever())
+    
+    
+    async def _call(self, func, *args):
+        """
+        Runs a blocking SpadeClient call (e.g., a command round trip) without stalling the event loop
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+    
+    
+    async def _subscribe(self, queue_max=None):
+        spade_client = self.spade_client
+        async with self._stream_lock:
+            if spade_client.ingest_process is not None:
+                # Received and reassembled by the ingest process instead (see spade_shm); frames are published
+                # from its pump thread
+                await self._call(spade_client.ingest_process.start_stream)
+            elif self._stream_transport is None or self._stream_transport.is_closing():
+                await self._call(spade_client.connect)
+                loop = asyncio.get_running_loop()
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.bind(('0.0.0.0', 0))
+                # Kernel drop reporting requires recvmsg(), which asyncio transports don't use
+                spade_client.configure_stream_socket(sock)
+                self._stream_transport, _ = await loop.create_datagram_endpoint(
+                    lambda: StreamProtocol(spade_client), sock=sock)
+                spade_client.streaming = True
+                spade_client.last_datagram_time = time.monotonic()
+                self._watchdog = loop.call_later(spade_client.__class__.STREAM_POLL_INTERVAL, self._check_stream)
+            return spade_client.broadcaster.subscribe(AsyncFrameSubscriber(asyncio.get_running_loop(), queue_max))
+    
+    
+    def _unsubscribe(self, subscriber):
+        spade_client = self.spade_client
+        spade_client.broadcaster.unsubscribe(subscriber)
+        if len(spade_client.broadcaster) == 0:
+            self._stop_stream()
+    
+    
+    async def _hold_stream(self, seconds):
+        """
+        Keeps the stream running for at least another `seconds`, even if no viewers remain
+        """
+        loop = asyncio.get_running_loop()
+        self._hold_until = max(self._hold_until, loop.time() + seconds)
+        if self._hold_subscriber is not None and not self._hold_subscriber.closed:
+            return
+        if self._hold_subscriber is not None:
+            # The stream ended since the last request
+            self._hold_timer.cancel()
+            self._unsubscribe(self._hold_subscriber)
+        self._hold_subscriber = await self._subscribe(1)
+        self._hold_timer = loop.call_later(seconds, self._check_hold)
+    
+    
+    def _check_hold(self):
+        loop = asyncio.get_running_loop()
+        remaining = self._hold_until - loop.time()
+        if remaining > 0:
+            self._hold_timer = loop.call_later(remaining, self._check_hold)
+            return
+        subscriber = self._hold_subscriber
+        self._hold_subscriber = None
+        self._hold_timer = None
+        self._unsubscribe(subscriber)
+    
+    
+    async def _snapshot(self, etag, wait):
+        """
+        Same as SpadeClient.snapshot, but runs the stream on this event loop
+        """
+        spade_client = self.spade_client
+        if spade_client.ingest_process is not None:
+            was_streaming = spade_client.ingest_process.streaming
+        else:
+            was_streaming = self._stream_transport is not None and not self._stream_transport.is_closing()
+        await self._hold_stream(spade_client.__class__.SNAPSHOT_LINGER)
+        frame = spade_client.broadcaster.latest()
+        if was_streaming and frame is not None and (wait <= 0 or HttpHandler.ETAG(frame) != etag):
+            return frame
+        
+        if frame is None or not was_streaming:
+            # The latest frame (if any) is left over from an earlier stream
+            wait = max(wait, spade_client.__class__.SNAPSHOT_TIMEOUT)
+        subscriber = await self._subscribe(1)
+        try:
+            newer = await asyncio.wait_for(subscriber.get_async(), wait)
+        except asyncio.TimeoutError:
+            newer = None
+        finally:
+            self._unsubscribe(subscriber)
+        if newer is None:
+            return frame
+        if frame is not None:
+            frame.release()
+        return newer
+    
+    
+    def _stop_stream(self):
+        if self.spade_client.ingest_process is not None:
+            self.spade_client.ingest_process.stop_stream()
+            return
+        self.spade_client.streaming = False
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+        if self._stream_transport is not None:
+            # @TODO: Send EndStream message
+            self._stream_transport.close()
+            self._stream_transport = None
+    
+    
+    def _check_stream(self):
+        spade_client = self.spade_client
+        if self._stream_transport is None or self._stream_transport.is_closing():
+            self._stop_stream()
+            spade_client.broadcaster.close()
+            return
+        if time.monotonic() - spade_client.last_datagram_time > spade_client.stream_timeout:
+            print(f'[ERROR] Stream ingest failed: No stream data received from {spade_client.server} in {spade_client.stream_timeout} seconds')
+            self._stop_stream()
+            spade_client.broadcaster.close()
+            return
+        self._watchdog = asyncio.get_running_loop().call_later(spade_client.__class__.STREAM_POLL_INTERVAL, self._check_stream)
+    
+    
+    @staticmethod
+    def _response_head(status, headers, version='HTTP/1.0'):
+        status = http.HTTPStatus(status)
+        lines = [
+            f'{version} {status.value} {status.phrase}',
+            f'Server: {HttpHandler.server_version}',
+            f'Date: {email.utils.formatdate(usegmt=True)}',
+        ]
+        lines += [f'{k}: {v}' for k, v in headers.items()]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+    
+    
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                k, _, v = line.decode('latin-1').partition(':')
+                headers[k.strip().lower()] = v.strip()
+            parts = request_line.decode('latin-1').split()
+            if len(parts) != 3:
+                writer.write(self._response_head(400, {'Connection': 'close'}))
+            elif parts[0] != 'GET':
+                writer.write(self._response_head(501, {'Connection': 'close'}))
+            else:
+                await self._route(parts[1], headers, reader, writer)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ssl.SSLError):
+            # Viewer disconnected or sent a malformed request
+            pass
+        finally:
+            writer.close()
+    
+    
+    async def _route(self, path, headers, reader, writer):
+        """
+        Serves a GET request; in hub mode, with the server of the device it's for
+        """
+        if self.devices is None:
+            await self._do_GET(path, headers, reader, writer)
+            return
+        url = urllib.parse.urlsplit(path)
+        name, subpath = HttpHandler.DEVICE_ROUTE(url.path)
+        response = HttpHandler.HUB_RESPONSE(name, subpath, url.query, headers.get('host'))
+        if response is not None:
+            status, response_headers, data = response
+            response_headers['Content-Length'] = len(data)
+            response_headers['Connection'] = 'close'
+            writer.write(self._response_head(status, response_headers) + data)
+            return
+        if url.query:
+            subpath += f'?{url.query}'
+        await self.devices[name]._do_GET(subpath, headers, reader, writer, prefix=f'/devices/{name}')
+    
+    
+    async def _read_websocket(self, reader, writer, parser, window, acked, subscriber):
+        """
+        Processes a WebSocket viewer's messages until it closes the connection, setting `acked` whenever the
+        viewer acknowledges a frame
+        """
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                parser.feed(data)
+                replies, closed = spade_ws.handle_messages(parser, window)
+                if replies:
+                    writer.write(replies)
+                if closed:
+                    break
+                acked.set()
+        except (ConnectionError, ssl.SSLError):
+            # Viewer disconnected
+            pass
+        finally:
+            # Ends the sender's loop
+            subscriber.close()
+            acked.set()
+    
+    
+    async def _send_websocket(self, query, headers, reader, writer):
+        """
+        Same as HttpHandler.send_websocket, but reads acknowledgements from a separate task
+        """
+        spade_client = self.spade_client
+        if not spade_ws.is_handshake(headers):
+            writer.write(self._response_head(426, {'Upgrade': 'websocket', 'Sec-WebSocket-Version': '13', 'Connection': 'close'})
+                         + b'Error: WebSocket handshake required')
+            return
+        params = urllib.parse.parse_qs(query)
+        try:
+            window = spade_ws.AckWindow(int(params['window'][0]) if 'window' in params else spade_ws.WINDOW)
+        except ValueError:
+            writer.write(self._response_head(400, {'Connection': 'close'}) + b'Error: window must be a number of frames')
+            return
+        
+        writer.write(self._response_head(101, {
+            'Upgrade': 'websocket',
+            'Connection': 'Upgrade',
+            'Sec-WebSocket-Accept': spade_ws.accept_key(headers['sec-websocket-key']),
+        }, version='HTTP/1.1'))
+        # Only the latest frame is kept while the viewer is behind
+        subscriber = await self._subscribe(1)
+        peer = writer.get_extra_info('peername') or ('?', '?')
+        subscriber.name = f'{peer[0]}:{peer[1]}'
+        acked = asyncio.Event()
+        read_task = asyncio.create_task(self._read_websocket(reader, writer, spade_ws.MessageParser(), window, acked, subscriber))
+        tls = writer.get_extra_info('sslcontext') is not None
+        try:
+            if not tls:
+                # See /stream
+                writer.transport.set_write_buffer_limits(0)
+            while True:
+                while window.full and not subscriber.closed:
+                    acked.clear()
+                    try:
+                        await asyncio.wait_for(acked.wait(), spade_ws.ACK_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        # Viewer isn't acknowledging frames
+                        window.reset()
+                frame = await subscriber.get_async()
+                if frame is None:
+                    # Stream ended (or the viewer closed the connection)
+                    break
+                with frame:
+                    if tls:
+                        writer.write(HttpHandler.WS_MESSAGE(frame))
+                    else:
+                        writer.writelines((HttpHandler.WS_HEADER(frame), frame.data))
+                    subscriber.bytes_sent += len(HttpHandler.WS_HEADER(frame)) + len(frame.data)
+                    window.sent(frame.index)
+                    await writer.drain()
+            if not read_task.done():
+                writer.write(spade_ws.close_message())
+        finally:
+            read_task.cancel()
+            self._unsubscribe(subscriber)
+            print(f'WebSocket viewer {peer[0]}:{peer[1]} disconnected ({subscriber.frames_delivered} frames sent, {subscriber.frames_dropped} dropped)')
+    
+    
+    async def _send_accel(self, query, headers, writer):
+        """
+        Same as HttpHandler.send_accel
+        """
+        spade_client = self.spade_client
+        try:
+            fmt, since = spade_accel.parse_request(query, headers.get('accept'), headers.get('last-event-id'))
+        except ValueError as e:
+            writer.write(self._response_head(400, {'Connection': 'close'}) + f'Error: {e}'.encode('utf-8'))
+            return
+        accel = spade_client.accel
+        # Samples only arrive while the stream is running
+        await self._hold_stream(spade_client.__class__.SNAPSHOT_LINGER)
+        response_headers = {
+            'Content-Type': spade_accel.CONTENT_TYPES[fmt],
+            'Cache-Control': 'no-cache',
+            'Access-Control-Allow-Origin': '*',  # CORS
+            'Connection': 'close',
+        }
+        if fmt == spade_accel.FORMAT_JSON:
+            data = spade_accel.format_batch(fmt, *accel.read(since))
+            response_headers['Content-Length'] = len(data)
+            writer.write(self._response_head(200, response_headers) + data)
+            return
+        
+        writer.write(self._response_head(200, response_headers))
+        if since is None:
+            since = accel.count
+        last_write = time.monotonic()
+        while True:
+            await self._hold_stream(spade_client.__class__.SNAPSHOT_LINGER)
+            start, timestamps, raw, since = accel.read(since)
+            if len(raw) > 0:
+                writer.write(spade_accel.format_batch(fmt, start, timestamps, raw, since))
+                last_write = time.monotonic()
+            elif time.monotonic() - last_write >= spade_accel.KEEPALIVE:
+                writer.write(spade_accel.KEEPALIVES[fmt])
+                last_write = time.monotonic()
+            await writer.drain()
+            await asyncio.sleep(spade_accel.STREAM_INTERVAL)
+    
+    
+    async def _do_GET(self, path, headers, reader, writer, prefix=''):
+        """
+        Serves a GET request for one of the client's routes. prefix is the path prefix of the routes (in hub
+        mode).
+        """
+        spade_client = self.spade_client
+        url = urllib.parse.urlsplit(path)
+        path = url.path
+        
+        if path not in ('/', '/stream', '/ws', '/live', '/snapshot.jpg', '/telemetry', '/battery', '/model', '/pwm', '/recordings', '/metrics') and not path.startswith('/recordings/'):
+            writer.write(self._response_head(404, {'Connection': 'close'}))
+            return
+        
+        if spade_client is None:
+            writer.write(self._response_head(503, {'Connection': 'close'}) + b'Error: Spade client unavailable')
+            return
+        
+        # Telemetry is served from the client's cache; HTTP requests never trigger server commands
+        telemetry = spade_client.telemetry
+        if path in HttpHandler.TELEMETRY_ROUTES:
+            value, timestamp = telemetry.get(HttpHandler.TELEMETRY_ROUTES[path])
+            if value is None:
+                writer.write(self._response_head(503, {'Retry-After': max(1, int(telemetry.interval)), 'Connection': 'close'})
+                             + b'Error: Value not available')
+                return
+        
+        if path == '/recordings' or path.startswith('/recordings/'):
+            recorder = spade_client.recorder
+            status, response_headers, body = HttpHandler.RECORDING_RESPONSE(recorder, path, url.query)
+            response_headers['Connection'] = 'close'
+            if type(body) == bytes:
+                writer.write(self._response_head(status, response_headers) + body)
+                return
+            # Recorded parts are sent straight from disk; the first part's leading CRLF ends the headers
+            f, offset, count = body
+            with f:
+                writer.write(self._response_head(status, response_headers)[:-2])
+                await asyncio.get_running_loop().sendfile(writer.transport, f, offset, count)
+            writer.write(recorder.CLOSE_DELIMITER)
+            return
+        
+        if path == '/snapshot.jpg':
+            params = urllib.parse.parse_qs(url.query)
+            try:
+                wait = min(float(params['wait'][0]), spade_client.__class__.SNAPSHOT_WAIT_MAX) if 'wait' in params else 0.0
+            except ValueError:
+                writer.write(self._response_head(400, {'Connection': 'close'}) + b'Error: wait must be a number of seconds')
+                return
+            if_none_match = headers.get('if-none-match')
+            try:
+                frame = await self._snapshot(if_none_match, wait)
+            except IOError as e:
+                print(f'[ERROR] Snapshot failed: {e}')
+                frame = None
+            try:
+                status, response_headers, body = HttpHandler.SNAPSHOT_RESPONSE(frame, if_none_match)
+                response_headers['Connection'] = 'close'
+                # Copied into the response, so the frame can be released right away
+                writer.write(self._response_head(status, response_headers) + body)
+            finally:
+                if frame is not None:
+                    frame.release()
+            return
+        
+        if path == '/ws':
+            await self._send_websocket(url.query, headers, reader, writer)
+            return
+        
+        if path == '/telemetry':
+            await self._send_accel(url.query, headers, writer)
+            return
+        
+        if path == '/live':
+            data = spade_ws.LIVE_PAGE.encode('utf-8')
+            writer.write(self._response_head(200, {'Content-Type': 'text/html; charset=utf-8', 'Content-Length': len(data), 'Connection': 'close'}) + data)
+            return
+        
+        if path == '/metrics':
+            data = spade_client.metrics.render().encode('utf-8')
+            writer.write(self._response_head(200, {'Content-Type': Metrics.CONTENT_TYPE, 'Content-Length': len(data), 'Connection': 'close'}) + data)
+            return
+        
+        variant = None
+        if path == '/stream':
+            status, variant = HttpHandler.STREAM_VARIANT(spade_client.transcoder, url.query)
+            if status != 200:
+                writer.write(self._response_head(status, {'Connection': 'close'}) + variant)
+                return
+            # See HttpHandler
+            try:
+                if variant is None:
+                    subscriber = await self._subscribe()
+                else:
+                    await self._call(spade_client.connect)
+                    subscriber = spade_client.transcoder.subscribe(variant, AsyncFrameSubscriber(asyncio.get_running_loop()))
+            except IOError as e:
+                print(f'[ERROR] Failed to start stream: {e}')
+                writer.write(self._response_head(503, {'Connection': 'close'}) + b'Error: Spade server unavailable')
+                return
+        
+        response_headers = {}
+        battery, _ = telemetry.get('battery')
+        if battery is not None:
+            response_headers['X-Battery'] = str(battery)
+        response_headers['Connection'] = 'close'
+        
+        if path in HttpHandler.TELEMETRY_ROUTES:
+            data = str(value).encode('ascii')
+            response_headers['Age'] = int(max(0, time.time() - timestamp))
+            response_headers['X-Telemetry-Timestamp'] = timestamp
+            response_headers['Content-Length'] = len(data)
+            writer.write(self._response_head(200, response_headers) + data)
+            return
+        
+        if path == '/':
+            host = headers.get('host', f'{self.host}:{self.port}')
+            html_data = f'<html><head></head><body><img src="{self.protocol}://{host}{prefix}/stream" >\n</body></html>'
+            response_headers['Content-Length'] = len(html_data)
+            writer.write(self._response_head(200, response_headers) + html_data.encode('ascii'))
+            return
+        
+        elif path == '/stream':
+            response_headers.update(HttpHandler.HEADERS_BASE())
+            peer = writer.get_extra_info('peername') or ('?', '?')
+            subscriber.name = f'{peer[0]}:{peer[1]}'
+            try:
+                # The blank line that ends the response headers is sent as the first part's leading CRLF,
+                # matching the output of HttpHandler
+                writer.write(self._response_head(200, response_headers)[:-2])
+                tls = writer.get_extra_info('sslcontext') is not None
+                if not tls:
+                    # With a high-water mark of 0, drain() waits until the transport has sent everything, so a
+                    # frame is never released while the transport still references its buffer
+                    writer.transport.set_write_buffer_limits(0)
+                while True:
+                    frame = await subscriber.get_async()
+                    if frame is None:
+                        # Stream ended
+                        break
+                    
+                    with frame:
+                        if tls:
+                            # The SSL transport can keep written data queued until it has been encrypted (and
+                            # doesn't honor a zero high-water mark), so it's given the part as an immutable
+                            # copy that outlives the frame's buffer
+                            writer.write(HttpHandler.PART(frame))
+                        else:
+                            # Sent with a single vectored write where the transport supports it
+                            writer.writelines((HttpHandler.PART_HEADER(frame), frame.data))
+                        subscriber.bytes_sent += len(HttpHandler.PART_HEADER(frame)) + len(frame.data)
+                        # Only waits if this viewer's socket can't take the whole frame right away; frames
+                        # published in the meantime replace older ones in the subscriber's queue
+                        await writer.drain()
+            finally:
+                if variant is None:
+                    self._unsubscribe(subscriber)
+                else:
+                    spade_client.transcoder.unsubscribe(variant, subscriber)
+                print(f'Viewer {peer[0]}:{peer[1]} disconnected ({subscriber.frames_delivered} frames sent, {subscriber.frames_dropped} dropped)')
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# Author: Sean Pesce
+
+# Benchmarks for the stream mirror's hot paths, and end-to-end benchmarks that run the mirror against the
+# device emulator (spade_emu) on loopback. Results are printed as JSON; runs with the same options (and
+# --seed) feed identical streams, so results can be compared from run to run.
+
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import re
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+
+import spade_msg
+import spade_emu
+
+from spade_mirror import HttpHandler, JpgFrame, SpadeClient
+from spade_util import sendmsg_all
+
+
+def make_chunk(n_frame=1, n_chunk=1, last_chunk=0, payload=b'\x00' * 1024, arg1=0):
+    """
+    Builds a StreamChunk message (header and payload) as sent by the server
+    """
+    return spade_msg.SpadeUdpMsg_0x9999_StreamChunk.STRUCT.pack(
+        spade_msg.SpadeUdpMsg_0x9999.MAGIC, 0x0003, 0, arg1, len(payload) + 27, 0,
+        1, n_frame, 0, n_chunk, last_chunk, len(payload), n_frame, 640, 480, n_frame) + payload
+
+
+def bench_chunk_header(iterations=200000):
+    """
+    Compares the ctypes and struct-based StreamChunk header decoders
+    """
+    chunk_cls = spade_msg.SpadeUdpMsg_0x9999_StreamChunk
+    buf = memoryview(make_chunk())
+    hdr_sz = chunk_cls.sizeof()
+    results = {}
+    for name, stmt in (
+        ('ctypes_from_bytes', lambda: chunk_cls.from_bytes(buf[:hdr_sz])),
+        ('struct_unpack_from', lambda: chunk_cls.unpack_from(buf, 0)),
+    ):
+        elapsed = min(timeit.repeat(stmt, number=iterations, repeat=5))
+        results[name] = {
+            'ns_per_chunk': elapsed / iterations * 1e9,
+            'chunks_per_sec': iterations / elapsed,
+        }
+    results['speedup'] = results['ctypes_from_bytes']['ns_per_chunk'] / results['struct_unpack_from']['ns_per_chunk']
+    return results
+
+
+class CountingSocket:
+    """
+    Socket wrapper that counts send system calls and the bytes they wrote
+    """
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self.syscalls = 0
+        self.bytes_sent = 0
+    
+    
+    def send(self, data):
+        sent = self.sock.send(data)
+        self.syscalls += 1
+        self.bytes_sent += sent
+        return sent
+    
+    
+    def sendall(self, data):
+        # Only counts as one system call when the socket accepts everything at once (as it does here)
+        data = memoryview(data)
+        while len(data) > 0:
+            data = data[self.send(data):]
+    
+    
+    def sendmsg(self, buffers):
+        sent = self.sock.sendmsg(buffers)
+        self.syscalls += 1
+        self.bytes_sent += sent
+        return sent
+
+
+def make_frame(index=1, size=50000):
+    """
+    Builds a completed JpgFrame with `size` bytes of data
+    """
+    frame = JpgFrame(index, 640, 480)
+    frame.add_chunk(1, b'\xff\xd8' + b'\x00' * (size - 4) + b'\xff\xd9', 1)
+    frame.timestamp = time.time()
+    return frame
+
+
+def write_part_legacy(sock, frame):
+    """
+    The per-frame writes HttpHandler made before part headers were coalesced: end_headers() (which
+    flushes the buffered header lines), the boundary, and the payload were written separately
+    """
+    sock.sendall(b'\r\n')
+    sock.sendall(HttpHandler.BOUNDARY)
+    sock.sendall(b'\r\n')
+    img_headers = HttpHandler.HEADERS_IMAGE(len(frame.data))
+    sock.sendall(''.join(f'{k}: {v}\r\n' for k, v in img_headers.items()).encode('latin-1') + b'\r\n')
+    sock.sendall(frame.data)
+
+
+def write_part_coalesced(sock, frame):
+    sendmsg_all(sock, (HttpHandler.PART_HEADER(frame), frame.data))
+
+
+def bench_multipart_write(frames=2000, frame_sz=50000):
+    """
+    Compares the system calls, bytes, and time spent writing each MJPEG part to a viewer's socket with
+    separate writes and with a single vectored write
+    """
+    results = {}
+    for name, write_part in (
+        ('separate_writes', write_part_legacy),
+        ('vectored_write', write_part_coalesced),
+    ):
+        src, dst = socket.socketpair()
+        src.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, frame_sz * 4)
+        def drain():
+            while dst.recv(1 << 20):
+                pass
+        reader = threading.Thread(target=drain, daemon=True)
+        reader.start()
+        sock = CountingSocket(src)
+        frame = make_frame(size=frame_sz)
+        t_start = time.perf_counter()
+        for i in range(frames):
+            write_part(sock, frame)
+            # A new frame (and part header) per iteration, as when streaming
+            frame.cache.clear()
+        elapsed = time.perf_counter() - t_start
+        src.close()
+        reader.join()
+        dst.close()
+        results[name] = {
+            'syscalls_per_frame': sock.syscalls / frames,
+            'bytes_per_frame': sock.bytes_sent / frames,
+            'us_per_frame': elapsed / frames * 1e6,
+        }
+    return results
+
+
+def load_stream(capture=None, frames=300):
+    """
+    Returns the stream records of a capture file, or of a synthetic stream if no capture is given
+    """
+    if capture is None:
+        return spade_emu.synthetic_capture(frames)
+    records = [r for r in spade_emu.Capture.load(capture) if r[1] == spade_emu.CAPTURE_STREAM]
+    if not records:
+        raise ValueError(f'No stream datagrams in capture {capture}')
+    return records
+
+
+def frame_index(data):
+    """
+    Returns the frame index of the first chunk in a stream datagram
+    """
+    return spade_msg.SpadeUdpMsg_0x9999_StreamChunk.unpack_from(data, 0)[7]
+
+
+def impair(datagrams, seed, loss=0.01, duplicate=0.02, reorder=0.05):
+    """
+    Applies the emulator's impairments (spade_emu.Impairment) to a list of datagrams
+    """
+    impairment = spade_emu.Impairment(loss, duplicate, reorder, seed)
+    return [datagram for data in datagrams for datagram in impairment.apply(data)]
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def bench_reassembly(capture=None, seed=1, passes=5):
+    """
+    Feeds a chunk stream through SpadeClient.process_datagram() (parsing, reassembly, the jitter buffer
+    and the broadcaster) as fast as possible, without sockets. Measures frames per second, CPU time per
+    frame, and memory allocations per frame, for the clean stream and with loss, duplication and
+    reordering applied.
+    """
+    records = load_stream(capture)
+    clean = [memoryview(data) for t, kind, data in records]
+    results = {}
+    for name, datagrams in (
+        ('clean', clean),
+        ('impaired', impair(clean, seed)),
+    ):
+        # Discarded frames are logged; keep that out of the measurement (and the JSON output)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            best = None
+            for i in range(passes):
+                client = SpadeClient('127.0.0.1')
+                t_start = time.perf_counter()
+                cpu_start = time.process_time()
+                for data in datagrams:
+                    client.process_datagram(data)
+                elapsed = time.perf_counter() - t_start
+                cpu = time.process_time() - cpu_start
+                if best is None or elapsed < best[0]:
+                    best = (elapsed, cpu, client.frames_completed)
+            # Separate pass for allocations, since tracing slows everything down
+            client = SpadeClient('127.0.0.1')
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+            for data in datagrams:
+                client.process_datagram(data)
+            after = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        elapsed, cpu, frames = best
+        net_blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+        results[name] = {
+            'datagrams': len(datagrams),
+            'frames': frames,
+            # (No frames are completed if the impairments dropped a chunk of every frame)
+            'frames_per_sec': frames / elapsed if frames else 0.0,
+            'cpu_us_per_frame': cpu / frames * 1e6 if frames else None,
+            'us_per_datagram': elapsed / len(datagrams) * 1e6 if datagrams else None,
+            'alloc_peak_bytes': peak,
+            'alloc_net_blocks': net_blocks,
+        }
+    return results
+
+
+class BenchViewer(threading.Thread):
+    """
+    HTTP client that reads the /stream route and records when each frame arrives, relative to its
+    X-Timestamp (the time the mirror completed the frame)
+    """
+    PART_HEADER = re.compile(rb'X-Timestamp: ([0-9.]+)\r\nContent-Length: (\d+)\r\n[^\r]*\r\n\r\n')
+    
+    def __init__(self, port, deadline):
+        super().__init__(daemon=True)
+        self.port = port
+        self.deadline = deadline
+        self.frames = 0
+        self.latencies = []
+        self.error = None
+    
+    
+    def run(self):
+        try:
+            sock = socket.create_connection(('127.0.0.1', self.port), timeout=5)
+            sock.sendall(b'GET /stream HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n')
+            buf = bytearray()
+            while time.monotonic() < self.deadline:
+                data = sock.recv(1 << 20)
+                if not data:
+                    break
+                t_recv = time.time()
+                buf += data
+                while True:
+                    m = self.__class__.PART_HEADER.search(buf)
+                    if m is None or len(buf) < m.end() + int(m.group(2)):
+                        break
+                    self.frames += 1
+                    self.latencies.append(t_recv - float(m.group(1)))
+                    del buf[:m.end() + int(m.group(2))]
+            sock.close()
+        except OSError as e:
+            self.error = str(e)
+
+
+def free_port():
+    """
+    Returns a local TCP port that's currently unused
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def bench_fanout(capture=None, viewers=(1, 10, 100), seconds=10.0, modes=('sync', 'async'), seed=1):
+    """
+    Runs the mirror (in a subprocess, against a device emulator replaying the stream at its original rate)
+    and measures the frames per second each viewer receives, the mirror's CPU time per ingested frame,
+    and the latency from frame completion to each viewer reading it from its socket
+    """
+    records = load_stream(capture)
+    chunks_per_frame = len(records) / len({frame_index(data) for t, kind, data in records})
+    results = {}
+    for mode in modes:
+        results[mode] = {}
+        for n_viewers in viewers:
+            # The emulator's output is kept out of the JSON output
+            with contextlib.redirect_stdout(sys.stderr):
+                emulator = spade_emu.SpadeEmulator(records, seed=seed)
+                emulator.start()
+            # Served on a free port, so the benchmark doesn't collide with a mirror that's already running
+            port = free_port()
+            cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spade_mirror.py'),
+                   '--no-ssl', '--server', '127.0.0.1', '--port', str(port), '--queue', '2']
+            if mode == 'async':
+                cmd.append('--async')
+            cpu_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            mirror = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                if not wait_for_port(port):
+                    raise RuntimeError('Mirror did not start')
+                # Let the stream start with a single viewer before measuring
+                warmup = BenchViewer(port, time.monotonic() + 2.0)
+                warmup.start()
+                time.sleep(1.0)
+                sent_start = emulator.datagrams_sent
+                deadline = time.monotonic() + seconds
+                clients = [BenchViewer(port, deadline) for i in range(n_viewers)]
+                for client in clients:
+                    client.start()
+                time.sleep(max(0.0, deadline - time.monotonic()))
+                sent = emulator.datagrams_sent - sent_start
+                for client in clients + [warmup]:
+                    client.join()
+            finally:
+                mirror.terminate()
+                mirror.wait()
+                emulator.close()
+            cpu_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu = (cpu_after.ru_utime - cpu_before.ru_utime) + (cpu_after.ru_stime - cpu_before.ru_stime)
+            frames_ingested = sent / chunks_per_frame
+            latencies = [l for client in clients for l in client.latencies]
+            results[mode][str(n_viewers)] = {
+                'viewers': n_viewers,
+                'viewer_errors': sum(1 for client in clients if client.error is not None),
+                'frames_ingested': round(frames_ingested),
+                'frames_per_sec_per_viewer': statistics.mean(client.frames for client in clients) / seconds,
+                'min_frames_per_sec': min(client.frames for client in clients) / seconds,
+                # Includes the mirror's startup
+                'cpu_ms_per_frame': cpu / frames_ingested * 1000 if frames_ingested else None,
+                'latency_p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+                'latency_p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+            }
+    return results
+
+
+BENCHMARKS = {
+    'chunk_header': bench_chunk_header,
+    'multipart_write': bench_multipart_write,
+    'reassembly': bench_reassembly,
+    'fanout': bench_fanout,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the Spade stream mirror')
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK', help=f'Benchmarks to run (default: all). Choices: {", ".join(BENCHMARKS)}')
+    parser.add_argument('--capture', metavar='FILE', help='Stream capture (recorded with "spade_mirror.py --capture") to use instead of a synthetic stream')
+    parser.add_argument('--viewers', type=int, nargs='+', default=[1, 10, 100], help='Viewer counts for the fanout benchmark (default: 1 10 100)')
+    parser.add_argument('--seconds', type=float, default=10.0, help='Duration of each fanout measurement (default: 10)')
+    parser.add_argument('--modes', nargs='+', default=['sync', 'async'], help='Servers to run the fanout benchmark against: sync and/or async (default: both)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for packet impairments (default: 1)')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f'Unknown benchmark: {name}')
+    for mode in args.modes:
+        if mode not in ('sync', 'async'):
+            parser.error(f'Unknown mode: {mode}')
+    
+    options = {
+        'reassembly': {'capture': args.capture, 'seed': args.seed},
+        'fanout': {'capture': args.capture, 'viewers': args.viewers, 'seconds': args.seconds, 'modes': args.modes, 'seed': args.seed},
+    }
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'capture': args.capture,
+            'seed': args.seed,
+        },
+    }
+    for name in args.benchmarks or BENCHMARKS:
+        results[name] = BENCHMARKS[name](**options.get(name, {}))
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# Author: Sean Pesce
+
+import collections
+import socket
+import threading
+
+import spade_msg
+
+from spade_util import bind_to_interface
+
+
+class PendingCommand:
+    """
+    A command that has been sent to the server and is waiting for its response
+    """
+    
+    def __init__(self, msg):
+        self.msg = msg
+        self.response = None
+        self._event = threading.Event()
+        return
+    
+    
+    def complete(self, response):
+        self.response = response
+        self._event.set()
+    
+    
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
+
+
+class CommandChannel:
+    """
+    Command socket that can be shared by any number of threads.
+    
+    Each request is tagged with its cmdSendIndex and registered before it is sent, so several commands can
+    be in flight at once; a receiver thread matches each response to its request by index. Requests that
+    go unanswered are re-sent (with the same index) until they run out of retries.
+    """
+    TIMEOUT = 1.0  # Seconds to wait for each response
+    RETRIES = 2    # Number of times an unanswered request is re-sent
+    RECV_SZ = 65536
+    POLL_INTERVAL = 0.5  # Seconds between checks for a close request while the receiver thread waits for data
+    FINISHED_MAX = 64    # Number of finished (answered or timed out) request indices remembered
+    AWAITING_MAX = 16    # Number of response headers that can wait for their payloads at once
+    
+    def __init__(self, server, port, timeout=TIMEOUT, retries=RETRIES, interface=None):
+        self.server = str(server)
+        self.server_ip = socket.gethostbyname(self.server)
+        self.port = int(port)
+        self.timeout = float(timeout)
+        self.retries = int(retries)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if interface is not None:
+            bind_to_interface(self.sock, interface)
+        self.sock.settimeout(self.__class__.POLL_INTERVAL)
+        self._lock = threading.Lock()
+        self._pending = {}  # cmdSendIndex -> PendingCommand
+        self._finished = collections.deque(maxlen=self.__class__.FINISHED_MAX)  # Indices of recently finished requests
+        self._awaiting_data = collections.OrderedDict()  # cmdSendIndex -> (PendingCommand, response) whose payload follows in a separate datagram, oldest first
+        self._closed = False
+        self.timeouts = 0  # Requests that went unanswered after all retries
+        self.capture = None  # Optional spade_emu.Capture that logs every response
+        self._thread = threading.Thread(target=self._run, name=f'SpadeCommand-{self.server}', daemon=True)
+        self._thread.start()
+        return
+    
+    
+    def request(self, msg, timeout=None, retries=None):
+        """
+        Sends a command message (with its cmdSendIndex already assigned) and returns the server's response.
+        Raises TimeoutError if no response arrives after all retries.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if retries is None:
+            retries = self.retries
+        pending = PendingCommand(msg)
+        with self._lock:
+            self._pending[msg.cmdSendIndex] = pending
+        try:
+            data = bytes(msg)
+            for attempt in range(int(retries) + 1):
+                self.sock.sendto(data, (self.server_ip, self.port))
+                if pending.wait(timeout):
+                    return pending.response
+            with self._lock:
+                self.timeouts += 1
+        finally:
+            with self._lock:
+                self._pending.pop(msg.cmdSendIndex, None)
+                self._finished.append(msg.cmdSendIndex)
+        raise TimeoutError(f'No response from {self.server} to {type(msg).__name__} type {msg.type:#x} (cmdSendIndex={msg.cmdSendIndex}) after {int(retries) + 1} attempt(s)')
+    
+    
+    def close(self):
+        self._closed = True
+        if not self.sock._closed:
+            self.sock.close()
+    
+    
+    @property
+    def in_flight(self):
+        return len(self._pending)
+    
+    
+    def _run(self):
+        while not self._closed:
+            try:
+                data, server = self.sock.recvfrom(self.__class__.RECV_SZ)
+            except socket.timeout:
+                continue
+            except OSError:
+                # Socket closed
+                break
+            capture = self.capture
+            if capture is not None:
+                capture.record_command(data)
+            if server[0] != self.server_ip:
+                print(f'[WARNING] Ignoring command response from unknown host {server[0]}')
+                continue
+            try:
+                self._dispatch(data)
+            except Exception as e:
+                print(f'[WARNING] Failed to parse command response: {e}')
+    
+    
+    def _match(self, response):
+        """
+        Returns the pending request that a response belongs to, if any
+        """
+        with self._lock:
+            pending = self._pending.get(response.cmdSendIndex)
+            if pending is not None and type(pending.msg) == type(response):
+                return pending
+            if response.cmdSendIndex in self._finished:
+                # Late response to a request that was already answered or timed out
+                return None
+            # Fall back to the request of the same kind in case the server didn't echo the index, but only if
+            # there's exactly one (otherwise the response could complete the wrong request)
+            candidates = [pending for pending in self._pending.values()
+                          if type(pending.msg) == type(response) and getattr(pending.msg, 'type', None) == response.type]
+            if len(candidates) == 1:
+                return candidates[0]
+        return None
+    
+    
+    def _take_awaiting(self, size):
+        """
+        Returns the (PendingCommand, response) that a payload datagram of the given size belongs to, if any
+        """
+        awaiting = self._awaiting_data
+        # Forget headers of requests that timed out in the meantime
+        with self._lock:
+            for index, (pending, response) in list(awaiting.items()):
+                if pending is not None and index not in self._pending:
+                    del awaiting[index]
+        # Payloads don't carry an index, so a payload is paired with the oldest header that announced its size
+        # (the server sends each header's payload right after it)
+        for index, (pending, response) in awaiting.items():
+            if response.length == size:
+                return awaiting.pop(index)
+        if awaiting:
+            return awaiting.popitem(last=False)
+        return None
+    
+    
+    def _dispatch(self, data):
+        if data[:2] == b'\x99\x99':
+            msg_cls = spade_msg.SpadeUdpMsg_0x9999
+        elif data[:6] in spade_msg.SpadeUdpMsg_SETCMD.MAGIC:
+            msg_cls = spade_msg.SpadeUdpMsg_SETCMD
+        else:
+            msg_cls = None
+        
+        if msg_cls is None or len(data) < msg_cls.sizeof():
+            awaiting = self._take_awaiting(len(data))
+            if awaiting is None:
+                print(f'[WARNING] Unrecognized command response: {data[:100]}')
+                return
+            # Payload for the previous response header
+            pending, response = awaiting
+            response.data = data[:response.length]
+            if pending is not None:
+                pending.complete(response)
+            return
+        
+        response = msg_cls.from_bytes(data[:msg_cls.sizeof()])
+        pending = self._match(response)
+        if response.length > 0:
+            if len(data) > msg_cls.sizeof():
+                response.data = data[msg_cls.sizeof():]
+            else:
+                # The payload arrives in a separate datagram
+                self._awaiting_data.pop(response.cmdSendIndex, None)
+                self._awaiting_data[response.cmdSendIndex] = (pending, response)
+                while len(self._awaiting_data) > self.__class__.AWAITING_MAX:
+                    self._awaiting_data.popitem(last=False)
+                return
+        if pending is not None:
+            pending.complete(response)
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# Author: Sean Pesce
+
+# Packet capture and device emulation, for running the mirror without a physical Spade.
+#
+# A SpadeClient with a Capture attached logs every stream datagram and command response it receives. The
+# SpadeEmulator answers commands on COMMAND_PORT and replays a capture (or a synthetic stream) on
+# STREAM_PORT, so the whole mirror can run on loopback, e.g.:
+#
+#    python3 spade_emu.py --synthetic 300 --speed 0
+#    python3 spade_mirror.py --no-ssl --server 127.0.0.1
+
+
+import argparse
+import random
+import socket
+import struct
+import threading
+import time
+
+import spade_msg
+
+from spade_mirror import SpadeClient
+
+
+CAPTURE_STREAM = 0   # Datagram received on the stream socket
+CAPTURE_COMMAND = 1  # Datagram received on the command socket
+
+
+class Capture:
+    """
+    Log of the datagrams received from a Spade server.
+    
+    The file starts with MAGIC and the wall-clock time the capture started (float64), followed by one
+    RECORD header (seconds since the capture started, CAPTURE_STREAM/CAPTURE_COMMAND, datagram length) and
+    the datagram itself for each datagram. Safe to record from multiple threads.
+    """
+    MAGIC = b'SPADECAP\x01'
+    HEADER = struct.Struct('<d')
+    RECORD = struct.Struct('<dBI')
+    
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self._lock = threading.Lock()
+        self._file = open(fpath, 'wb')
+        self._t_start = time.monotonic()
+        self._file.write(self.__class__.MAGIC + self.__class__.HEADER.pack(time.time()))
+        self.records = 0
+        return
+    
+    
+    def record(self, kind, data):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(self.__class__.RECORD.pack(time.monotonic() - self._t_start, kind, len(data)))
+            self._file.write(data)
+            self.records += 1
+    
+    
+    def record_stream(self, data):
+        self.record(CAPTURE_STREAM, data)
+    
+    
+    def record_command(self, data):
+        self.record(CAPTURE_COMMAND, data)
+    
+    
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+    
+    
+    @classmethod
+    def load(cls, fpath):
+        """
+        Reads a capture file. Returns a list of (seconds since the capture started, kind, datagram)
+        """
+        with open(fpath, 'rb') as f:
+            data = f.read()
+        if not data.startswith(cls.MAGIC):
+            raise ValueError(f'Not a Spade capture file: {fpath}')
+        offs = len(cls.MAGIC) + cls.HEADER.size
+        records = []
+        while offs + cls.RECORD.size <= len(data):
+            timestamp, kind, length = cls.RECORD.unpack_from(data, offs)
+            offs += cls.RECORD.size
+            if offs + length > len(data):
+                # Truncated capture
+                break
+            records.append((timestamp, kind, data[offs:offs+length]))
+            offs += length
+        return records
+
+
+def synthetic_capture(frames=300, fps=30.0, frame_sz=20000, chunk_sz=1400, width=640, height=480):
+    """
+    Generates the stream records of a capture (in the format returned by Capture.load) for a stream of
+    placeholder JPEG frames, one chunk per datagram
+    """
+    chunk_cls = spade_msg.SpadeUdpMsg_0x9999_StreamChunk
+    records = []
+    for n in range(1, int(frames) + 1):
+        data = b'\xff\xd8' + bytes([n % 256]) * (int(frame_sz) - 4) + b'\xff\xd9'
+        parts = [data[i:i+chunk_sz] for i in range(0, len(data), chunk_sz)]
+        for i, part in enumerate(parts):
+            last_chunk = len(parts) if i == len(parts) - 1 else 0
+            chunk = chunk_cls.STRUCT.pack(spade_msg.SpadeUdpMsg_0x9999.MAGIC, 0x0003, 0, 0, len(part) + 27, 0,
+                                          1, n, 0, i + 1, last_chunk, len(part), n, width, height, n) + part
+            records.append(((n - 1) / fps, CAPTURE_STREAM, chunk))
+    return records
+
+
+class Impairment:
+    """
+    Randomly drops, duplicates, or swaps stream datagrams with the next datagram to emulate a poor
+    connection (reproducibly, for a given seed). Used by SpadeEmulator for each replay, and by spade_bench
+    to impair a stream in the same way without sockets.
+    """
+    
+    def __init__(self, loss=0.0, duplicate=0.0, reorder=0.0, seed=None):
+        self.loss = float(loss)
+        self.duplicate = float(duplicate)
+        self.reorder = float(reorder)
+        self._random = random.Random(seed)
+        self._held = None  # Datagram being sent after the next one
+        # Statistics
+        self.datagrams_lost = 0
+        self.datagrams_duplicated = 0
+        self.datagrams_reordered = 0
+        return
+    
+    
+    def apply(self, data):
+        """
+        Returns the datagrams to send in place of a datagram (none if it's dropped or held back)
+        """
+        rand = self._random
+        if rand.random() < self.loss:
+            self.datagrams_lost += 1
+            return []
+        copies = 1
+        if rand.random() < self.duplicate:
+            self.datagrams_duplicated += 1
+            copies = 2
+        if self._held is None and rand.random() < self.reorder:
+            self.datagrams_reordered += 1
+            self._held = data
+            return []
+        datagrams = [data] * copies
+        if self._held is not None:
+            datagrams.append(self._held)
+            self._held = None
+        return datagrams
+
+
+class SpadeEmulator:
+    """
+    Emulates a Spade server on the local host.
+    
+    Commands are answered with the matching responses from the capture (if any) or with default values.
+    Once a client requests the stream, the capture's stream datagrams are replayed to it at `speed` times
+    their original rate (0 for as fast as possible), looping until the client ends the stream or another
+    client requests it. Datagrams can be randomly dropped, duplicated, or swapped with the next datagram to
+    emulate a poor connection.
+    """
+    # Default command responses (arg1 values)
+    BATTERY = 3900   # 72%
+    VERSION = 7100   # M9|X7
+    PWM = 55
+    REMOTE_KEY = b'\x01\x02\x03\x04'
+    POLL_INTERVAL = 0.5  # Seconds between checks for a close request while waiting for requests
+    
+    def __init__(self, records, host='127.0.0.1', speed=1.0, loss=0.0, duplicate=0.0, reorder=0.0, seed=None, loop=True):
+        self.stream_records = [(t, data) for t, kind, data in records if kind == CAPTURE_STREAM]
+        if not self.stream_records:
+            raise ValueError('Capture contains no stream datagrams')
+        self.responses = {}  # Command response type -> Recorded response
+        for t, kind, data in records:
+            if kind == CAPTURE_COMMAND and data[:2] == b'\x99\x99' and len(data) >= spade_msg.SpadeUdpMsg_0x9999.sizeof():
+                self.responses[struct.unpack_from('<H', data, 2)[0]] = data
+        self.host = host
+        self.speed = float(speed)
+        self.loss = float(loss)
+        self.duplicate = float(duplicate)
+        self.reorder = float(reorder)
+        self.loop = bool(loop)
+        self._random = random.Random(seed)  # Seeds each replay's Impairment
+        # Frame indices are offset by this much on each pass through the capture so they keep increasing
+        frame_indices = [struct.unpack_from('<I', data, 25)[0] for t, data in self.stream_records]
+        self._index_span = max(frame_indices) - min(frame_indices) + 1
+        self.command_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.command_sock.bind((host, SpadeClient.COMMAND_PORT))
+        self.command_sock.settimeout(self.__class__.POLL_INTERVAL)
+        self.stream_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.stream_sock.bind((host, SpadeClient.STREAM_PORT))
+        self.stream_sock.settimeout(self.__class__.POLL_INTERVAL)
+        self._replays = {}  # Client address -> threading.Event that stops its replay
+        self._lock = threading.Lock()
+        self._closed = False
+        self._threads = []
+        # Statistics
+        self.commands = 0
+        self.datagrams_sent = 0
+        self._impairments = []  # Impairment of each replay so far
+        return
+    
+    
+    @property
+    def datagrams_lost(self):
+        return sum(i.datagrams_lost for i in self._impairments)
+    
+    
+    @property
+    def datagrams_duplicated(self):
+        return sum(i.datagrams_duplicated for i in self._impairments)
+    
+    
+    @property
+    def datagrams_reordered(self):
+        return sum(i.datagrams_reordered for i in self._impairments)
+    
+    
+    def start(self):
+        self._threads = [
+            threading.Thread(target=self._command_loop, name='SpadeEmuCommand', daemon=True),
+            threading.Thread(target=self._stream_loop, name='SpadeEmuStream', daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        print(f'Emulating Spade server on {self.host} ({len(self.stream_records)} stream datagrams, speed: {self.speed or "max"})')
+    
+    
+    def close(self):
+        self._closed = True
+        with self._lock:
+            for stop in self._replays.values():
+                stop.set()
+            self._replays.clear()
+        # The ports are only released once the threads waiting on them have returned
+        for thread in self._threads:
+            thread.join()
+        self.command_sock.close()
+        self.stream_sock.close()
+    
+    
+    def _command_loop(self):
+        while not self._closed:
+            try:
+                data, addr = self.command_sock.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                # Socket closed
+                break
+            self.commands += 1
+            try:
+                response = self._respond(data)
+            except Exception as e:
+                print(f'[WARNING] Emulator ignored malformed command: {e}')
+                continue
+            if response is not None:
+                self.command_sock.sendto(response, addr)
+    
+    
+    def _respond(self, data):
+        if data[:6] in spade_msg.SpadeUdpMsg_SETCMD.MAGIC:
+            msg = spade_msg.SpadeUdpMsg_SETCMD.from_bytes(data[:spade_msg.SpadeUdpMsg_SETCMD.sizeof()])
+            payload = self.__class__.REMOTE_KEY if msg.type == 0x90 else b''
+            return b'RETCMD' + struct.pack('<IHH', msg.cmdSendIndex, msg.type, len(payload)) + payload
+        
+        msg = spade_msg.SpadeUdpMsg_0x9999.from_bytes(data[:spade_msg.SpadeUdpMsg_0x9999.sizeof()])
+        recorded = self.responses.get(msg.type)
+        if recorded is not None:
+            # Replay the recorded response with the request's index
+            return recorded[:4] + struct.pack('<I', msg.cmdSendIndex) + recorded[8:]
+        arg1 = {0x1002: self.__class__.VERSION, 0x1015: self.__class__.PWM, 0x1017: self.__class__.BATTERY}.get(msg.type, 0)
+        return struct.pack('<HHIIIQ', msg.magic, msg.type, msg.cmdSendIndex, arg1, 0, 0)
+    
+    
+    def _stream_loop(self):
+        while not self._closed:
+            try:
+                data, addr = self.stream_sock.recvfrom(65536)
+            except (socket.timeout, ConnectionError):
+                continue
+            except OSError:
+                # Socket closed
+                break
+            if data[:2] != b'\x99\x99' or len(data) < 4:
+                continue
+            msg_type = struct.unpack_from('<H', data, 2)[0]
+            with self._lock:
+                if msg_type == 0x0001:  # ReadStream
+                    if addr not in self._replays:
+                        # Like the device, only stream to the most recent client
+                        for stop in self._replays.values():
+                            stop.set()
+                        self._replays.clear()
+                        stop = threading.Event()
+                        self._replays[addr] = stop
+                        threading.Thread(target=self._replay, args=(addr, stop), name=f'SpadeEmuReplay-{addr[1]}', daemon=True).start()
+                elif msg_type == 0x0002:  # EndStream
+                    stop = self._replays.pop(addr, None)
+                    if stop is not None:
+                        stop.set()
+    
+    
+    def _replay(self, addr, stop):
+        with self._lock:
+            impairment = Impairment(self.loss, self.duplicate, self.reorder, self._random.getrandbits(64))
+            self._impairments.append(impairment)
+        n_pass = 0
+        while not stop.is_set():
+            t_start = time.monotonic()
+            t_first = self.stream_records[0][0]
+            for timestamp, data in self.stream_records:
+                if stop.is_set():
+                    return
+                if self.speed > 0:
+                    delay = t_start + (timestamp - t_first) / self.speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                if n_pass > 0:
+                    data = renumber_frames(data, n_pass * self._index_span)
+                try:
+                    for datagram in impairment.apply(data):
+                        self.stream_sock.sendto(datagram, addr)
+                        self.datagrams_sent += 1
+                except OSError:
+                    # Emulator closed or client gone
+                    return
+            n_pass += 1
+            if not self.loop:
+                break
+        with self._lock:
+            if self._replays.get(addr) is stop:
+                del self._replays[addr]
+
+
+def renumber_frames(data, offset):
+    """
+    Returns a copy of a stream datagram with the frame index of every chunk in it increased by offset
+    """
+    chunk_cls = spade_msg.SpadeUdpMsg_0x9999_StreamChunk
+    hdr_sz = chunk_cls.STRUCT.size
+    data = bytearray(data)
+    offs = 0
+    while len(data) - offs >= hdr_sz:
+        fields = list(chunk_cls.STRUCT.unpack_from(data, offs))
+        for i in (7, 12, 15):  # n_frame1, n_frame2, n_frame3
+            fields[i] = (fields[i] + offset) & 0xffffffff
+        chunk_cls.STRUCT.pack_into(data, offs, *fields)
+        offs += hdr_sz + fields[11]
+    return bytes(data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Emulates a Spade server by replaying a packet capture')
+    parser.add_argument('capture', nargs='?', help='Capture file recorded with "spade_mirror.py --capture"')
+    parser.add_argument('--synthetic', type=int, default=None, metavar='FRAMES', help='Replay a synthetic stream with this many frames instead of a capture')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed relative to the capture; 0 replays as fast as possible (default: 1)')
+    parser.add_argument('--loss', type=float, default=0.0, metavar='P', help='Probability of dropping each stream datagram')
+    parser.add_argument('--duplicate', type=float, default=0.0, metavar='P', help='Probability of sending each stream datagram twice')
+    parser.add_argument('--reorder', type=float, default=0.0, metavar='P', help='Probability of delaying a stream datagram until after the next one')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for the impairments (for reproducible runs)')
+    parser.add_argument('--no-loop', action='store_true', help='Stop streaming at the end of the capture instead of starting over')
+    args = parser.parse_args()
+    
+    if args.synthetic is not None:
+        records = synthetic_capture(args.synthetic)
+    elif args.capture is not None:
+        records = Capture.load(args.capture)
+    else:
+        parser.error('Specify a capture file or --synthetic')
+    
+    emulator = SpadeEmulator(records, args.host, args.speed, args.loss, args.duplicate, args.reorder, args.seed, not args.no_loop)
+    emulator.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        emulator.close()
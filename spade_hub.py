@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# Author: Sean Pesce
+
+# Hub mode: serves several Spade devices from one mirror, each under /devices/<name>/ (e.g.,
+# /devices/left/stream, /devices/left/battery). Every device has its own SpadeClient, with its own ingest
+# thread, frame pool, telemetry cache, recorder and so on.
+#
+# With workers > 1, the devices are sharded across worker processes (so ingest and serving scale with CPU
+# cores rather than sharing one GIL). Each worker serves its devices on its own port, and the main process
+# serves the device index and redirects each device's requests to its worker.
+
+
+import multiprocessing
+import re
+import signal
+import sys
+import threading
+import time
+
+from spade_mirror import HttpHandler, http_server
+
+
+NAME_PATTERN = re.compile(r'[A-Za-z0-9_.-]+')
+
+# Workers are spawned rather than forked, so they don't inherit the hub's sockets or locks held by its other
+# threads
+_context = multiprocessing.get_context('spawn')
+
+
+def parse_device(spec):
+    """
+    Parses a NAME=ADDRESS[%INTERFACE] device specification. Returns the name, address and interface (or
+    None).
+    """
+    name, sep, address = spec.partition('=')
+    if not sep or not address:
+        raise ValueError(f'Invalid device "{spec}" (expected NAME=ADDRESS[%INTERFACE])')
+    if not NAME_PATTERN.fullmatch(name) or name in ('.', '..'):
+        raise ValueError(f'Invalid device name "{name}" (use letters, digits, "_", "." and "-")')
+    address, _, interface = address.partition('%')
+    return name, address, interface or None
+
+
+def serve(devices, make_client, port, cert_fpath=None, privkey_fpath=None, use_async=False, device_ports=None):
+    """
+    Serves the given devices (a list of (name, address, interface) tuples) from this process. make_client
+    (address, interface, name) creates each device's SpadeClient. device_ports maps the names of devices
+    served by other processes to their ports, for redirects.
+    """
+    clients = {}
+    for name, address, interface in devices:
+        clients[name] = make_client(address, interface, name)
+    HttpHandler.DEVICES = clients
+    HttpHandler.DEVICE_PORTS = dict(device_ports or {})
+    try:
+        if use_async:
+            import spade_async
+            HttpHandler.PORT = int(port)
+            servers = {name: spade_async.AsyncMirrorServer(client, cert_fpath, privkey_fpath) for name, client in clients.items()}
+            hub = spade_async.AsyncMirrorServer(None, cert_fpath, privkey_fpath, port=port, devices=servers)
+            HttpHandler.PROTOCOL = hub.protocol
+            for client in clients.values():
+                client.telemetry.start()
+            hub.run()
+            return
+        httpd = http_server(port, cert_fpath, privkey_fpath)
+        for client in clients.values():
+            client.start_services()
+        httpd.serve_forever()
+    finally:
+        # Worker processes exit without running atexit handlers, so the ingest processes are closed here
+        for client in clients.values():
+            if client.ingest_process is not None:
+                client.ingest_process.close()
+
+
+def _run_worker(setup, *args):
+    """
+    Main function of a worker process
+    """
+    # Exits normally when terminated by the hub, so that the worker's clients are cleaned up (see spade_shm)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    if setup is not None:
+        setup()
+    serve(*args)
+
+
+class Hub:
+    """
+    Serves a set of named devices, optionally sharded across worker processes
+    """
+    RESTART_DELAY = 2.0  # Seconds between checks for (and restarts of) worker processes that exited
+    
+    def __init__(self, devices, make_client, port=HttpHandler.PORT, cert_fpath=None, privkey_fpath=None, use_async=False, workers=0, setup=None):
+        names = [name for name, _, _ in devices]
+        if len(set(names)) != len(names):
+            raise ValueError('Device names must be unique')
+        self.devices = list(devices)
+        self.make_client = make_client
+        self.port = int(port)
+        self.cert_fpath = cert_fpath
+        self.privkey_fpath = privkey_fpath
+        self.use_async = bool(use_async)
+        self.workers = min(max(0, int(workers)), len(self.devices))
+        self.setup = setup  # Called by each worker process before it starts serving (e.g., to apply settings)
+        self._processes = []
+        self._stopping = False
+        return
+    
+    
+    def shards(self):
+        """
+        Returns the devices served by each worker process (round-robin) and each worker's port
+        """
+        return [(self.devices[i::self.workers], self.port + 1 + i) for i in range(self.workers)]
+    
+    
+    def _start_worker(self, shard, port):
+        # Not a daemon, since workers might start processes of their own (see spade_shm); they're terminated
+        # when the hub exits instead
+        process = _context.Process(target=_run_worker, name=f'SpadeHubWorker-{port}',
+                                   args=(self.setup, shard, self.make_client, port, self.cert_fpath, self.privkey_fpath, self.use_async))
+        process.start()
+        return process
+    
+    
+    def _supervise(self):
+        while not self._stopping:
+            time.sleep(self.__class__.RESTART_DELAY)
+            if self._stopping:
+                return
+            for i, (shard, port) in enumerate(self.shards()):
+                process = self._processes[i]
+                if not process.is_alive():
+                    print(f'[WARNING] Hub worker on port {port} exited with code {process.exitcode}; restarting')
+                    self._processes[i] = self._start_worker(shard, port)
+    
+    
+    def run(self):
+        if self.workers <= 1:
+            serve(self.devices, self.make_client, self.port, self.cert_fpath, self.privkey_fpath, self.use_async)
+            return
+        # Exits (terminating the workers) on SIGTERM, rather than leaving the workers running
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+        device_ports = {}
+        for shard, port in self.shards():
+            self._processes.append(self._start_worker(shard, port))
+            for name, _, _ in shard:
+                device_ports[name] = port
+        threading.Thread(target=self._supervise, name='SpadeHubSupervisor', daemon=True).start()
+        try:
+            # This process only serves the device index and redirects
+            serve([], self.make_client, self.port, self.cert_fpath, self.privkey_fpath, self.use_async, device_ports)
+        finally:
+            self._stopping = True
+            for process in self._processes:
+                process.terminate()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# Author: Sean Pesce
+
+# Metrics in the Prometheus text exposition format, served at /metrics.
+#
+# Hot-path counters aren't kept here: the ingest pipeline already counts what it does in plain integer
+# attributes (each written by a single thread), and collector callbacks read them only when the metrics
+# are scraped. Histograms are for per-frame and per-command events; observe() doesn't allocate.
+
+
+import bisect
+import threading
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed bucket upper bounds (in seconds)
+    """
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last count is for the +Inf bucket
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+        return
+    
+    
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+    
+    
+    def samples(self, name, labels):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            yield f'{name}_bucket', dict(labels, le=le), cumulative
+        yield f'{name}_sum', labels, total
+        yield f'{name}_count', labels, count
+
+
+class Metrics:
+    """
+    Registry of histograms and collector callbacks.
+    
+    A collector is a callable that returns (or yields) (name, type, help, labels, value) tuples, where type
+    is 'counter' or 'gauge' and labels is a dict (or None).
+    """
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # (name, sorted label items) -> Histogram
+        self._help = {}        # Histogram name -> help text
+        self._collectors = []
+        return
+    
+    
+    def histogram(self, name, help, labels=None, buckets=Histogram.BUCKETS):
+        """
+        Returns the histogram with the given name and labels, creating it on first use
+        """
+        key = (name, tuple(sorted((labels or {}).items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = Histogram(buckets)
+                    self._help[name] = help
+                    # Replaced (never mutated) so that render() can iterate without locking
+                    self._histograms = {**self._histograms, key: histogram}
+        return histogram
+    
+    
+    def add_collector(self, collector):
+        with self._lock:
+            self._collectors = self._collectors + [collector]
+    
+    
+    def render(self):
+        """
+        Returns all metrics in the Prometheus text exposition format
+        """
+        families = {}  # Name -> (type, help, [(sample name, labels, value)])
+        for collector in self._collectors:
+            for name, metric_type, help, labels, value in collector():
+                if value is None:
+                    continue
+                families.setdefault(name, (metric_type, help, []))[2].append((name, labels or {}, value))
+        for (name, label_items), histogram in self._histograms.items():
+            families.setdefault(name, ('histogram', self._help[name], []))[2].extend(histogram.samples(name, dict(label_items)))
+        
+        lines = []
+        for name, (metric_type, help, samples) in families.items():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for sample_name, labels, value in samples:
+                if labels:
+                    label_str = ','.join(f'{k}="{escape_label(v)}"' for k, v in labels.items())
+                    lines.append(f'{sample_name}{{{label_str}}} {value}')
+                else:
+                    lines.append(f'{sample_name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -8,26 +8,46 @@
 #    openssl req -new -newkey rsa:4096 -x509 -sha256 -days 365 -nodes -out cert.crt -keyout private.key
 
 
+import collections
+import concurrent.futures
 import datetime
+import functools
+import heapq
 import http.server
+import itertools
+import json
+import logging
+import os
 import queue
+import selectors
 import socket
+import select
 import ssl
 import sys
+import threading
 import time
+import urllib.parse
 
-from io import BytesIO
-
+import spade_accel
 import spade_msg
-from spade_util import ping, udp_send, decode_battery_percentage
+import spade_ws
+from spade_command import CommandChannel
+from spade_metrics import Metrics
+from spade_util import udp_send, decode_battery_percentage, sendmsg_all, bind_to_interface
 
 
 class HttpHandler(http.server.BaseHTTPRequestHandler):
     BOUNDARY = b'--SP-LaputanMachine--'
     SPADE_CLIENT = None
-    RENDER_RATE = 0  # One frame is rendered locally (with MatPlotLib) for every RENDER_RATE frames sent to the HTTP client (Set to <1 to never render locally)
     PROTOCOL = 'http'
     PORT = 45100
+    DEVICES = None  # In hub mode (see spade_hub), the SpadeClient of each device served by this process, by name
+    DEVICE_PORTS = {}  # In hub mode, the port of the worker process that serves each of the other devices, by name
+    TELEMETRY_ROUTES = {
+        '/battery': 'battery',
+        '/model': 'version',
+        '/pwm': 'pwm',
+    }
     
     
     @classmethod
@@ -43,20 +63,452 @@ class HttpHandler(http.server.BaseHTTPRequestHandler):
     
     
     @classmethod
-    def HEADERS_IMAGE(cls, length):
+    def HEADERS_IMAGE(cls, length, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
         headers = {
-            'X-Timestamp': time.time(),
+            'X-Timestamp': timestamp,
             'Content-Length': str(int(length)),
             'Content-Type': 'image/jpeg',
         }
         return headers
     
     
+    @classmethod
+    def PART_HEADER(cls, frame):
+        """
+        Returns the multipart headers that precede a frame's JPEG data (starting with the CRLF that ends the
+        previous part). They're built once per frame and shared by every viewer.
+        """
+        header = frame.cache.get('part_header')
+        if header is None:
+            img_headers = cls.HEADERS_IMAGE(len(frame.data), frame.timestamp)
+            header = b'\r\n' + cls.BOUNDARY + b'\r\n' + ''.join(f'{k}: {v}\r\n' for k, v in img_headers.items()).encode('latin-1') + b'\r\n'
+            header = frame.cache.setdefault('part_header', header)
+        return header
+    
+    
+    @classmethod
+    def PART(cls, frame):
+        """
+        Returns a frame's complete multipart part (headers and JPEG data) as a single immutable bytes
+        object, for connections that can't use vectored writes. Built once per frame and shared by every
+        viewer that needs it.
+        """
+        part = frame.cache.get('part')
+        if part is None:
+            part = frame.cache.setdefault('part', cls.PART_HEADER(frame) + frame.data)
+        return part
+    
+    
+    @classmethod
+    def WS_HEADER(cls, frame):
+        """
+        Returns the WebSocket message header and frame header that precede a frame's JPEG data in /ws
+        messages. Built once per frame and shared by every viewer.
+        """
+        header = frame.cache.get('ws_header')
+        if header is None:
+            header = frame.cache.setdefault('ws_header', spade_ws.frame_message_header(frame))
+        return header
+    
+    
+    @classmethod
+    def WS_MESSAGE(cls, frame):
+        """
+        Same as PART, but returns a frame's complete /ws message
+        """
+        message = frame.cache.get('ws_message')
+        if message is None:
+            message = frame.cache.setdefault('ws_message', cls.WS_HEADER(frame) + frame.data)
+        return message
+    
+    
+    def send_frame(self, frame):
+        """
+        Sends a frame as the next part of the multipart stream with a single vectored write
+        """
+        if isinstance(self.connection, ssl.SSLSocket):
+            # TLS sockets don't support sendmsg(), so send the whole part in one write (avoiding a separate
+            # TLS record for the headers)
+            self.wfile.write(self.__class__.PART(frame))
+            return
+        sendmsg_all(self.connection, (self.__class__.PART_HEADER(frame), frame.data))
+    
+    
+    @classmethod
+    def RECORDING_RESPONSE(cls, recorder, path, query):
+        """
+        Resolves a request for /recordings (a JSON list of the recorded segments) or
+        /recordings/<name>?start=<timestamp>&end=<timestamp> (the frames recorded in a segment between two
+        Unix timestamps, as a multipart stream). Returns the response status, headers and body; for a
+        recorded range, the body is the (open data file, offset, length) of the parts to send from disk, and
+        the caller closes the file.
+        """
+        if recorder is None:
+            body = b'Error: Recording is disabled'
+            return 404, {'Content-Length': len(body)}, body
+        if path in ('/recordings', '/recordings/'):
+            body = json.dumps(recorder.listing()).encode('ascii')
+            return 200, {'Content-Type': 'application/json', 'Content-Length': len(body)}, body
+        
+        name = path[len('/recordings/'):]
+        params = urllib.parse.parse_qs(query)
+        try:
+            start = float(params['start'][0]) if 'start' in params else None
+            end = float(params['end'][0]) if 'end' in params else None
+        except ValueError:
+            body = b'Error: start and end must be Unix timestamps'
+            return 400, {'Content-Length': len(body)}, body
+        try:
+            found = recorder.find(name, start, end)
+        except (KeyError, FileNotFoundError):
+            # (FileNotFoundError if the segment was just deleted to enforce the size limit)
+            found = None
+            body = b'Error: Recording not found'
+        else:
+            body = b'Error: No frames recorded in the requested range'
+        if found is None:
+            return 404, {'Content-Length': len(body)}, body
+        
+        f, offset, count, frames = found
+        headers = cls.HEADERS_BASE()
+        headers['Content-Length'] = recorder.response_length(count)
+        headers['X-Frame-Count'] = frames
+        return 200, headers, (f, offset, count)
+    
+    
+    @classmethod
+    def ETAG(cls, frame):
+        # The completion time keeps frame indices from colliding after the stream restarts
+        return f'"{frame.index}-{int(frame.timestamp * 1000)}"'
+    
+    
+    @classmethod
+    def SNAPSHOT_RESPONSE(cls, frame, if_none_match=None):
+        """
+        Returns the status, headers and body of a /snapshot.jpg response for a frame (or None if no frame is
+        available)
+        """
+        if frame is None:
+            body = b'Error: No frame available'
+            return 503, {'Retry-After': 1, 'Content-Length': len(body)}, body
+        etag = cls.ETAG(frame)
+        headers = {
+            'ETag': etag,
+            'Cache-Control': 'no-cache',
+            'Access-Control-Allow-Origin': '*',  # CORS
+            'X-Timestamp': frame.timestamp,
+        }
+        if if_none_match is not None and (if_none_match.strip() == '*' or etag in (t.strip() for t in if_none_match.split(','))):
+            return 304, headers, b''
+        headers['Content-Type'] = 'image/jpeg'
+        headers['Content-Length'] = len(frame.data)
+        return 200, headers, frame.data
+    
+    
+    def send_snapshot(self, spade_client, query):
+        params = urllib.parse.parse_qs(query)
+        try:
+            wait = min(float(params['wait'][0]), spade_client.__class__.SNAPSHOT_WAIT_MAX) if 'wait' in params else 0.0
+        except ValueError:
+            self.send_response(400)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(b'Error: wait must be a number of seconds')
+            return
+        if_none_match = self.headers['If-None-Match']
+        try:
+            frame = spade_client.snapshot(if_none_match, wait)
+        except IOError as e:
+            print(f'[ERROR] Snapshot failed: {e}')
+            frame = None
+        try:
+            status, headers, body = self.__class__.SNAPSHOT_RESPONSE(frame, if_none_match)
+            self.send_response(status)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            if frame is not None:
+                frame.release()
+    
+    
+    @classmethod
+    def STREAM_VARIANT(cls, transcoder, query):
+        """
+        Resolves the variant of /stream requested by the query string (see spade_transcode). Returns the
+        response status and either the variant (None for the full-resolution stream) or an error message.
+        """
+        params = urllib.parse.parse_qs(query)
+        if not any(k in params for k in ('scale', 'quality', 'fps')):
+            return 200, None
+        if transcoder is None:
+            return 501, b'Error: Variant streams are disabled'
+        try:
+            variant = transcoder.parse(query)
+        except ValueError as e:
+            return 400, f'Error: {e}'.encode('utf-8')
+        if not transcoder.supports(variant):
+            return 501, b'Error: Scaling and re-encoding require Pillow'
+        return 200, variant
+    
+    
+    @classmethod
+    def DEVICE_ROUTE(cls, path):
+        """
+        Splits a hub-mode request path into the device name and the path within the device's routes (e.g.,
+        "/devices/left/stream" -> ("left", "/stream")). The name is None for paths outside /devices/<name>/.
+        """
+        if not path.startswith('/devices/'):
+            return None, path
+        name, _, subpath = path[len('/devices/'):].partition('/')
+        if not name:
+            return None, path
+        return name, '/' + subpath
+    
+    
+    @classmethod
+    def HUB_RESPONSE(cls, name, path, query, host):
+        """
+        Returns the response (status, headers and body) to a hub-mode request that isn't for one of the
+        devices served by this process: the device index, redirects to the worker processes that serve the
+        other devices, and 404s. Returns None for requests that a device in this process should serve.
+        """
+        devices = cls.DEVICES
+        if name is None:
+            names = sorted(set(devices) | set(cls.DEVICE_PORTS))
+            if path == '/':
+                tiles = ''.join(f'<a href="/devices/{n}/"><img src="/devices/{n}/stream" title="{n}" style="max-width: 49vw"></a>\n' for n in names)
+                data = f'<html><head><title>Spade</title></head><body>\n{tiles}</body></html>'.encode('utf-8')
+                return 200, {'Content-Type': 'text/html; charset=utf-8'}, data
+            if path in ('/devices', '/devices/'):
+                listing = [{'name': n, 'path': f'/devices/{n}/', 'port': cls.DEVICE_PORTS.get(n, cls.PORT),
+                            'server': devices[n].server if n in devices else None} for n in names]
+                return 200, {'Content-Type': 'application/json'}, json.dumps(listing).encode('utf-8')
+            return 404, {}, b'Error: Not found'
+        if name in devices:
+            return None
+        port = cls.DEVICE_PORTS.get(name)
+        if port is None:
+            return 404, {}, f'Error: Unknown device "{name}"'.encode('utf-8')
+        # Served by another worker process (on the same host)
+        hostname = urllib.parse.urlsplit(f'//{host or ""}').hostname or 'localhost'
+        if ':' in hostname:
+            hostname = f'[{hostname}]'
+        location = f'{cls.PROTOCOL.lower()}://{hostname}:{port}/devices/{name}{path}'
+        if query:
+            location += f'?{query}'
+        return 307, {'Location': location}, b''
+    
+    
+    def _receive_websocket(self, parser, timeout):
+        """
+        Feeds whatever the viewer has sent (waiting up to timeout seconds for something to arrive) to the
+        parser. Returns False once the viewer has closed the connection.
+        """
+        connection = self.connection
+        # TLS sockets can hold decrypted data that select() doesn't know about
+        if not (isinstance(connection, ssl.SSLSocket) and connection.pending()):
+            if not select.select((connection,), (), (), timeout)[0]:
+                return True
+        data = connection.recv(65536)
+        if not data:
+            return False
+        parser.feed(data)
+        return True
+    
+    
+    def _process_websocket(self, parser, window, timeout):
+        """
+        Processes the viewer's messages (waiting up to timeout seconds for something to arrive), answering
+        pings and close messages. Returns True once the viewer has closed the connection.
+        """
+        if not self._receive_websocket(parser, timeout):
+            return True
+        replies, closed = spade_ws.handle_messages(parser, window)
+        if replies:
+            self.wfile.write(replies)
+        return closed
+    
+    
+    def send_websocket(self, spade_client, query):
+        """
+        Streams frames to a WebSocket viewer (see spade_ws). The viewer's messages are only read in between
+        frames, and every POLL_INTERVAL while waiting for one, so a single thread serves each viewer (TLS
+        sockets can't be read and written from separate threads).
+        """
+        if not spade_ws.is_handshake(self.headers):
+            self.send_response(426)  # Upgrade Required
+            self.send_header('Upgrade', 'websocket')
+            self.send_header('Sec-WebSocket-Version', '13')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(b'Error: WebSocket handshake required')
+            return
+        params = urllib.parse.parse_qs(query)
+        try:
+            window = spade_ws.AckWindow(int(params['window'][0]) if 'window' in params else spade_ws.WINDOW)
+        except ValueError:
+            self.send_response(400)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(b'Error: window must be a number of frames')
+            return
+        
+        # WebSocket handshakes must be answered with an HTTP/1.1 status line
+        self.protocol_version = 'HTTP/1.1'
+        self.send_response(101)  # Switching Protocols
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', spade_ws.accept_key(self.headers['Sec-WebSocket-Key']))
+        self.end_headers()
+        self.wfile.flush()
+        
+        parser = spade_ws.MessageParser()
+        # Only the latest frame is kept while the viewer is behind
+        subscriber = spade_client.subscribe(queue_max=1)
+        subscriber.name = f'{self.client_address[0]}:{self.client_address[1]}'
+        tls = isinstance(self.connection, ssl.SSLSocket)
+        closed = False
+        try:
+            while True:
+                # Process acknowledgements, waiting for one while the window is full
+                deadline = time.monotonic() + spade_ws.ACK_TIMEOUT
+                while True:
+                    timeout = max(0, deadline - time.monotonic()) if window.full else 0
+                    closed = self._process_websocket(parser, window, timeout)
+                    if closed or not window.full:
+                        break
+                    if time.monotonic() >= deadline:
+                        # Viewer isn't acknowledging frames
+                        window.reset()
+                        break
+                if closed:
+                    break
+                
+                try:
+                    frame = subscriber.get(spade_ws.POLL_INTERVAL)
+                except queue.Empty:
+                    # Checks for messages (like a close) while the stream is stalled
+                    continue
+                if frame is None:
+                    # Stream ended
+                    break
+                with frame:
+                    if tls:
+                        self.wfile.write(self.__class__.WS_MESSAGE(frame))
+                    else:
+                        sendmsg_all(self.connection, (self.__class__.WS_HEADER(frame), frame.data))
+                    subscriber.bytes_sent += len(self.__class__.WS_HEADER(frame)) + len(frame.data)
+                    window.sent(frame.index)
+            if not closed:
+                self.wfile.write(spade_ws.close_message())
+        except ConnectionError:
+            # Viewer disconnected
+            pass
+        finally:
+            spade_client.unsubscribe(subscriber)
+            print(f'WebSocket viewer {self.client_address[0]}:{self.client_address[1]} disconnected ({subscriber.frames_delivered} frames sent, {subscriber.frames_dropped} dropped)')
+    
+    
+    def send_accel(self, spade_client, query):
+        """
+        Serves accelerometer samples as a single JSON response or as an SSE/NDJSON stream (see spade_accel)
+        """
+        try:
+            fmt, since = spade_accel.parse_request(query, self.headers['Accept'], self.headers['Last-Event-ID'])
+        except ValueError as e:
+            self.send_response(400)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(f'Error: {e}'.encode('utf-8'))
+            return
+        accel = spade_client.accel
+        # Samples only arrive while the stream is running
+        spade_client.hold_stream(spade_client.__class__.SNAPSHOT_LINGER)
+        if fmt == spade_accel.FORMAT_JSON:
+            data = spade_accel.format_batch(fmt, *accel.read(since))
+            self.send_response(200)
+            self.send_header('Content-Type', spade_accel.CONTENT_TYPES[fmt])
+            self.send_header('Content-Length', len(data))
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Access-Control-Allow-Origin', '*')  # CORS
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        
+        self.send_response(200)
+        self.send_header('Content-Type', spade_accel.CONTENT_TYPES[fmt])
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')  # CORS
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        if since is None:
+            since = accel.count
+        last_write = time.monotonic()
+        try:
+            while True:
+                spade_client.hold_stream(spade_client.__class__.SNAPSHOT_LINGER)
+                start, timestamps, raw, since = accel.read(since)
+                if len(raw) > 0:
+                    self.wfile.write(spade_accel.format_batch(fmt, start, timestamps, raw, since))
+                    last_write = time.monotonic()
+                elif time.monotonic() - last_write >= spade_accel.KEEPALIVE:
+                    self.wfile.write(spade_accel.KEEPALIVES[fmt])
+                    last_write = time.monotonic()
+                time.sleep(spade_accel.STREAM_INTERVAL)
+        except ConnectionError:
+            # Client disconnected
+            pass
+    
+    
+    def send_recording(self, recorder, path, query):
+        status, headers, body = self.__class__.RECORDING_RESPONSE(recorder, path, query)
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Connection', 'close')
+        if type(body) == bytes:
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        
+        # Recorded parts are sent straight from disk; the first part's leading CRLF ends the headers
+        f, offset, count = body
+        with f:
+            self.flush_headers()
+            self.connection.sendfile(f, offset, count)
+        self.wfile.write(recorder.CLOSE_DELIMITER)
+    
+    
     def do_GET(self):
         print(self.headers['Host'])
         spade_client = self.__class__.SPADE_CLIENT
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path
+        prefix = ''  # Path prefix of this device's routes (in hub mode)
+        
+        if self.__class__.DEVICES is not None:
+            name, path = self.__class__.DEVICE_ROUTE(path)
+            response = self.__class__.HUB_RESPONSE(name, path, url.query, self.headers['Host'])
+            if response is not None:
+                status, headers, data = response
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', len(data))
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.wfile.write(data)
+                return
+            spade_client = self.__class__.DEVICES[name]
+            prefix = f'/devices/{name}'
         
-        if self.path not in ('/', '/stream', '/battery', '/model', '/pwm'):
+        if path not in ('/', '/stream', '/ws', '/live', '/snapshot.jpg', '/telemetry', '/battery', '/model', '/pwm', '/recordings', '/metrics') and not path.startswith('/recordings/'):
             self.send_response(404)
             self.send_header('Connection', 'close')
             self.end_headers()
@@ -70,88 +522,536 @@ class HttpHandler(http.server.BaseHTTPRequestHandler):
             return
             
         
-        self.send_response(200)
-        self.send_header('X-Battery', str(spade_client.battery))
-        self.send_header('Connection', 'close')
+        # Telemetry is served from the client's cache; HTTP requests never trigger server commands
+        telemetry = spade_client.telemetry
+        if path in self.__class__.TELEMETRY_ROUTES:
+            value, timestamp = telemetry.get(self.__class__.TELEMETRY_ROUTES[path])
+            if value is None:
+                self.send_response(503)  # Service Unavailable
+                self.send_header('Retry-After', str(max(1, int(telemetry.interval))))
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.wfile.write(b'Error: Value not available')
+                return
+        
+        if path == '/recordings' or path.startswith('/recordings/'):
+            self.send_recording(spade_client.recorder, path, url.query)
+            return
+        
+        if path == '/snapshot.jpg':
+            self.send_snapshot(spade_client, url.query)
+            return
         
-        if self.path == '/battery':
-            data = str(spade_client.battery).encode('ascii')
+        if path == '/ws':
+            self.send_websocket(spade_client, url.query)
+            return
+        
+        if path == '/telemetry':
+            self.send_accel(spade_client, url.query)
+            return
+        
+        if path == '/live':
+            data = spade_ws.LIVE_PAGE.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
             self.send_header('Content-Length', len(data))
+            self.send_header('Connection', 'close')
             self.end_headers()
             self.wfile.write(data)
             return
         
-        elif self.path == '/model':
-            data = str(spade_client.version).encode('ascii')
+        if path == '/metrics':
+            data = spade_client.metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', Metrics.CONTENT_TYPE)
             self.send_header('Content-Length', len(data))
+            self.send_header('Connection', 'close')
             self.end_headers()
             self.wfile.write(data)
             return
         
-        elif self.path == '/pwm':
-            data = str(spade_client.pwm).encode('ascii')
+        variant = None
+        if path == '/stream':
+            status, variant = self.__class__.STREAM_VARIANT(spade_client.transcoder, url.query)
+            if status != 200:
+                self.send_response(status)
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.wfile.write(variant)
+                return
+            # Subscribed before responding, so viewers get an error if the server can't be reached
+            try:
+                if variant is None:
+                    subscriber = spade_client.subscribe()
+                else:
+                    # Variants subscribe from their own pipeline, so the server is probed here
+                    spade_client.connect()
+                    subscriber = spade_client.transcoder.subscribe(variant)
+            except IOError as e:
+                print(f'[ERROR] Failed to start stream: {e}')
+                self.send_response(503)  # Service Unavailable
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.wfile.write(b'Error: Spade server unavailable')
+                return
+        
+        self.send_response(200)
+        battery, _ = telemetry.get('battery')
+        if battery is not None:
+            self.send_header('X-Battery', str(battery))
+        self.send_header('Connection', 'close')
+        
+        if path in self.__class__.TELEMETRY_ROUTES:
+            data = str(value).encode('ascii')
+            self.send_header('Age', str(int(max(0, time.time() - timestamp))))
+            self.send_header('X-Telemetry-Timestamp', str(timestamp))
             self.send_header('Content-Length', len(data))
             self.end_headers()
             self.wfile.write(data)
             return
         
-        elif self.path == '/':
+        if path == '/':
             # @TODO: Insert model and battery percentage in DOM
-            html_data = f'<html><head></head><body><img src="{self.__class__.PROTOCOL.lower()}://{self.headers["Host"]}/stream" >\n</body></html>'
+            html_data = f'<html><head></head><body><img src="{self.__class__.PROTOCOL.lower()}://{self.headers["Host"]}{prefix}/stream" >\n</body></html>'
             print(f'Serving page:\n{html_data}')
             self.send_header('Content-Length', len(html_data))
             self.end_headers()
             self.wfile.write(html_data.encode('ascii'))
             return
         
-        elif self.path == '/stream':
+        elif path == '/stream':
             for k, v in self.__class__.HEADERS_BASE().items():
                 self.send_header(k, v)
-            spade_client.connect()
-            spade_client.streaming = True
-            spade_client.stream_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            server_address = (spade_client.server, spade_client.__class__.STREAM_PORT)
-            data = spade_client.__class__.READ_STREAM_REQUEST
-            sent = spade_client.stream_sock.sendto(data, server_address)
-            assert sent == len(data), f'UDP message was {len(data)} bytes but only {sent} were sent'
-            while spade_client.streaming:
-                frame = spade_client.get_frame()
-                if frame is None:
-                    continue
-                
-                self.end_headers()
-                self.wfile.write(self.__class__.BOUNDARY)
-                self.end_headers()
-                img_headers = self.__class__.HEADERS_IMAGE(len(frame.data))
-                for k, v in img_headers.items():
-                    self.send_header(k, v)
-                self.end_headers()
-                self.wfile.write(frame.data)
-                if self.__class__.RENDER_RATE > 0 and frame.index % self.__class__.RENDER_RATE == 0:
-                    frame.render()#f'{spade_client.version}  |  Frame {frame.index}  |  Battery: {spade_client.battery}%')
-                
-                #print(f'Reconstructed frame: {frame.index}')
-                #time.sleep(0.016)  # ~60FPS
-            
-            spade_client.streaming = False
-            if spade_client.stream_sock is not None and not spade_client.stream_sock._closed:
-                # @TODO: Send EndStream message
-                spade_client.stream_sock.close()
-            spade_client.stream_sock = None
+            # Frames are reassembled once by the client's shared ingest thread (and transcoded once per variant);
+            # this request only consumes them
+            subscriber.name = f'{self.client_address[0]}:{self.client_address[1]}'
+            try:
+                # The blank line that ends the response headers is sent as the first part's leading CRLF
+                self.flush_headers()
+                while True:
+                    frame = subscriber.get()
+                    if frame is None:
+                        # Stream ended
+                        break
+                    
+                    with frame:
+                        self.send_frame(frame)
+                        subscriber.bytes_sent += len(self.__class__.PART_HEADER(frame)) + len(frame.data)
+                    
+                    #print(f'Reconstructed frame: {frame.index}')
+                    #time.sleep(0.016)  # ~60FPS
+            except ConnectionError:
+                # Viewer disconnected
+                pass
+            finally:
+                if variant is None:
+                    spade_client.unsubscribe(subscriber)
+                else:
+                    spade_client.transcoder.unsubscribe(variant, subscriber)
+                print(f'Viewer {self.client_address[0]}:{self.client_address[1]} disconnected ({subscriber.frames_delivered} frames sent, {subscriber.frames_dropped} dropped)')
         return
 
 
+class FramePool:
+    """
+    Reference-counted pool of JpgFrame buffers.
+    
+    acquire() returns a frame holding a single reference. Each consumer that keeps a frame calls
+    retain(), and every reference is dropped with release(); the frame returns to the pool only when the
+    count reaches zero, so no consumer can ever observe its buffer being reused. The pool allocates new
+    frames whenever all existing ones are in use and keeps at most max_free idle frames around.
+    
+    Frame buffers are sized per stream resolution from a moving average of the completed frame sizes
+    (see size_hint()), so pooled memory follows the actual size of the stream rather than a fixed
+    worst case.
+    """
+    MAX_FREE = 16
+    BYTES_PER_PIXEL = 0.25  # Initial JPEG size estimate for a resolution that hasn't been seen yet
+    SIZE_HEADROOM = 1.25    # Buffers are sized this much larger than the average frame
+    SIZE_EWMA_ALPHA = 0.1   # Weight of each new frame in the average frame size
+    
+    def __init__(self, max_free=MAX_FREE, prealloc=0):
+        self.max_free = int(max_free)
+        self._lock = threading.Lock()
+        self._frame_sizes = {}  # (width, height) -> Moving average of completed frame sizes
+        # Statistics
+        self.buffer_bytes = 0       # Bytes of frame buffer memory owned by the pool
+        self.peak_buffer_bytes = 0
+        self.resizes = 0            # Number of frame buffer (re)allocations
+        # Buffers are allocated once the first frame's size hint is known
+        self._free = [JpgFrame(pool=self, buf_sz=0) for i in range(int(prealloc))]
+        self.allocated = len(self._free)  # Frames currently owned by the pool (in use or idle)
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.allocations = self.allocated  # Frames allocated since the pool was created
+        self.release_hook = None  # Called with each frame whose last reference has been released
+        return
+    
+    
+    def acquire(self):
+        with self._lock:
+            frame = self._free.pop() if self._free else None
+        created = frame is None
+        if created:
+            # Created without holding the lock, since frames report their buffer allocations to _track
+            frame = JpgFrame(pool=self, buf_sz=0)
+        with self._lock:
+            if created:
+                self.allocated += 1
+                self.allocations += 1
+            frame._refs = 1
+            self.in_use += 1
+            if self.in_use > self.peak_in_use:
+                self.peak_in_use = self.in_use
+        return frame
+    
+    
+    def retain(self, frame):
+        with self._lock:
+            assert frame._refs > 0, f'Attempt to retain released frame {frame.index}'
+            frame._refs += 1
+    
+    
+    def release(self, frame):
+        with self._lock:
+            assert frame._refs > 0, f'Attempt to release frame {frame.index} more times than it was retained'
+            frame._refs -= 1
+            if frame._refs > 0:
+                return
+            if self.release_hook is not None:
+                # Called before the frame can be reused
+                self.release_hook(frame)
+            self.in_use -= 1
+            if len(self._free) < self.max_free:
+                self._free.append(frame)
+            else:
+                # Shrink back down after a burst
+                self.allocated -= 1
+                self.buffer_bytes -= len(frame._buf)
+    
+    
+    def size_hint(self, width, height):
+        """
+        Returns the buffer size to use for a new frame with the given resolution
+        """
+        avg = self._frame_sizes.get((width, height))
+        if avg is None:
+            return int(width * height * self.__class__.BYTES_PER_PIXEL)
+        return int(avg * self.__class__.SIZE_HEADROOM)
+    
+    
+    def observe(self, frame):
+        """
+        Updates the average frame size for the resolution of a completed frame
+        """
+        key = (frame.width, frame.height)
+        avg = self._frame_sizes.get(key)
+        if avg is None:
+            self._frame_sizes[key] = frame.acquired_sz
+        else:
+            self._frame_sizes[key] = avg + (frame.acquired_sz - avg) * self.__class__.SIZE_EWMA_ALPHA
+    
+    
+    def _track(self, delta):
+        """
+        Called by pooled frames whenever their buffer is reallocated
+        """
+        with self._lock:
+            self.resizes += 1
+            self.buffer_bytes += delta
+            if self.buffer_bytes > self.peak_buffer_bytes:
+                self.peak_buffer_bytes = self.buffer_bytes
+    
+    
+    @property
+    def stats(self):
+        return {
+            'allocated': self.allocated,
+            'in_use': self.in_use,
+            'free': len(self._free),
+            'peak_in_use': self.peak_in_use,
+            'allocations': self.allocations,
+            'buffer_bytes': self.buffer_bytes,
+            'peak_buffer_bytes': self.peak_buffer_bytes,
+            'resizes': self.resizes,
+        }
+
+
+class FrameSubscriber:
+    """
+    A single consumer of the frames published by a FrameBroadcaster.
+    
+    Frames are buffered in a bounded queue; when a consumer falls behind, the oldest buffered frame is
+    dropped in favor of the latest one so that publishing never blocks. Buffered frames are retained, and
+    each frame returned by get() must be released by the consumer once it's done with it.
+    """
+    QUEUE_MAX = 2  # Default number of frames buffered per consumer
+    
+    def __init__(self, queue_max=None):
+        if queue_max is None:
+            queue_max = self.__class__.QUEUE_MAX
+        self._frames = collections.deque(maxlen=max(1, int(queue_max)))
+        self._cond = threading.Condition()
+        self.closed = False
+        self.name = None  # Set for viewers (e.g., to the viewer's address)
+        self.frames_delivered = 0
+        self.frames_dropped = 0
+        self.bytes_sent = 0  # Updated by the consumer
+        return
+    
+    
+    def put(self, frame):
+        with self._cond:
+            if self.closed:
+                return
+            if len(self._frames) == self._frames.maxlen:
+                self.frames_dropped += 1
+                self._frames.popleft().release()
+            self._frames.append(frame.retain())
+            self._cond.notify()
+    
+    
+    def get(self, timeout=None):
+        """
+        Blocks until the next frame is published. Returns None if the subscription has ended, or raises
+        queue.Empty if no frame arrived within the timeout.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._frames or self.closed, timeout):
+                raise queue.Empty()
+            if self.closed:
+                return None
+            self.frames_delivered += 1
+            return self._frames.popleft()
+    
+    
+    def close(self):
+        with self._cond:
+            self.closed = True
+            while self._frames:
+                self._frames.popleft().release()
+            self._cond.notify_all()
+
+
+class FrameBroadcaster:
+    """
+    Hands each completed frame to every subscribed consumer, and keeps (a reference to) the most recent one
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latest = None
+        self.bytes_sent = 0  # Bytes sent by consumers that have unsubscribed
+        # Replaced (never mutated) under the lock so that publish() can iterate without locking
+        self._subscribers = ()
+        return
+    
+    
+    def __len__(self):
+        return len(self._subscribers)
+    
+    
+    def subscribe(self, subscriber=None):
+        if subscriber is None:
+            subscriber = FrameSubscriber()
+        with self._lock:
+            self._subscribers = self._subscribers + (subscriber,)
+        return subscriber
+    
+    
+    def unsubscribe(self, subscriber):
+        """
+        Ends a subscription. Must be called exactly once for each subscriber, even after close().
+        """
+        with self._lock:
+            self._subscribers = tuple(s for s in self._subscribers if s is not subscriber)
+            self.bytes_sent += subscriber.bytes_sent
+        subscriber.close()
+    
+    
+    def publish(self, frame):
+        """
+        Hands a frame to every subscriber (each retains its own reference)
+        """
+        frame.retain()
+        with self._lock:
+            previous = self._latest
+            self._latest = frame
+        if previous is not None:
+            previous.release()
+        for subscriber in self._subscribers:
+            subscriber.put(frame)
+    
+    
+    def latest(self):
+        """
+        Returns a reference to the most recently published frame (which the caller must release), or None
+        if no frame has been published yet. The frame is deliberately kept after the stream stops (so
+        snapshots can fall back to it), so it might be stale; close() releases it.
+        """
+        with self._lock:
+            frame = self._latest
+            if frame is not None:
+                frame.retain()
+        return frame
+    
+    
+    @property
+    def subscribers(self):
+        return self._subscribers
+    
+    
+    def close(self):
+        """
+        Ends all current subscriptions and releases the most recent frame (so its buffer, or ring slot, can
+        be reused)
+        """
+        with self._lock:
+            subscribers = self._subscribers
+            self._subscribers = ()
+            latest = self._latest
+            self._latest = None
+        if latest is not None:
+            latest.release()
+        for subscriber in subscribers:
+            subscriber.close()
+
+
+class FrameConsumer:
+    """
+    Base class for services that consume a SpadeClient's frames from a background thread, through a
+    subscription of their own (e.g., spade_record.Recorder), and that subscribe again each time the stream
+    ends until they're stopped. Subclasses implement _run, which is started by start().
+    """
+    RETRY_INTERVAL = 5.0  # Seconds to wait before resubscribing after the stream ends
+    THREAD_NAME = 'SpadeFrameConsumer'
+    
+    def __init__(self, spade_client):
+        self.spade_client = spade_client
+        self._subscribe = spade_client.subscribe
+        self._unsubscribe = spade_client.unsubscribe
+        self._subscriber = None
+        self._stop = threading.Event()
+        self._thread = None
+        # Statistics
+        self.frames_dropped = 0  # Frames replaced by newer ones before the consumer got to them
+        return
+    
+    
+    def start(self, subscribe=None, unsubscribe=None):
+        """
+        Starts consuming frames in the background. subscribe(queue_max) and unsubscribe(subscriber) default
+        to the client's own methods; servers that run the stream themselves (e.g., AsyncMirrorServer) pass
+        theirs.
+        """
+        if subscribe is not None:
+            self._subscribe = subscribe
+        if unsubscribe is not None:
+            self._unsubscribe = unsubscribe
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=self.__class__.THREAD_NAME, daemon=True)
+        self._thread.start()
+    
+    
+    def stop(self):
+        self._stop.set()
+        subscriber = self._subscriber
+        if subscriber is not None:
+            subscriber.close()
+        self.wait()
+    
+    
+    def wait(self):
+        """
+        Waits until the background thread exits
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+    
+    
+    def _frames(self, queue_max):
+        """
+        Yields each frame of the stream until the consumer is stopped, subscribing again (after
+        RETRY_INTERVAL) whenever the stream ends, and yields None each time it ends. Each frame is released
+        once the consumer asks for the next one.
+        """
+        while not self._stop.is_set():
+            try:
+                self._subscriber = self._subscribe(queue_max)
+            except Exception as e:
+                print(f'[ERROR] {type(self).__name__} failed to start the stream: {e}')
+                self._stop.wait(self.__class__.RETRY_INTERVAL)
+                continue
+            subscriber = self._subscriber
+            try:
+                while True:
+                    frame = subscriber.get()
+                    if frame is None:
+                        # Stream ended
+                        break
+                    with frame:
+                        yield frame
+            finally:
+                self._subscriber = None
+                self.frames_dropped += subscriber.frames_dropped
+                self._unsubscribe(subscriber)
+            yield None
+            self._stop.wait(self.__class__.RETRY_INTERVAL)
+
+
 class JpgFrame:
-    BUF_SZ = 131072
+    """
+    Reassembly buffer for a single JPEG frame.
+    
+    Frames that belong to a FramePool are reference-counted: every consumer that holds on to a completed
+    frame calls retain() and later release(), and the buffer is only reused once the last reference has
+    been released.
     
-    def __init__(self, index=None, width=None, height=None, coords=None):
-        self._buf = bytearray(self.__class__.BUF_SZ)
+    The buffer grows on demand (keeping any chunks already acquired) when a chunk lands past its end, and
+    is reallocated by init() if it's far too small or too large for the new frame's size hint.
+    """
+    BUF_SZ = 131072     # Default initial buffer size
+    BUF_ALIGN = 4096    # Buffer sizes are rounded up to a multiple of this
+    SHRINK_FACTOR = 4   # A buffer is reallocated by init() if it's this many times larger than the size hint
+    MAX_CHUNKS = 4096   # Highest chunk index accepted (anything higher is treated as malformed)
+    
+    def __init__(self, index=None, width=None, height=None, coords=None, pool=None, buf_sz=BUF_SZ):
+        self.pool = pool
+        self._refs = 0
+        self._buf = bytearray()
+        self._data = memoryview(self._buf)
+        self._end = 0
+        if buf_sz > 0:
+            # (Empty frames, like the pool's, aren't counted as resized until they're given a buffer)
+            self._resize(buf_sz)
         if None not in (index, width, height):
             self.init(index, width, height, coords)
         return
     
     
-    def init(self, index, width, height, coords=None):
+    def retain(self):
+        if self.pool is not None:
+            self.pool.retain(self)
+        return self
+    
+    
+    def release(self):
+        if self.pool is not None:
+            self.pool.release(self)
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+    
+    
+    def init(self, index, width, height, coords=None, size_hint=None):
         self.index = int(index)
         self.width = int(width)
         self.height = int(height)
@@ -166,32 +1066,110 @@ class JpgFrame:
         self.complete = False  # True when all chunks have been acquired
         self.chunk_sz = None   # All but the final chunk have the same size
         self.acquired_sz = 0   # Total number of bytes acquired
-        self._data = memoryview(self._buf)
+        self.received = 0      # Bitmap of acquired chunks (bit n is set once chunk n has been acquired)
+        self.n_received = 0    # Number of distinct chunks acquired
+        self.duplicates = 0    # Number of chunks received more than once
+        self._final_chunk = None  # Final chunk received before the chunk size was known
+        self.t_first = time.monotonic()  # When the frame's first chunk arrived
+        self.t_complete = None    # time.monotonic() when the frame was completed
+        self.timestamp = None     # time.time() when the frame was completed
+        self._end = 0             # End of the furthest chunk placed in the buffer so far
+        self._view = None
+        self.cache = {}           # Encodings of the completed frame that are shared by all viewers
+        if size_hint is not None:
+            buf_sz = len(self._buf)
+            if buf_sz < size_hint or buf_sz > size_hint * self.__class__.SHRINK_FACTOR:
+                self._resize(size_hint)
     
     
     def add_chunk(self, idx, data, final=0):
-        assert not self.complete, 'Attempt to add a chunk to a completed frame'
+        """
+        Copies a chunk into the frame buffer. Duplicate chunks are ignored; the frame is complete once
+        every chunk from 1 to the final chunk index has been acquired. Returns False if the chunk was a
+        duplicate. Raises ValueError (leaving the frame unchanged) if the chunk doesn't fit the frame.
+        """
+        if self.complete:
+            raise ValueError('Attempt to add a chunk to a completed frame')
+        # Message indices start at 1
+        if not 1 <= idx <= self.__class__.MAX_CHUNKS or int(final) > self.__class__.MAX_CHUNKS:
+            raise ValueError(f'Invalid chunk index: {idx} (final: {final})')
+        bit = 1 << idx
+        if self.received & bit:
+            self.duplicates += 1
+            return False
         if not final:
             if self.chunk_sz is not None:
-                assert self.chunk_sz == len(data), f'Chunk size mismatch:  {self.chunk_sz=}  {len(data)=}'
-            self.chunk_sz = len(data)
-        elif self.chunk_sz is None:
-            # Received last chunk before any other chunk... just allow the bad data?
-            self.chunk_sz = len(data)
-        start = self.chunk_sz * (idx - 1)  # Message indices start at 1
-        self._data[start:start+len(data)] = data
-        self.acquired_sz += len(data)
-        if final:
+                if self.chunk_sz != len(data):
+                    raise ValueError(f'Chunk size mismatch:  {self.chunk_sz=}  {len(data)=}')
+            else:
+                self.chunk_sz = len(data)
+                if self._final_chunk is not None:
+                    # Now that the chunk size is known, the final chunk can be placed
+                    final_idx, final_data = self._final_chunk
+                    self._final_chunk = None
+                    self._place(final_idx, final_data)
+        else:
             self.total = int(final)
-        if self.total and self.acquired_sz > self.chunk_sz * (self.total-1):
+            if self.chunk_sz is None and idx > 1:
+                # Received the last chunk before any other chunk; its offset isn't known yet
+                self._final_chunk = (idx, bytes(data))
+        self.received |= bit
+        self.n_received += 1
+        if self._final_chunk is None or self._final_chunk[0] != idx:
+            self._place(idx, data)
+        if self.total is not None and self._final_chunk is None and self.received == (1 << (self.total + 1)) - 2:
             self.complete = True
-        return
+            self._view = self._data[:self.acquired_sz].toreadonly()
+        return True
+    
+    
+    def _place(self, idx, data):
+        start = 0 if idx == 1 else self.chunk_sz * (idx - 1)
+        end = start + len(data)
+        if end > len(self._buf):
+            if self.total is not None and self.chunk_sz is not None:
+                # The frame can't be larger than this
+                self._resize(max(end, self.chunk_sz * self.total))
+            else:
+                self._resize(max(end, len(self._buf) + len(self._buf) // 2))
+        self._data[start:end] = data
+        self._end = max(self._end, end)
+        self.acquired_sz += len(data)
+    
+    
+    def _resize(self, buf_sz):
+        """
+        Replaces the buffer with one of (at least) buf_sz bytes, copying any data placed so far
+        """
+        align = self.__class__.BUF_ALIGN
+        buf_sz = -(-int(buf_sz) // align) * align
+        buf = bytearray(buf_sz)
+        if self._end > 0:
+            buf[:self._end] = self._data[:self._end]
+        delta = buf_sz - len(self._buf)
+        self._buf = buf
+        self._data = memoryview(buf)
+        if self.pool is not None:
+            self.pool._track(delta)
+    
+    
+    @property
+    def missing(self):
+        """
+        Number of chunks not (yet) acquired, up to the final chunk (or the highest chunk index acquired so
+        far if the final chunk hasn't arrived)
+        """
+        expected = self.total if self.total is not None else self.received.bit_length() - 1
+        return max(0, expected - self.n_received)
     
     
     @property
     def data(self):
+        """
+        Read-only view of the completed JPEG (valid until the frame is released)
+        """
         assert self.complete, 'Attempt to reassemble incomplete frame'
-        return self._data[:self.acquired_sz]
+        return self._view
     
     
     @property
@@ -200,19 +1178,227 @@ class JpgFrame:
         if None not in coords:
             return coords
         return None
+
+
+class JitterBuffer:
+    """
+    Reorders completed frames by index and releases them to an output callable at a steady cadence. Held
+    frames are retained until they have been handed to the output.
     
+    Each frame is held for up to `latency` seconds while earlier frames are still missing; once that budget
+    runs out, the missing frames are skipped. Output is paced to `fps` frames per second (estimated from
+    frame arrival times if None). With a latency of 0, frames are passed straight through in arrival
+    order (low-latency mode).
+    """
+    MAX_FRAMES = 4    # Frames held at once; the oldest is released early if more arrive
+    RESET_GAP = 1000  # An index this far behind the expected one means the server restarted its frame count
     
-    def render(self, title=None):
-        import matplotlib.pyplot
-        img = matplotlib.pyplot.imread(BytesIO(self.data), format='jpeg')
-        if title is None:
-            title = f'Frame {self.index}'
-        matplotlib.pyplot.title(title)
-        matplotlib.pyplot.imshow(img)
-        matplotlib.pyplot.show(block=False)
-        matplotlib.pyplot.pause(0.001)
+    def __init__(self, output, latency=0.0, fps=None, max_frames=MAX_FRAMES):
+        self.output = output
+        self.latency = max(0.0, float(latency))
+        self.fps = None if not fps else float(fps)
+        self.max_frames = max(1, int(max_frames))
+        self._heap = []  # (index, sequence, frame)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self._next_index = None  # Index of the next frame to release
+        self._last_arrival = None
+        self._last_release = 0.0
+        self._interval = None    # Estimated (or configured) seconds between frames
+        # Statistics
+        self.frames_reordered = 0  # Frames that arrived before an earlier frame
+        self.frames_skipped = 0    # Missing frames given up on
+        self.frames_late = 0       # Frames dropped because a later frame was already released
+        return
+    
+    
+    def push(self, frame):
+        if self.latency <= 0:
+            self.output(frame)
+            return
+        with self._cond:
+            now = time.monotonic()
+            if self.fps:
+                self._interval = 1.0 / self.fps
+            elif self._last_arrival is not None:
+                # Exponentially weighted moving average of the frame interval
+                interval = now - self._last_arrival
+                self._interval = interval if self._interval is None else (0.9 * self._interval) + (0.1 * interval)
+            self._last_arrival = now
+            
+            if self._next_index is not None and frame.index < self._next_index:
+                if self._next_index - frame.index < self.__class__.RESET_GAP:
+                    self.frames_late += 1
+                    return
+                # Frame numbering restarted; flush what's held and start over
+                self._next_index = None
+            if self._heap and frame.index < self._heap[0][0]:
+                self.frames_reordered += 1
+            heapq.heappush(self._heap, (frame.index, next(self._seq), frame.retain()))
+            self._closed = False
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='SpadeJitterBuffer', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+    
+    
+    def reset(self):
+        """
+        Drops any held frames and stops the release thread; the buffer starts over with the next push
+        """
+        with self._cond:
+            self._closed = True
+            while self._heap:
+                heapq.heappop(self._heap)[2].release()
+            self._next_index = None
+            self._last_arrival = None
+            self._cond.notify()
+    
+    
+    def _next_release(self, now):
+        """
+        Returns the number of seconds until the frame at the head of the heap can be released (<= 0 if it
+        can be released now)
+        """
+        index, seq, frame = self._heap[0]
+        deadline = frame.t_complete + self.latency
+        if len(self._heap) > self.max_frames or now >= deadline:
+            # Out of buffering budget; release regardless of gaps or pacing
+            return 0.0
+        if self._next_index is None or index != self._next_index:
+            # Wait for the missing frame(s) (or, for the first frame, for any earlier frames still in flight)
+            return deadline - now
+        if self._interval is None:
+            return 0.0
+        return min(self._last_release + self._interval, deadline) - now
+    
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        self._thread = None
+                        return
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    now = time.monotonic()
+                    delay = self._next_release(now)
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                index, seq, frame = heapq.heappop(self._heap)
+                if self._next_index is not None and index > self._next_index:
+                    self.frames_skipped += index - self._next_index
+                self._next_index = index + 1
+                self._last_release = now
+            with frame:
+                self.output(frame)
 
 
+class TelemetryPoller:
+    """
+    Periodically queries the server's battery level, model and PWM value and caches the results, so that
+    status requests are served without any command traffic to the server
+    """
+    INTERVAL = 10.0  # Seconds between refreshes
+    RETRY_MIN = 0.5  # Seconds before the first retry while some values are still unknown (doubles up to INTERVAL)
+    MAX_AGE = 3      # Refresh intervals after which a cached value is too old to serve (e.g., the server went away)
+    FIELDS = ('battery', 'version', 'pwm')
+    
+    def __init__(self, spade_client, interval=INTERVAL):
+        self.spade_client = spade_client
+        self.interval = float(interval)
+        self._cache = {}  # Field name -> (value, time.time() of the query)
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = None
+        self._failing = False
+        return
+    
+    
+    def get(self, name):
+        """
+        Returns the cached (value, timestamp) of a field, or (None, None) if it hasn't been queried
+        successfully in the last MAX_AGE refresh intervals
+        """
+        value, timestamp = self._cache.get(name, (None, None))
+        if timestamp is None or time.time() - timestamp > self.interval * self.__class__.MAX_AGE:
+            return None, None
+        return value, timestamp
+    
+    
+    @property
+    def ready(self):
+        return all(name in self._cache for name in self.__class__.FIELDS)
+    
+    
+    def _query(self, name):
+        value = getattr(self.spade_client, name)
+        self._cache[name] = (value, time.time())
+        return value
+    
+    
+    def refresh(self):
+        """
+        Queries all fields concurrently (commands are pipelined by the client's command channel). Returns
+        True if every query succeeded.
+        """
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(len(self.__class__.FIELDS), thread_name_prefix='SpadeTelemetryQuery')
+        was_ready = self.ready
+        try:
+            self.spade_client.connect()
+        except Exception as e:
+            if not self._failing:
+                print(f'[WARNING] Failed to connect to {self.spade_client.server}: {e}')
+            self._failing = True
+            return False
+        futures = {name: self._executor.submit(self._query, name) for name in self.__class__.FIELDS}
+        errors = []
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(f'{name}: {e}')
+        if errors:
+            if not self._failing:
+                print(f'[WARNING] Failed to query {self.spade_client.server} ({"; ".join(errors)})')
+            self._failing = True
+            return False
+        self._failing = False
+        if not was_ready:
+            print(f'Server: {self.get("version")[0]}  |  Battery: {self.get("battery")[0]}%  |  PWM: {self.get("pwm")[0]}')
+        return True
+    
+    
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f'SpadeTelemetry-{self.spade_client.server}', daemon=True)
+        self._thread.start()
+    
+    
+    def stop(self):
+        self._stop.set()
+    
+    
+    def _run(self):
+        retry_delay = self.__class__.RETRY_MIN
+        while not self._stop.is_set():
+            if self.refresh():
+                retry_delay = self.__class__.RETRY_MIN
+                delay = self.interval
+            else:
+                # Retry sooner (with backoff) while the server is coming up
+                delay = min(retry_delay, self.interval)
+                retry_delay *= 2
+            self._stop.wait(delay)
+
 
 class SpadeClient:
     DEFAULT_SERVER = '192.168.10.123'
@@ -227,162 +1413,628 @@ class SpadeClient:
     READ_STREAM_REQUEST = b'\x99\x99\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
     UDP_READ_SZ = 8192
     FRAME_QUEUE_MAX = 8
+    STREAM_POLL_INTERVAL = 0.5  # Seconds between checks for a stop request while the ingest thread waits for data
+    STREAM_TIMEOUT = 5.0  # Seconds without stream data before the server is considered unresponsive
+    CONNECT_TIMEOUT = 0.5      # Seconds to wait for each handshake response
+    CONNECT_RETRIES = 5        # Additional handshake attempts before giving up
+    CONNECT_BACKOFF_MAX = 4.0  # Maximum seconds between handshake attempts (the delay doubles after each attempt)
+    RECV_BATCH_MAX = 64  # Maximum number of datagrams drained from the stream socket per wakeup
+    JITTER_LATENCY = 0.0  # Seconds completed frames may be held for reordering (0 for lowest latency)
+    # Statistics that count events in the current stream (reset each time the stream starts; see total())
+    STREAM_COUNTERS = ('recv_wakeups', 'recv_datagrams', 'kernel_drops', 'chunks_received', 'chunks_duplicate',
+                       'chunks_lost', 'chunks_invalid', 'frames_completed', 'frames_discarded')
+    SNAPSHOT_LINGER = 10.0   # Seconds the stream keeps running after a snapshot request (so pollers don't restart it)
+    SNAPSHOT_TIMEOUT = 5.0   # Seconds a snapshot request waits for the first frame of a newly started stream
+    SNAPSHOT_WAIT_MAX = 30.0 # Maximum seconds a snapshot request can wait for a new frame (long poll)
+    # Reports the number of datagrams dropped by the kernel with each received datagram (Linux only)
+    SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40 if sys.platform.startswith('linux') else None)
     
-    def __init__(self, server=DEFAULT_SERVER, cmd_send_index=1234):
+    def __init__(self, server=DEFAULT_SERVER, cmd_send_index=1234, stream_timeout=STREAM_TIMEOUT, debug_parse=False,
+                 rcvbuf_sz=None, recv_batch=RECV_BATCH_MAX, jitter_latency=JITTER_LATENCY, fps=None,
+                 telemetry_interval=TelemetryPoller.INTERVAL, command_timeout=CommandChannel.TIMEOUT,
+                 command_retries=CommandChannel.RETRIES, interface=None):
         self.server = str(server)  # Server host name or IP address
+        self.interface = interface  # Network interface the server is reached through (None for any; Linux only)
+        self.stream_timeout = float(stream_timeout)
+        self.debug_parse = bool(debug_parse)  # Parse stream chunks with the (slower) ctypes classes and log each one
+        self.rcvbuf_sz = None if rcvbuf_sz is None else int(rcvbuf_sz)  # SO_RCVBUF for the stream socket (None for the OS default)
+        self.last_datagram_time = None  # time.monotonic() of the most recent stream datagram
         self.cmd_send_index = int(cmd_send_index) & 0xffffffff  # Incremented with each message sent to the server (max 4 bytes)
+        self._cmd_index_lock = threading.Lock()
+        self.command_timeout = float(command_timeout)  # Seconds to wait for each command response
+        self.command_retries = int(command_retries)    # Times an unanswered command is re-sent
         self._connected = False
+        self._connect_lock = threading.RLock()
+        self.command_channel = None
         self.command_sock = None
         self.stream_sock = None
-        self.stream_buf = memoryview(bytearray(self.__class__.UDP_READ_SZ))
+        self._stream_selector = None
+        # Preallocated receive buffers; datagram i of the latest batch is recv_ring[i][:recv_lens[i]]
+        self.recv_ring = [memoryview(bytearray(self.__class__.UDP_READ_SZ)) for i in range(max(1, int(recv_batch)))]
+        self.recv_lens = [0] * len(self.recv_ring)
+        self._rxq_ovfl = False
+        # Ingest statistics
+        self.recv_wakeups = 0      # Wakeups that received at least one datagram
+        self.recv_datagrams = 0    # Total datagrams received
+        self.recv_batch_peak = 0   # Most datagrams received in a single wakeup
+        self.kernel_drops = None   # Datagrams dropped by the kernel since the stream started (None if unsupported)
+        # Reassembly statistics
+        self.chunks_received = 0    # Stream chunks parsed
+        self.chunks_duplicate = 0   # Chunks ignored because they had already been received
+        self.chunks_lost = 0        # Chunks missing from discarded frames
+        self.chunks_invalid = 0     # Malformed chunks dropped (e.g., inconsistent headers or chunk sizes)
+        self.frames_completed = 0
+        self.frames_discarded = 0   # Frames abandoned before all of their chunks arrived
+        self.stream_totals = dict.fromkeys(self.__class__.STREAM_COUNTERS, 0)  # Counts from earlier streams
+        self._recent_frames = collections.deque(maxlen=self.__class__.FRAME_QUEUE_MAX)  # Recently completed frame indices
         self.streaming = False
-        self.frame_queue = queue.Queue()
-        self.frame_dict = {}
-        self.frame_reserve = []
-        self.frame_reserve_idx = 0
-        for i in range(self.__class__.FRAME_QUEUE_MAX):
-            self.frame_reserve.append(JpgFrame())
+        self.broadcaster = FrameBroadcaster()
+        # Completed frames pass through the jitter buffer on their way to the broadcaster
+        self.jitter_buffer = JitterBuffer(self.broadcaster.publish, jitter_latency, fps,
+                                          max_frames=self.__class__.FRAME_QUEUE_MAX // 2)
+        self._stream_lock = threading.Lock()
+        self._ingest_thread = None
+        self._hold_lock = threading.Lock()
+        self._hold_until = 0.0
+        self._hold_thread = None
+        self.telemetry = TelemetryPoller(self, telemetry_interval)
+        self.accel = spade_accel.AccelRing()  # Accelerometer samples from every stream chunk
+        self.recorder = None  # Optional spade_record.Recorder, started along with the mirror server
+        self.transcoder = None  # Optional spade_transcode.Transcoder that serves variant streams
+        self.capture = None   # Optional spade_emu.Capture that logs every datagram received from the server
+        self.ingest_process = None  # Optional spade_shm.IngestProcess that runs the ingest pipeline in a child process
+        self.preview = None   # Optional spade_preview.LocalPreview, started along with the mirror server
+        self._command_timeouts = 0  # Timeouts counted by command channels that have since been closed
+        self.metrics = Metrics()
+        self.metrics.add_collector(self._collect_metrics)
+        self._assembly_latency = self.metrics.histogram('spade_frame_assembly_seconds', 'Time from the first chunk of a frame to its completion')
+        self._delivery_latency = self.metrics.histogram('spade_frame_delivery_seconds', 'Time from the completion of a frame until its last reference was released (i.e., the last viewer wrote it)')
+        self.frame_pool = FramePool(prealloc=self.__class__.FRAME_QUEUE_MAX)
+        self.frame_pool.release_hook = self._frame_released
+        self.frame_queue = queue.Queue()  # Incomplete frames, oldest first
+        self.frame_dict = {}              # Incomplete frames by index
         return
     
     
-    def connect(self):
-        if self._connected and self.command_sock is not None:
-            return
-        print(f'Connecting to {self.server}')
-        if not ping(self.server):
-            raise IOError(f'[ERROR] No ICMP response from {self.server}')
-        self.command_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        msg = b'SETCMD\xff\xff\x00\x00\x90\x00\x04\x00\x00\x00\x00\x00'
-        msg = spade_msg.SpadeUdpMsg_SETCMD.from_bytes(msg)
-        msg.data = b'\x00' * msg.length
-        response = self.send_command(msg, True)
-        self._connected = True
+    def connect(self, timeout=None, retries=None):
+        """
+        Performs the GetRemoteKey handshake with the server, retrying with exponential backoff.
+        
+        timeout is the number of seconds to wait for each handshake response and retries is the number of
+        additional attempts (defaults: CONNECT_TIMEOUT and CONNECT_RETRIES).
+        """
+        if timeout is None:
+            timeout = self.__class__.CONNECT_TIMEOUT
+        if retries is None:
+            retries = self.__class__.CONNECT_RETRIES
+        with self._connect_lock:
+            if self._connected and self.command_channel is not None:
+                return
+            print(f'Connecting to {self.server}')
+            if self.command_channel is None:
+                self.command_channel = CommandChannel(self.server, self.__class__.COMMAND_PORT, self.command_timeout, self.command_retries,
+                                                      interface=self.interface)
+                self.command_channel.capture = self.capture
+                self.command_sock = self.command_channel.sock
+            msg = b'SETCMD\xff\xff\x00\x00\x90\x00\x04\x00\x00\x00\x00\x00'
+            msg = spade_msg.SpadeUdpMsg_SETCMD.from_bytes(msg)
+            msg.data = b'\x00' * msg.length
+            delay = float(timeout)
+            for attempt in range(int(retries) + 1):
+                try:
+                    response = self.send_command(msg, True, timeout=timeout, retries=0)
+                    break
+                except TimeoutError:
+                    if attempt >= int(retries):
+                        raise IOError(f'[ERROR] No handshake response from {self.server} after {int(retries) + 1} attempt(s)')
+                time.sleep(delay)
+                delay = min(delay * 2, self.__class__.CONNECT_BACKOFF_MAX)
+            self._connected = True
     
     
     def disconnect(self):
-        self.streaming = False
-        if self.command_sock is not None:
-            if not self.command_sock._closed:
-                self.command_sock.close()
-            self.command_sock = None
-        if self.stream_sock is not None:
-            if not self.stream_sock._closed:
-                # @TODO: Send EndStream message
-                self.stream_sock.close()
-            self.stream_sock = None
+        if self.recorder is not None:
+            self.recorder.stop()
+        if self.transcoder is not None:
+            self.transcoder.stop()
+        if self.preview is not None:
+            self.preview.stop()
+        if self.capture is not None:
+            self.capture.close()
+        self.stop_stream(wait=True)
+        if self.ingest_process is not None:
+            self.ingest_process.close()
+        self.telemetry.stop()
+        self.jitter_buffer.reset()
+        self.broadcaster.close()
+        if self.command_channel is not None:
+            self.command_channel.close()
+            self._command_timeouts += self.command_channel.timeouts
+            self.command_channel = None
+        self.command_sock = None
+        self._close_stream_socket()
         self._connected = False
     
     
-    def stream_to_matplotlib(self):
-        # Don't use this function
+    def subscribe(self, queue_max=None):
+        """
+        Returns a new FrameSubscriber, starting the shared ingest thread if it isn't already running.
+        
+        queue_max is the number of frames buffered for the subscriber before older frames are dropped
+        (defaults to FrameSubscriber.QUEUE_MAX).
+        """
+        with self._stream_lock:
+            self.start_stream()
+            return self.broadcaster.subscribe(FrameSubscriber(queue_max))
+    
+    
+    def unsubscribe(self, subscriber):
+        """
+        Ends the subscription and stops the ingest thread once no subscribers remain
+        """
+        with self._stream_lock:
+            self.broadcaster.unsubscribe(subscriber)
+            if len(self.broadcaster) == 0:
+                self.stop_stream()
+    
+    
+    def start_stream(self):
+        """
+        Requests the video stream from the server and starts the ingest thread, which reassembles
+        frames and publishes them to self.broadcaster
+        """
+        if self.ingest_process is not None:
+            # Received and reassembled by the ingest process instead
+            self.ingest_process.start_stream()
+            return
+        if self.streaming and self._ingest_thread is not None and self._ingest_thread.is_alive():
+            return
+        # A previous ingest thread might still be shutting down
+        self.stop_stream(wait=True)
         self.connect()
-        self.streaming = True
         self.stream_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._rxq_ovfl = self.configure_stream_socket(self.stream_sock)
+        self.stream_sock.setblocking(False)
+        self._stream_selector = selectors.DefaultSelector()
+        self._stream_selector.register(self.stream_sock, selectors.EVENT_READ)
+        for name in self.__class__.STREAM_COUNTERS:
+            self.stream_totals[name] += getattr(self, name) or 0
+        self.recv_wakeups = 0
+        self.recv_datagrams = 0
+        self.recv_batch_peak = 0
+        self.kernel_drops = 0 if self._rxq_ovfl else None
+        self.jitter_buffer.reset()
+        self.chunks_received = 0
+        self.chunks_duplicate = 0
+        self.chunks_lost = 0
+        self.chunks_invalid = 0
+        self.frames_completed = 0
+        self.frames_discarded = 0
         server_address = (self.server, self.__class__.STREAM_PORT)
         data = self.__class__.READ_STREAM_REQUEST
         sent = self.stream_sock.sendto(data, server_address)
         assert sent == len(data), f'UDP message was {len(data)} bytes but only {sent} were sent'
-        while self.streaming:
-            frame = self.get_frame()
-            if frame is None:
-                continue
-            
-            frame.render()
-            print(f'Reconstructed frame: {frame.index}')
-            #time.sleep(0.016)  # ~60FPS
-        
+        self.streaming = True
+        self.last_datagram_time = time.monotonic()
+        self._ingest_thread = threading.Thread(target=self._ingest, name=f'SpadeIngest-{self.server}', daemon=True)
+        self._ingest_thread.start()
+    
+    
+    def stop_stream(self, wait=False):
+        """
+        Signals the ingest thread to exit (it closes the stream socket itself)
+        """
+        if self.ingest_process is not None:
+            self.ingest_process.stop_stream()
+            return
         self.streaming = False
-        if self.stream_sock is not None and not self.stream_sock._closed:
-            # @TODO: Send EndStream message
-            self.stream_sock.close()
-        self.stream_sock = None
+        thread = self._ingest_thread
+        if wait and thread is not None and thread is not threading.current_thread():
+            thread.join()
+    
+    
+    def configure_stream_socket(self, sock):
+        """
+        Applies the receive buffer size and enables kernel drop reporting (where supported) on a stream
+        socket. Returns True if drop reporting was enabled.
+        """
+        if self.interface is not None:
+            bind_to_interface(sock, self.interface)
+        if self.rcvbuf_sz is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf_sz)
+            actual = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            if actual < self.rcvbuf_sz:
+                print(f'[WARNING] Requested {self.rcvbuf_sz}-byte stream receive buffer, but the OS only allowed {actual} bytes')
+        if self.__class__.SO_RXQ_OVFL is None:
+            return False
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, self.__class__.SO_RXQ_OVFL, 1)
+        except OSError:
+            return False
+        return True
+    
+    
+    def recv_batch(self, timeout=None):
+        """
+        Waits up to timeout seconds (default: STREAM_POLL_INTERVAL) for stream data, then drains up to
+        len(self.recv_ring) datagrams without blocking. Returns the number of datagrams received; datagram i
+        is self.recv_ring[i][:self.recv_lens[i]].
+        """
+        if timeout is None:
+            timeout = min(self.__class__.STREAM_POLL_INTERVAL, self.stream_timeout)
+        sock = self.stream_sock
+        if sock is None or sock._closed or not self._stream_selector.select(timeout):
+            return 0
+        ring = self.recv_ring
+        lens = self.recv_lens
+        n = 0
+        while n < len(ring):
+            try:
+                if self._rxq_ovfl:
+                    nbytes, ancdata, flags, addr = sock.recvmsg_into((ring[n],), socket.CMSG_SPACE(4))
+                    for level, cmsg_type, cmsg_data in ancdata:
+                        if level == socket.SOL_SOCKET and cmsg_type == self.__class__.SO_RXQ_OVFL:
+                            self.kernel_drops = int.from_bytes(cmsg_data[:4], sys.byteorder)
+                else:
+                    nbytes = sock.recv_into(ring[n])
+            except BlockingIOError:
+                break
+            lens[n] = nbytes
+            n += 1
+        if n > 0:
+            self.last_datagram_time = time.monotonic()
+            self.recv_wakeups += 1
+            self.recv_datagrams += n
+            if n > self.recv_batch_peak:
+                self.recv_batch_peak = n
+        return n
+    
+    
+    def _ingest(self):
+        try:
+            while self.streaming:
+                n = self.recv_batch()
+                if n == 0:
+                    if time.monotonic() - self.last_datagram_time > self.stream_timeout:
+                        raise TimeoutError(f'No stream data received from {self.server} in {self.stream_timeout} seconds')
+                    continue
+                for i in range(n):
+                    self.process_datagram(self.recv_ring[i][:self.recv_lens[i]])
+        except Exception as e:
+            print(f'[ERROR] Stream ingest failed: {e}')
+            self.streaming = False
+            # Wake any consumers that are waiting for frames that will never arrive
+            self.broadcaster.close()
+        finally:
+            print(f'Stream stopped ({self.recv_datagrams} datagrams in {self.recv_wakeups} wakeups, {self.recv_batch_peak} at most; {self.kernel_drops} dropped by the kernel)')
+            print(f'Stream reassembly: {self.loss_stats}')
+            print(f'Frame pool: {self.frame_pool.stats}')
+            self._close_stream_socket()
+    
+    
+    def _close_stream_socket(self):
+        if self._stream_selector is not None:
+            self._stream_selector.close()
+            self._stream_selector = None
+        if self.stream_sock is not None:
+            if not self.stream_sock._closed:
+                # @TODO: Send EndStream message
+                self.stream_sock.close()
+            self.stream_sock = None
+    
+    
+    def hold_stream(self, seconds):
+        """
+        Keeps the stream running for at least another `seconds`, even if no subscribers remain
+        """
+        with self._hold_lock:
+            self._hold_until = max(self._hold_until, time.monotonic() + seconds)
+            if self._hold_thread is not None:
+                return
+            self._hold_thread = threading.Thread(target=self._hold_stream, name=f'SpadeHold-{self.server}', daemon=True)
+            self._hold_thread.start()
+    
+    
+    def _hold_stream(self):
+        try:
+            subscriber = self.subscribe(queue_max=1)
+        except IOError as e:
+            print(f'[ERROR] Failed to start stream: {e}')
+            with self._hold_lock:
+                self._hold_thread = None
+            return
+        try:
+            while True:
+                with self._hold_lock:
+                    remaining = self._hold_until - time.monotonic()
+                    if remaining <= 0 or subscriber.closed:
+                        self._hold_thread = None
+                        break
+                try:
+                    frame = subscriber.get(remaining)
+                except queue.Empty:
+                    continue
+                if frame is not None:
+                    frame.release()
+        finally:
+            self.unsubscribe(subscriber)
+    
+    
+    def snapshot(self, etag=None, wait=0.0):
+        """
+        Returns a reference to the most recent frame (which the caller must release), or None if no frame
+        arrived in time. Starts the stream if necessary and keeps it running for SNAPSHOT_LINGER seconds.
+        
+        If wait is set and the most recent frame's ETag matches etag, waits up to `wait` seconds for a newer
+        frame (returning the current one if none arrives).
+        """
+        was_streaming = self.streaming
+        self.hold_stream(self.__class__.SNAPSHOT_LINGER)
+        frame = self.broadcaster.latest()
+        if was_streaming and frame is not None and (wait <= 0 or HttpHandler.ETAG(frame) != etag):
+            return frame
+        
+        if frame is None or not was_streaming:
+            # The latest frame (if any) is left over from an earlier stream
+            wait = max(wait, self.__class__.SNAPSHOT_TIMEOUT)
+        subscriber = self.subscribe(queue_max=1)
+        try:
+            newer = subscriber.get(wait)
+        except queue.Empty:
+            newer = None
+        finally:
+            self.unsubscribe(subscriber)
+        if newer is None:
+            return frame
+        if frame is not None:
+            frame.release()
+        return newer
+    
+    
+    def stream_to_matplotlib(self, fps=None):
+        """
+        Shows the stream in a local MatPlotLib window (see spade_preview) until the window is closed
+        """
+        import spade_preview
+        preview = spade_preview.LocalPreview(self, fps=fps or spade_preview.LocalPreview.FPS)
+        preview.start()
+        preview.wait()
         return
 
 
     def get_frame(self):
+        """
+        Reads the next batch of stream datagrams and returns the most recent frame they completed, if any.
+        Returns None if no frame was completed or no datagram arrived within STREAM_POLL_INTERVAL. The
+        caller owns a reference to the returned frame and should release() it once it's done with it.
+        """
         if not self.streaming:
             return None
         
         frame = None
+        for i in range(self.recv_batch()):
+            completed = self.process_datagram(self.recv_ring[i][:self.recv_lens[i]], keep_last=True)
+            if completed is not None:
+                if frame is not None:
+                    frame.release()
+                frame = completed
+        return frame
+    
+    
+    def process_datagram(self, buf, keep_last=False):
+        """
+        Parses the stream chunks in a single datagram received from the server's stream port. Every frame
+        completed by them is passed to emit(). If keep_last is True, a reference to the most recent one is
+        also returned (and must be released by the caller).
+        """
+        if self.capture is not None:
+            self.capture.record_stream(buf)
+        frame = None
+        offs = 0
+        chunk_cls = spade_msg.SpadeUdpMsg_0x9999_StreamChunk
+        hdr_sz = chunk_cls.STRUCT.size
+        accel = self.accel
+        now = time.time()
         
-        server_address = (self.server, self.__class__.STREAM_PORT)
-        
-        while self.stream_sock is not None and not self.stream_sock._closed:
-            nread = self.stream_sock.recv_into(self.stream_buf)
-            buf = self.stream_buf[:nread]
-            offs = 0
-        
-            # Parse response for multiple messages
-            while True:
-                read_sz = spade_msg.SpadeUdpMsg_0x9999_StreamChunk.sizeof()
-                data = buf[offs:offs+read_sz]
-                offs += read_sz
-                #if len(data) == 0:
-                #    continue
-                
-                if len(data) < read_sz:
-                    if len(data) > 0:
-                        print(f'len(data) < spade_msg.SpadeUdpMsg_0x9999_StreamChunk.sizeof()')
-                        print(data)
-                    return frame
-                
-                msg = spade_msg.SpadeUdpMsg_0x9999_StreamChunk.from_bytes(data)
-                read_sz = msg.length
-                data = buf[offs:offs+read_sz]
-                offs += read_sz
-                if len(data) < read_sz:
-                    print(f'len(data) < read_sz')
-                    print(data)
-                    return frame
-                
-                if msg.n_frame1 in self.frame_dict:
-                    parse_frame = self.frame_dict[msg.n_frame1]
-                else:
-                    while len(self.frame_dict) >= len(self.frame_reserve):
-                        # Discard unfinished frames if no free frame slots are available
-                        print('Discarding frame')
-                        self.frame_dict.pop(self.frame_queue.get().index, None)
-                    parse_frame = self.frame_reserve[self.frame_reserve_idx]
-                    self.frame_reserve_idx += 1
-                    if self.frame_reserve_idx >= len(self.frame_reserve):
-                        self.frame_reserve_idx = 0
-                    parse_frame.init(msg.n_frame1, msg.res_width, msg.res_height)
-                    self.frame_dict[msg.n_frame1] = parse_frame
-                    self.frame_queue.put(parse_frame)
-                
-                #print(f'Adding chunk:\n{msg}\n{msg.coordinates=}\n')
-                assert (msg.n_frame1 == msg.n_frame2) and (msg.n_frame1 == msg.n_frame3), f'Unequal n_frame values'
-                assert msg.unk1 == 1, f'{msg.unk1=}'
-                parse_frame.add_chunk(msg.n_chunk, data, msg.last_chunk)
-                
-                # If a frame enters the "complete" state, pop frames from the queue (and delete them from
-                # the dict) until the popped frame is the completed frame
-                if parse_frame.complete:
-                    while True:
-                        tmp_frame = self.frame_queue.get()
+        # Parse response for multiple messages
+        while True:
+            if len(buf) - offs < hdr_sz:
+                if len(buf) > offs:
+                    print(f'len(data) < spade_msg.SpadeUdpMsg_0x9999_StreamChunk.sizeof()')
+                    print(buf[offs:])
+                return frame
+            
+            if self.debug_parse:
+                # Slow path; validates and logs every chunk
+                fields = chunk_cls.from_bytes(buf[offs:offs+hdr_sz]).astuple()
+            else:
+                fields = chunk_cls.unpack_from(buf, offs)
+            (_, _, _, arg1, _, _, unk1, n_frame1, _, n_chunk, last_chunk, read_sz, n_frame2, res_width, res_height, n_frame3) = fields
+            offs += hdr_sz
+            data = buf[offs:offs+read_sz]
+            offs += read_sz
+            if len(data) < read_sz:
+                print(f'len(data) < read_sz')
+                print(data)
+                return frame
+            
+            self.chunks_received += 1
+            if n_frame1 != n_frame2 or n_frame1 != n_frame3 or unk1 != 1:
+                # Malformed (or spoofed) chunk; dropped rather than ending the stream for every viewer
+                self.chunks_invalid += 1
+                if self.debug_parse:
+                    print(f'Dropping malformed chunk: {n_frame1=}  {n_frame2=}  {n_frame3=}  {unk1=}')
+                continue
+            accel.append(now, arg1)
+            if n_frame1 in self.frame_dict:
+                parse_frame = self.frame_dict[n_frame1]
+            elif n_frame1 in self._recent_frames:
+                # Late duplicate of a chunk from a frame that was already completed
+                self.chunks_duplicate += 1
+                continue
+            else:
+                while len(self.frame_dict) >= self.__class__.FRAME_QUEUE_MAX:
+                    # Discard the oldest unfinished frame if too many are in progress
+                    self._discard_frame(self.frame_queue.get())
+                parse_frame = self.frame_pool.acquire()
+                parse_frame.init(n_frame1, res_width, res_height, spade_msg.decode_coordinates(arg1), size_hint=self.frame_pool.size_hint(res_width, res_height))
+                self.frame_dict[n_frame1] = parse_frame
+                self.frame_queue.put(parse_frame)
+            
+            try:
+                added = parse_frame.add_chunk(n_chunk, data, last_chunk)
+            except ValueError as e:
+                self.chunks_invalid += 1
+                if self.debug_parse:
+                    print(f'Dropping malformed chunk of frame {n_frame1}: {e}')
+                continue
+            if not added:
+                self.chunks_duplicate += 1
+            
+            # If a frame enters the "complete" state, pop frames from the queue (and delete them from
+            # the dict) until the popped frame is the completed frame
+            if parse_frame.complete:
+                while True:
+                    tmp_frame = self.frame_queue.get()
+                    if parse_frame.index == tmp_frame.index:
                         self.frame_dict.pop(tmp_frame.index, None)
-                        if parse_frame.index == tmp_frame.index:  
-                            break
+                        break
+                    # Older frames that are still incomplete won't be delivered
+                    self._discard_frame(tmp_frame)
+                self.frames_completed += 1
+                self._recent_frames.append(parse_frame.index)
+                self.frame_pool.observe(parse_frame)
+                parse_frame.t_complete = time.monotonic()
+                self._assembly_latency.observe(parse_frame.t_complete - parse_frame.t_first)
+                parse_frame.timestamp = time.time()
+                self.emit(parse_frame)
+                if keep_last:
+                    if frame is not None:
+                        frame.release()
                     frame = parse_frame
-            
-            return frame
+                else:
+                    parse_frame.release()
+    
+    
+    def emit(self, frame):
+        """
+        Hands a completed frame to the output pipeline (the jitter buffer, which releases frames to the
+        broadcaster). Stages that hold on to the frame retain their own reference.
+        """
+        self.jitter_buffer.push(frame)
+    
+    
+    def _discard_frame(self, frame):
+        self.frame_dict.pop(frame.index, None)
+        self.frames_discarded += 1
+        self.chunks_lost += frame.missing
+        print(f'Discarding frame {frame.index} ({frame.missing} chunks missing, {frame.n_received} received)')
+        frame.release()
+    
+    
+    @property
+    def loss_stats(self):
+        """
+        Link quality statistics for the current stream
+        """
+        chunks_expected = self.chunks_received - self.chunks_duplicate - self.chunks_invalid + self.chunks_lost
+        return {
+            'chunks_received': self.chunks_received,
+            'chunks_duplicate': self.chunks_duplicate,
+            'chunks_lost': self.chunks_lost,
+            'chunks_invalid': self.chunks_invalid,
+            'chunk_loss_rate': (self.chunks_lost / chunks_expected) if chunks_expected else 0.0,
+            'frames_completed': self.frames_completed,
+            'frames_discarded': self.frames_discarded,
+        }
+    
+    
+    def _frame_released(self, frame):
+        if frame.t_complete is not None:
+            self._delivery_latency.observe(time.monotonic() - frame.t_complete)
+    
+    
+    @property
+    def command_timeouts(self):
+        """
+        Number of commands that went unanswered after all retries
+        """
+        channel = self.command_channel
+        return self._command_timeouts + (0 if channel is None else channel.timeouts)
+    
+    
+    def total(self, name):
+        """
+        Returns a stream statistic (one of STREAM_COUNTERS) summed over every stream since the client was
+        created
+        """
+        return self.stream_totals[name] + (getattr(self, name) or 0)
+    
+    
+    def _collect_metrics(self):
+        subscribers = self.broadcaster.subscribers
+        viewers = [s for s in subscribers if s.name is not None]
+        pool = self.frame_pool
+        yield 'spade_datagrams_received_total', 'counter', 'Stream datagrams received', None, self.total('recv_datagrams')
+        yield 'spade_kernel_drops_total', 'counter', 'Stream datagrams dropped by the kernel', None, None if self.kernel_drops is None else self.total('kernel_drops')
+        yield 'spade_chunks_parsed_total', 'counter', 'Stream chunks parsed', None, self.total('chunks_received')
+        yield 'spade_chunks_duplicate_total', 'counter', 'Duplicate stream chunks ignored', None, self.total('chunks_duplicate')
+        yield 'spade_chunks_lost_total', 'counter', 'Chunks missing from discarded frames', None, self.total('chunks_lost')
+        yield 'spade_chunks_invalid_total', 'counter', 'Malformed stream chunks dropped', None, self.total('chunks_invalid')
+        yield 'spade_frames_completed_total', 'counter', 'Frames reassembled', None, self.total('frames_completed')
+        yield 'spade_frames_discarded_total', 'counter', 'Incomplete frames abandoned', None, self.total('frames_discarded')
+        yield 'spade_accel_samples_total', 'counter', 'Accelerometer samples received', None, self.accel.count
+        yield 'spade_frames_incomplete', 'gauge', 'Frames currently being reassembled', None, len(self.frame_dict)
+        yield 'spade_frame_pool_in_use', 'gauge', 'Pooled frames currently referenced', None, pool.in_use
+        yield 'spade_frame_pool_buffer_bytes', 'gauge', 'Frame buffer memory owned by the frame pool', None, pool.buffer_bytes
+        yield 'spade_streaming', 'gauge', 'Whether the stream is running', None, int(self.streaming)
+        yield 'spade_subscribers', 'gauge', 'Frame subscribers (viewers and other consumers, such as the recorder)', None, len(subscribers)
+        yield 'spade_viewers', 'gauge', 'Connected stream viewers', None, len(viewers)
+        yield 'spade_bytes_served_total', 'counter', 'Bytes of stream data sent to all viewers', None, self.broadcaster.bytes_sent + sum(s.bytes_sent for s in subscribers)
+        for s in viewers:
+            yield 'spade_viewer_bytes_sent', 'gauge', 'Bytes of stream data sent to each connected viewer', {'viewer': s.name}, s.bytes_sent
+            yield 'spade_viewer_frames_dropped', 'gauge', 'Frames dropped for each connected viewer because it fell behind', {'viewer': s.name}, s.frames_dropped
+        yield 'spade_command_timeouts_total', 'counter', 'Commands that went unanswered after all retries', None, self.command_timeouts
+        if self.command_channel is not None:
+            yield 'spade_commands_in_flight', 'gauge', 'Commands awaiting a response', None, self.command_channel.in_flight
     
     
-    def mirror_http(self, cert_fpath=None, privkey_fpath=None):
-        port = 45100
+    def start_services(self):
+        """
+        Starts the background services that mirror_http relies on: telemetry polling, and the recorder,
+        transcoder and local preview (if set)
+        """
+        self.telemetry.start()
+        if self.recorder is not None:
+            self.recorder.start()
+        if self.transcoder is not None:
+            self.transcoder.start()
+        if self.preview is not None:
+            self.preview.start()
+    
+    
+    def mirror_http(self, cert_fpath=None, privkey_fpath=None, port=None):
         HttpHandler.SPADE_CLIENT = self
-        HttpHandler.PORT = port
-        server_address = ('0.0.0.0', port)
-        httpd = http.server.ThreadingHTTPServer(server_address, HttpHandler)
-        if None not in (cert_fpath, privkey_fpath):
-            HttpHandler.PROTOCOL = 'https'
-            context = ssl.SSLContext(ssl.PROTOCOL_TLS)
-            context.load_cert_chain(certfile=cert_fpath, keyfile=privkey_fpath, password='')
-            httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
-        print(f'Serving {HttpHandler.PROTOCOL.upper()} on {HttpHandler.PROTOCOL.lower()}://{server_address[0]}:{server_address[1]}')
+        httpd = http_server(port, cert_fpath, privkey_fpath)
+        self.start_services()
         httpd.serve_forever()
     
     
+    def mirror_async(self, cert_fpath=None, privkey_fpath=None, port=None):
+        """
+        Same as mirror_http, but serves viewers from a single asyncio event loop instead of one thread per
+        connection
+        """
+        import spade_async
+        if port is not None:
+            HttpHandler.PORT = int(port)
+        server = spade_async.AsyncMirrorServer(self, cert_fpath, privkey_fpath, port=HttpHandler.PORT)
+        HttpHandler.SPADE_CLIENT = self
+        HttpHandler.PROTOCOL = server.protocol
+        self.telemetry.start()
+        server.run()
+    
+    
     @property
     def connected(self):
         return self._connected
@@ -392,11 +2044,16 @@ class SpadeClient:
         """
         Increment and return the command-send-index while restricting it to four bytes
         """
-        self.cmd_send_index = int(self.cmd_send_index + 1) & 0xffffffff
-        return self.cmd_send_index
+        with self._cmd_index_lock:
+            self.cmd_send_index = int(self.cmd_send_index + 1) & 0xffffffff
+            return self.cmd_send_index
 
     
-    def send_command(self, msg, connecting=False):
+    def send_command(self, msg, connecting=False, timeout=None, retries=None):
+        """
+        Sends a command message and returns the server's response. Safe to call from multiple threads at
+        once. timeout (seconds per attempt) and retries default to command_timeout and command_retries.
+        """
         if type(msg) not in (bytes, spade_msg.SpadeUdpMsg_0x9999, spade_msg.SpadeUdpMsg_SETCMD):
             raise TypeError(f'Bad request message type: {type(msg)}')
         
@@ -423,14 +2080,10 @@ class SpadeClient:
         port = self.__class__.COMMAND_PORT
         #print(f'\n[Client -> {self.server}:{port}]\n{msg.type_name} {msg}\n{msg.data}')
         
-        server_address = (self.server, port)
-        self.command_sock.sendto(bytes(msg), server_address)
-        response, server = self.command_sock.recvfrom(msg.sizeof())
-        assert server[0] == self.server, f'Response from unknown host {server[0]}'
-        response = msg.__class__.from_bytes(response)
-        if response.length > 0:
-            response.data, server = self.command_sock.recvfrom(response.length)
-            assert server[0] == self.server, f'Response from unknown host {server[0]}'
+        t_start = time.monotonic()
+        response = self.command_channel.request(msg, timeout, retries)
+        self.metrics.histogram('spade_command_rtt_seconds', 'Command round-trip time (including retries) by message type',
+                               {'type': f'{msg.type:#06x}'}).observe(time.monotonic() - t_start)
         #print(f'[{self.server}:{port} -> Client]\n{response.type_name} {response}\n{response.data}\n')
         return response
     
@@ -478,21 +2131,137 @@ class SpadeClient:
         
         
         
-if __name__ == '__main__':
-    no_ssl_flag = '--no-ssl'
-    if len(sys.argv) < 2 or (len(sys.argv) < 3 and no_ssl_flag not in sys.argv):
-        print(f'\nUsage:\n\t{sys.argv[0]} {no_ssl_flag}\n\t{sys.argv[0]} <PEM certificate file> <private key file>\n')
-        sys.exit()
+def http_server(port=None, cert_fpath=None, privkey_fpath=None):
+    """
+    Creates a threaded HTTP(S) server for HttpHandler that listens on all interfaces (on HttpHandler.PORT by
+    default)
+    """
+    if port is not None:
+        HttpHandler.PORT = int(port)
+    server_address = ('0.0.0.0', HttpHandler.PORT)
+    httpd = http.server.ThreadingHTTPServer(server_address, HttpHandler)
+    if None not in (cert_fpath, privkey_fpath):
+        HttpHandler.PROTOCOL = 'https'
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS)
+        context.load_cert_chain(certfile=cert_fpath, keyfile=privkey_fpath, password='')
+        httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
+    print(f'Serving {HttpHandler.PROTOCOL.upper()} on {HttpHandler.PROTOCOL.lower()}://{server_address[0]}:{server_address[1]}')
+    return httpd
+
+
+def configure(args):
+    """
+    Applies the process-wide settings from the command-line arguments (hub worker processes are spawned, so
+    they apply them again)
+    """
+    FrameSubscriber.QUEUE_MAX = args.queue
+    if args.debug_parse:
+        logging.basicConfig(level=logging.DEBUG)
 
+
+def client_from_args(args, server, interface=None, name=None):
+    """
+    Creates a SpadeClient (and its capture, recorder and transcoder, if enabled) from the command-line
+    arguments. In hub mode, each device's recordings and capture are kept separately under its name.
+    """
+    client = SpadeClient(server, stream_timeout=args.stream_timeout, debug_parse=args.debug_parse, rcvbuf_sz=args.rcvbuf,
+                         recv_batch=args.recv_batch, jitter_latency=args.jitter / 1000, fps=args.fps,
+                         telemetry_interval=args.telemetry_interval, command_timeout=args.command_timeout,
+                         command_retries=args.command_retries, interface=interface)
+    if args.capture is not None:
+        import spade_emu
+        capture_fpath = args.capture
+        if name is not None:
+            root, ext = os.path.splitext(capture_fpath)
+            capture_fpath = f'{root}-{name}{ext}'
+        client.capture = spade_emu.Capture(capture_fpath)
+    if args.record is not None:
+        import spade_record
+        client.recorder = spade_record.Recorder(client, args.record if name is None else os.path.join(args.record, name),
+                                                segment_duration=args.record_segment or spade_record.Recorder.SEGMENT_DURATION,
+                                                max_bytes=None if args.record_max_mb is None else args.record_max_mb * 1024 * 1024)
+    if args.transcode_workers != 0:
+        import spade_transcode
+        client.transcoder = spade_transcode.Transcoder(client, workers=args.transcode_workers or spade_transcode.Transcoder.WORKERS)
+    if args.preview is not None:
+        import spade_preview
+        client.preview = spade_preview.LocalPreview(client, fps=args.preview or spade_preview.LocalPreview.FPS, title=name)
+    if args.ingest_process:
+        import spade_shm
+        client.ingest_process = spade_shm.IngestProcess(client)
+        # Started right away, so the ingest process is ready by the time the first viewer connects
+        client.ingest_process.start()
+    return client
+
+
+def main():
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='MJPEG mirror for Spade video streams')
+    parser.add_argument('cert_fpath', nargs='?', metavar='<PEM certificate file>')
+    parser.add_argument('privkey_fpath', nargs='?', metavar='<private key file>')
+    parser.add_argument('--no-ssl', action='store_true', help='Serve over HTTP instead of HTTPS')
+    parser.add_argument('--server', default=SpadeClient.DEFAULT_SERVER, help=f'Address of the Spade server (default: {SpadeClient.DEFAULT_SERVER}; use 127.0.0.1 with spade_emu.py)')
+    parser.add_argument('--port', type=int, default=HttpHandler.PORT, help=f'Port to serve viewers on (default: {HttpHandler.PORT})')
+    parser.add_argument('--device', action='append', metavar='NAME=ADDRESS[%%INTERFACE]', help='Serve several devices from one mirror (hub mode); each device is served under /devices/NAME/. Repeat for each device; INTERFACE (Linux only) is the network interface the device is reached through')
+    parser.add_argument('--workers', type=int, default=0, metavar='N', help='In hub mode, shard the devices across N worker processes, served on the ports following --port (default: serve every device from this process)')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='Serve viewers from an asyncio event loop instead of one thread per connection')
+    parser.add_argument('--queue', type=int, default=FrameSubscriber.QUEUE_MAX, help=f'Frames buffered per viewer before older frames are dropped (default: {FrameSubscriber.QUEUE_MAX})')
+    parser.add_argument('--stream-timeout', type=float, default=SpadeClient.STREAM_TIMEOUT, help=f'Seconds without stream data before the device is considered unresponsive (default: {SpadeClient.STREAM_TIMEOUT})')
+    parser.add_argument('--rcvbuf', type=int, default=None, metavar='BYTES', help='Kernel receive buffer size (SO_RCVBUF) for the video stream socket (default: OS default)')
+    parser.add_argument('--preview', type=float, nargs='?', const=0, default=None, metavar='FPS', help='Show the stream in a local MatPlotLib window, drawing up to FPS frames per second (default: 10); frames are drawn by a separate process, so the preview never slows down the stream')
+    parser.add_argument('--ingest-process', action='store_true', help='Receive and reassemble the stream in a separate process, which hands frames to the server through shared memory (so serving load can\'t cause packet loss)')
+    parser.add_argument('--recv-batch', type=int, default=SpadeClient.RECV_BATCH_MAX, metavar='N', help=f'Maximum datagrams received per ingest wakeup (default: {SpadeClient.RECV_BATCH_MAX})')
+    parser.add_argument('--jitter', type=float, default=SpadeClient.JITTER_LATENCY * 1000, metavar='MS', help='Milliseconds completed frames may be held to reorder them and pace output (default: 0, lowest latency)')
+    parser.add_argument('--fps', type=float, default=None, help='Frame rate to pace output to when --jitter is set (default: estimated from the stream)')
+    parser.add_argument('--telemetry-interval', type=float, default=TelemetryPoller.INTERVAL, metavar='SECONDS', help=f'Seconds between battery/model/PWM queries to the device (default: {TelemetryPoller.INTERVAL})')
+    parser.add_argument('--command-timeout', type=float, default=CommandChannel.TIMEOUT, metavar='SECONDS', help=f'Seconds to wait for each device command response (default: {CommandChannel.TIMEOUT})')
+    parser.add_argument('--command-retries', type=int, default=CommandChannel.RETRIES, metavar='N', help=f'Times an unanswered device command is re-sent (default: {CommandChannel.RETRIES})')
+    parser.add_argument('--record', metavar='DIRECTORY', help='Record the stream to rolling segment files in DIRECTORY (served at /recordings)')
+    parser.add_argument('--record-segment', type=float, default=None, metavar='SECONDS', help='Seconds of video per recording segment (default: 300)')
+    parser.add_argument('--record-max-mb', type=float, default=None, metavar='MB', help='Delete the oldest recordings once they take up more than this (default: no limit)')
+    parser.add_argument('--transcode-workers', type=int, default=None, metavar='N', help='Threads that re-encode frames for variant streams (/stream?scale=&quality=&fps=; default: up to 4, 0 disables variants)')
+    parser.add_argument('--capture', metavar='FILE', help='Log every datagram received from the server to FILE (for replay with spade_emu.py)')
+    parser.add_argument('--debug-parse', action='store_true', help='Parse stream chunks with the ctypes message classes and log each one (slow)')
+    args = parser.parse_args()
+    
+    if not args.no_ssl and None in (args.cert_fpath, args.privkey_fpath):
+        print(f'\nUsage:\n\t{sys.argv[0]} --no-ssl\n\t{sys.argv[0]} <PEM certificate file> <private key file>\n')
+        sys.exit()
+    
     cert_fpath = None
     privkey_fpath = None
-    if no_ssl_flag not in sys.argv:
-        cert_fpath = sys.argv[1]
-        privkey_fpath = sys.argv[2]
-
-    client = SpadeClient()
-    print(f'Server battery at {client.battery}%')
-    print(f'Server: {client.version}')
-    print(f'PWM: {client.pwm}')
+    if not args.no_ssl:
+        cert_fpath = args.cert_fpath
+        privkey_fpath = args.privkey_fpath
+    
+    if args.ingest_process and args.capture is not None:
+        # The stream datagrams are only seen by the ingest process
+        parser.error('--capture can\'t be combined with --ingest-process')
+    
+    configure(args)
+    if args.device:
+        import spade_hub
+        try:
+            devices = [spade_hub.parse_device(spec) for spec in args.device]
+        except ValueError as e:
+            parser.error(str(e))
+        hub = spade_hub.Hub(devices, functools.partial(client_from_args, args), args.port, cert_fpath, privkey_fpath,
+                            use_async=args.use_async, workers=args.workers, setup=functools.partial(configure, args))
+        hub.run()
+        sys.exit()
     
-    client.mirror_http(cert_fpath, privkey_fpath)
+    client = client_from_args(args, args.server)
+    # The listener is bound right away; the telemetry poller connects to the server in the background and
+    # viewers that connect in the meantime wait for the stream
+    if args.use_async:
+        client.mirror_async(cert_fpath, privkey_fpath, args.port)
+    else:
+        client.mirror_http(cert_fpath, privkey_fpath, args.port)
+
+
+if __name__ == '__main__':
+    # Runs the imported spade_mirror module rather than this script's copy of it (__main__), since the other
+    # modules (e.g., spade_async) import spade_mirror and must share its classes and settings
+    import spade_mirror
+    spade_mirror.main()
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 # Author: Sean Pesce
 
+import struct
+
 from ctypes import c_char, c_uint8, c_uint16, c_uint32, c_uint64
 
 import ctypes_util
@@ -79,14 +81,45 @@ class SpadeUdpMsg_0x9999_StreamChunk(ctypes_util.StructLE):
     ]
     
     
+    # Precompiled equivalent of _fields_ (with the nested header's fields flattened) for decoding chunk
+    # headers straight out of a receive buffer
+    STRUCT = struct.Struct('<HHIIIQBIIHHHIHHI')
+    
+    
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        """
+        Fast path for the ingest loop: decodes the header at buf[offset:] without copying the buffer or
+        instantiating ctypes objects. Returns the field values as a tuple (in the same order as
+        astuple()). Only the magic bytes are validated, and nothing is logged; use from_bytes for
+        debugging.
+        """
+        fields = cls.STRUCT.unpack_from(buf, offset)
+        if fields[0] != SpadeUdpMsg_0x9999.MAGIC:
+            raise ValueError(f'Invalid magic bytes for {cls.__name__}: {fields[0]:#x}')
+        return fields
+    
+    
+    def astuple(self):
+        h = self.header
+        return (h.magic, h.type, h.cmdSendIndex, h.arg1, h.length, h.unk1, self.unk1, self.n_frame1, self.unk2,
+                self.n_chunk, self.last_chunk, self.length, self.n_frame2, self.res_width, self.res_height, self.n_frame3)
+    
+    
     @property
     def coordinates(self):
-        accel = self.header.arg1
-        x = accel >> 20
-        y = (0xffc00 & accel) >> 10
-        z = 0x3ff & accel
-        
-        return x, y, z
+        return decode_coordinates(self.header.arg1)
+
+
+def decode_coordinates(accel):
+    """
+    Decodes the XYZ accelerometer coordinates packed into the arg1 field of StreamChunk messages
+    """
+    x = accel >> 20
+    y = (0xffc00 & accel) >> 10
+    z = 0x3ff & accel
+    
+    return x, y, z
 
 
 class SpadeUdpMsg_SETCMD(ctypes_util.StructLE):
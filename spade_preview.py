@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# Author: Sean Pesce
+
+# Local preview of the stream in a MatPlotLib window. Frames are decoded and drawn by a separate (spawned)
+# window process, at its own pace, so drawing never holds up the stream or the viewers.
+#
+# The preview is fed by a thread that holds a single-frame subscription (so newer frames replace older
+# ones while the window is busy), and that hands the window the latest frame each time the window reports
+# that it's ready for another one.
+
+
+import multiprocessing
+import signal
+import time
+
+from io import BytesIO
+
+from spade_mirror import FrameConsumer
+
+
+class LocalPreview(FrameConsumer):
+    """
+    Shows the frames published by a SpadeClient in a local window, drawing up to fps frames per second.
+    frames_dropped counts the frames replaced by newer ones before the window was ready for them.
+    """
+    FPS = 10.0
+    POLL_INTERVAL = 0.05  # Seconds between the window's event processing while it waits for frames
+    THREAD_NAME = 'SpadePreview'
+    
+    def __init__(self, spade_client, fps=FPS, title=None):
+        super().__init__(spade_client)
+        self.fps = float(fps)
+        self.title = title or f'Spade ({spade_client.server})'
+        self._process = None
+        # Statistics
+        self.frames_drawn = 0        # Frames the window has drawn
+        self.frames_undecodable = 0  # Frames the window skipped because they couldn't be decoded
+        return
+    
+    
+    def stop(self):
+        process = self._process
+        if process is not None:
+            process.terminate()
+        super().stop()
+    
+    
+    def _ready(self, conn):
+        """
+        Waits until the window is ready for another frame, counting the frame it was last sent (if any)
+        """
+        drawn = conn.recv()
+        if drawn:
+            self.frames_drawn += 1
+        elif drawn is not None:
+            self.frames_undecodable += 1
+    
+    
+    def _run(self):
+        # Spawned rather than forked, since GUI toolkits don't survive forking
+        context = multiprocessing.get_context('spawn')
+        conn, child_conn = context.Pipe()
+        self._process = context.Process(target=_draw, args=(child_conn, self.title, self.fps), name='SpadePreviewWindow', daemon=True)
+        self._process.start()
+        child_conn.close()
+        frames = self._frames(1)
+        try:
+            self._ready(conn)
+            for frame in frames:
+                if frame is None:
+                    if not self._process.is_alive():
+                        break
+                    continue
+                caption = f'Frame {frame.index}'
+                battery, _ = self.spade_client.telemetry.get('battery')
+                if battery is not None:
+                    caption += f'  |  Battery: {battery}%'
+                conn.send(caption)
+                conn.send_bytes(frame.data)
+                # The next frame is only taken once the window is ready for it, so it's the latest one
+                self._ready(conn)
+        except (EOFError, OSError):
+            # The window was closed
+            pass
+        finally:
+            frames.close()
+            conn.close()
+            self._process.join(self.__class__.RETRY_INTERVAL)
+            if self._process.is_alive():
+                self._process.terminate()
+            self._process = None
+
+
+def _draw(conn, title, fps):
+    """
+    Main function of the window process. Reports that it's ready for a frame, then decodes and draws each
+    frame it's sent, until the window is closed.
+    """
+    # Interrupts are handled by the mirror process (which then ends this one)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import matplotlib.pyplot
+    figure = matplotlib.pyplot.figure(title)
+    axes = figure.gca()
+    image = None
+    try:
+        # Reports whether each frame was drawn (None before the first frame)
+        conn.send(None)
+        while matplotlib.pyplot.fignum_exists(figure.number):
+            if not conn.poll(0):
+                # Keeps the window responsive while waiting
+                matplotlib.pyplot.pause(LocalPreview.POLL_INTERVAL)
+                continue
+            caption = conn.recv()
+            data = conn.recv_bytes()
+            start = time.monotonic()
+            try:
+                img = matplotlib.pyplot.imread(BytesIO(data), format='jpeg')
+            except Exception as e:
+                # Skips frames that can't be decoded, rather than closing the window
+                print(f'[WARNING] Preview failed to decode frame: {e}')
+                conn.send(False)
+                continue
+            if image is None or image.get_array().shape != img.shape:
+                axes.clear()
+                image = axes.imshow(img)
+            else:
+                # Reuses the existing image rather than stacking a new one on top of it
+                image.set_data(img)
+            axes.set_title(caption)
+            # Draws the frame, then waits out the rest of the frame interval
+            matplotlib.pyplot.pause(max(0.001, (1 / fps) - (time.monotonic() - start)))
+            conn.send(True)
+    except (EOFError, OSError):
+        # The preview was stopped
+        pass
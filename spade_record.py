@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# Author: Sean Pesce
+
+# Disk recording of the live stream. Completed frames are appended to rolling segment files, each paired
+# with a compact index of the frames it contains, and recorded time ranges are served back to viewers
+# straight from disk.
+#
+# Segment data files (<name>.mjpeg) hold the frames as consecutive multipart parts, formatted exactly as
+# they're sent to /stream viewers, so any run of frames can be sent to a viewer as-is with sendfile().
+# Each index file (<name>.idx) holds one fixed-size INDEX_RECORD per frame.
+
+
+import bisect
+import collections
+import datetime
+import os
+import struct
+import threading
+
+from spade_mirror import FrameConsumer, HttpHandler
+
+
+# Frame index, arrival timestamp, width, height, X/Y/Z coordinates (NO_COORDINATE if unknown), offset of
+# the frame's part in the data file, and the length of the part
+INDEX_RECORD = struct.Struct('<IdHHHHHQI')
+NO_COORDINATE = 0xffff
+
+DATA_EXT = '.mjpeg'
+INDEX_EXT = '.idx'
+
+
+class Segment:
+    """
+    A single recording file and its index
+    """
+    
+    def __init__(self, directory, name):
+        self.name = name
+        self.data_fpath = os.path.join(directory, name + DATA_EXT)
+        self.index_fpath = os.path.join(directory, name + INDEX_EXT)
+        self.start = None  # Timestamp of the first frame
+        self.end = None    # Timestamp of the last frame
+        self.frames = 0
+        self.size = 0      # Bytes of frame data recorded
+        return
+    
+    
+    @classmethod
+    def load(cls, directory, name):
+        """
+        Reads the statistics of a segment that was recorded previously
+        """
+        segment = cls(directory, name)
+        records = segment.read_index()
+        if records:
+            segment.start = records[0][1]
+            segment.end = records[-1][1]
+            segment.frames = len(records)
+            segment.size = records[-1][7] + records[-1][8]
+        return segment
+    
+    
+    def read_index(self):
+        with open(self.index_fpath, 'rb') as f:
+            data = f.read()
+        # Ignore a partially-written trailing record
+        return list(INDEX_RECORD.iter_unpack(data[:len(data) - (len(data) % INDEX_RECORD.size)]))
+    
+    
+    def find(self, start=None, end=None):
+        """
+        Locates the frames recorded between the start and end timestamps (inclusive). Returns the offset
+        and length of their parts in the data file and the number of frames, or None if there are none.
+        """
+        records = self.read_index()
+        timestamps = [r[1] for r in records]
+        first = 0 if start is None else bisect.bisect_left(timestamps, start)
+        last = len(records) if end is None else bisect.bisect_right(timestamps, end)
+        if first >= last:
+            return None
+        offset = records[first][7]
+        return offset, records[last - 1][7] + records[last - 1][8] - offset, last - first
+    
+    
+    def info(self):
+        return {
+            'name': self.name,
+            'start': self.start,
+            'end': self.end,
+            'frames': self.frames,
+            'bytes': self.size,
+        }
+    
+    
+    def delete(self):
+        for fpath in (self.data_fpath, self.index_fpath):
+            try:
+                os.remove(fpath)
+            except FileNotFoundError:
+                pass
+
+
+class Recorder(FrameConsumer):
+    """
+    Records the frames published by a SpadeClient to rolling segment files.
+    
+    Frames are written by a dedicated thread that holds its own subscription (so the stream keeps running
+    while recording, even with no viewers connected). Up to queue_max frames are buffered while the disk
+    falls behind; beyond that, the oldest buffered frames are dropped, just like for a slow viewer.
+    A new segment is started every segment_duration seconds and whenever the stream restarts, and the
+    oldest segments are deleted once the recordings take up more than max_bytes (if set). With a size
+    limit, segments are also rolled over once they reach half of it, so the current segment can't grow
+    past the limit on its own.
+    """
+    QUEUE_MAX = 32
+    SEGMENT_DURATION = 300.0
+    THREAD_NAME = 'SpadeRecorder'
+    CLOSE_DELIMITER = b'\r\n' + HttpHandler.BOUNDARY + b'--\r\n'  # Ends a recording served over HTTP
+    
+    def __init__(self, spade_client, directory, segment_duration=SEGMENT_DURATION, max_bytes=None, queue_max=QUEUE_MAX):
+        super().__init__(spade_client)
+        self.directory = str(directory)
+        self.segment_duration = float(segment_duration)
+        self.max_bytes = None if max_bytes is None else int(max_bytes)
+        self.queue_max = int(queue_max)
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.segments = collections.OrderedDict()  # Name -> Segment, oldest first
+        for fname in sorted(os.listdir(self.directory)):
+            name, ext = os.path.splitext(fname)
+            if ext == INDEX_EXT and os.path.isfile(os.path.join(self.directory, name + DATA_EXT)):
+                self.segments[name] = Segment.load(self.directory, name)
+        self._total_size = sum(s.size for s in self.segments.values())  # Bytes of frame data in all segments
+        self._segment = None      # Segment being recorded
+        self._data_file = None
+        self._index_file = None
+        # Statistics
+        self.frames_recorded = 0
+        return
+    
+    
+    def _run(self):
+        for frame in self._frames(self.queue_max):
+            if frame is None:
+                # The stream ended; the next one is recorded to a new segment
+                self._close_segment()
+                continue
+            try:
+                self._write(frame)
+            except OSError as e:
+                print(f'[ERROR] Recording failed: {e}')
+                # Retried with a new segment
+                self._close_segment()
+                self._stop.wait(self.__class__.RETRY_INTERVAL)
+    
+    
+    def _write(self, frame):
+        header = HttpHandler.PART_HEADER(frame)
+        data = frame.data
+        length = len(header) + len(data)
+        if (self._segment is None or frame.timestamp - self._segment.start >= self.segment_duration
+                or (self.max_bytes is not None and self._segment.frames > 0 and self._segment.size + length > self.max_bytes // 2)):
+            self._open_segment(frame.timestamp)
+        segment = self._segment
+        self._data_file.write(header)
+        self._data_file.write(data)
+        self._data_file.flush()
+        # The index entry is only written once the frame's data is on disk, so readers never see an entry
+        # for a partial frame
+        x, y, z = frame.position or (NO_COORDINATE, NO_COORDINATE, NO_COORDINATE)
+        self._index_file.write(INDEX_RECORD.pack(frame.index, frame.timestamp, frame.width, frame.height,
+                                                 x, y, z, segment.size, length))
+        self._index_file.flush()
+        with self._lock:
+            if segment.start is None:
+                segment.start = frame.timestamp
+            segment.end = frame.timestamp
+            segment.frames += 1
+            segment.size += length
+            self._total_size += length
+        self.frames_recorded += 1
+        if self.max_bytes is not None and self._total_size > self.max_bytes:
+            self._enforce_limit()
+    
+    
+    def _open_segment(self, timestamp):
+        self._close_segment()
+        name = base_name = datetime.datetime.fromtimestamp(timestamp).strftime('%Y%m%d-%H%M%S-%f')[:-3]
+        n = 1
+        while name in self.segments:
+            # Segments can be rolled over (by size) within the same millisecond
+            name = f'{base_name}-{n}'
+            n += 1
+        segment = Segment(self.directory, name)
+        segment.start = timestamp
+        self._data_file = open(segment.data_fpath, 'wb')
+        self._index_file = open(segment.index_fpath, 'wb')
+        with self._lock:
+            self.segments[name] = segment
+        self._segment = segment
+        print(f'Recording to {segment.data_fpath}')
+        self._enforce_limit()
+    
+    
+    def _close_segment(self):
+        for f in (self._data_file, self._index_file):
+            if f is not None:
+                f.close()
+        self._data_file = None
+        self._index_file = None
+        self._segment = None
+    
+    
+    def _enforce_limit(self):
+        """
+        Deletes the oldest segments (other than the current one) while the recordings exceed max_bytes
+        """
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            while len(self.segments) > 1 and self._total_size > self.max_bytes:
+                name, segment = self.segments.popitem(last=False)
+                self._total_size -= segment.size
+                segment.delete()
+                print(f'Deleted recording {name}')
+    
+    
+    def listing(self):
+        """
+        Returns information about every available segment, oldest first
+        """
+        with self._lock:
+            return [s.info() for s in self.segments.values()]
+    
+    
+    def find(self, name, start=None, end=None):
+        """
+        Locates the frames recorded in a segment between the start and end timestamps. Returns the
+        segment's data file (opened for reading; the caller closes it), the offset and length of the
+        frames' parts in it, and the number of frames. Raises KeyError if the segment doesn't exist and
+        FileNotFoundError if it was deleted in the meantime; returns None if no frames are in range.
+        """
+        with self._lock:
+            segment = self.segments[name]
+        # Opened before the index is read, so the data stays readable if the segment is deleted afterwards
+        f = open(segment.data_fpath, 'rb')
+        try:
+            found = segment.find(start, end)
+        except Exception:
+            f.close()
+            raise
+        if found is None:
+            f.close()
+            return None
+        return (f,) + found
+    
+    
+    @staticmethod
+    def response_length(count):
+        """
+        Content-Length of a recording response whose parts take up `count` bytes. The leading CRLF of the
+        first part ends the response headers, and the parts are followed by the closing delimiter.
+        """
+        return count - 2 + len(Recorder.CLOSE_DELIMITER)
@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+# Author: Sean Pesce
+
+# Process-separated ingest. With SpadeClient.ingest_process set, the stream is received and reassembled by
+# a child process (running the usual SpadeClient ingest pipeline, under its own GIL), so serving load in
+# the mirror process can't slow down the UDP receive path and cause packet loss.
+#
+# The child copies each completed frame into a slot of a FrameRing (fixed-size slots in shared memory,
+# each with a small header) and sends the frame's sequence number and slot to the mirror process, which
+# publishes the slot to the client's broadcaster as a RingFrame. A RingFrame's data is a view of the
+# shared memory, so viewers are sent frames straight from the slot, without another copy.
+#
+# While any reference to a slot's frame is held in the mirror process, the slot is flagged busy, and the
+# child skips it. If every slot is busy (or a frame doesn't fit in a slot), the child drops the frame
+# rather than waiting, so ingest never waits on viewers.
+#
+# The accelerometer ring (see spade_accel) and the child's ingest statistics are kept in the shared memory
+# too.
+
+
+import atexit
+import multiprocessing
+import os
+import queue
+import signal
+import struct
+import threading
+import time
+
+from multiprocessing import shared_memory
+
+import spade_accel
+from spade_mirror import SpadeClient
+
+
+# Magic, slot count, slot size, frames written and frames dropped (for lack of a free slot, or because they
+# didn't fit in one)
+HEADER = struct.Struct('<8sIIQQ')
+# Sequence number (0 while the slot is being written), frame index, length, timestamp (time.time()), first
+# chunk and completion times (time.monotonic(), which is system-wide), width, height, and X/Y/Z
+# accelerometer coordinates (NO_COORDINATE if unknown)
+SLOT_HEADER = struct.Struct('<QIIdddHHHHH')
+NO_COORDINATE = 0xffff
+# SpadeClient ingest statistics maintained by the ingest process (-1 for None), followed by its totals of
+# SpadeClient.STREAM_COUNTERS
+STATS = ('recv_wakeups', 'recv_datagrams', 'recv_batch_peak', 'kernel_drops', 'chunks_received', 'chunks_duplicate',
+         'chunks_lost', 'chunks_invalid', 'frames_completed', 'frames_discarded')
+STATS_STRUCT = struct.Struct(f'<{len(STATS) + len(SpadeClient.STREAM_COUNTERS)}q')
+
+# Messages between the mirror process and the ingest process
+MSG_START = 'start'      # (MSG_START, generation); starts the stream
+MSG_STOP = 'stop'        # (MSG_STOP, generation); stops the stream
+MSG_EXIT = 'exit'        # (MSG_EXIT, None); ends the ingest process
+MSG_STARTED = 'started'  # (MSG_STARTED, generation)
+MSG_ERROR = 'error'      # (MSG_ERROR, generation, message); the stream couldn't be started
+MSG_ENDED = 'ended'      # (MSG_ENDED, generation); the stream failed (e.g., the device stopped responding)
+MSG_FRAME = 'frame'      # (MSG_FRAME, sequence number, slot); a frame was written to the ring
+MSG_STATS = 'stats'      # (MSG_STATS, generation); the ingest statistics were updated
+
+
+# The ingest process is spawned rather than forked, since it can be (re)started while the mirror process is
+# serving: a forked process would inherit the mirror process's open connections (keeping them open after
+# the mirror process closes them) and any locks held by its other threads
+_context = multiprocessing.get_context('spawn')
+
+
+def _align(n, alignment):
+    return -(-n // alignment) * alignment
+
+
+class FrameRing:
+    """
+    Frame slots, busy flags, ingest statistics and accelerometer samples in a shared memory block. Created
+    by the mirror process; the ingest process attaches to it by name.
+    
+    Slot sequence numbers and busy flags are only changed under a (cross-process) lock, so the ingest
+    process never writes to a slot that the mirror process has claimed; frame data is copied without it.
+    """
+    MAGIC = b'SPADERNG'
+    SLOTS = 16
+    SLOT_SIZE = 512 * 1024
+    SLOT_ALIGN = 4096
+    
+    def __init__(self, slots=SLOTS, slot_size=SLOT_SIZE, name=None, lock=None):
+        self.slots = max(1, int(slots))
+        self.slot_size = _align(int(slot_size), self.__class__.SLOT_ALIGN)
+        self.lock = _context.Lock() if lock is None else lock
+        self._stats_offs = HEADER.size
+        self._busy_offs = self._stats_offs + STATS_STRUCT.size
+        self._slot_headers_offs = _align(self._busy_offs + self.slots, 8)
+        self._accel_offs = self._slot_headers_offs + (SLOT_HEADER.size * self.slots)
+        self._slots_offs = _align(self._accel_offs + spade_accel.AccelRing.size(), self.__class__.SLOT_ALIGN)
+        size = self._slots_offs + (self.slot_size * self.slots)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            HEADER.pack_into(self.shm.buf, 0, self.__class__.MAGIC, self.slots, self.slot_size, 0, 0)
+        else:
+            self.shm = shared_memory.SharedMemory(name)
+            magic, slots, slot_size, _, _ = HEADER.unpack_from(self.shm.buf, 0)
+            assert (magic, slots, slot_size) == (self.__class__.MAGIC, self.slots, self.slot_size), f'Unexpected frame ring layout in {name}'
+        self.name = self.shm.name
+        self.busy = self.shm.buf[self._busy_offs:self._busy_offs + self.slots]  # Set by the mirror process
+        self.accel = spade_accel.AccelRing(buffer=self.shm.buf[self._accel_offs:self._slots_offs])
+        self._next_slot = 0  # Next slot to try to write to (ingest process)
+        self._seq = 0        # Sequence number of the last frame written (ingest process)
+        # Reference counts of the frames in the mirror process
+        self._refs_lock = threading.Lock()
+        self.release_hook = None  # Called with each frame whose last reference has been released
+        return
+    
+    
+    @property
+    def counters(self):
+        """
+        Returns the number of frames written to the ring and the number of frames dropped
+        """
+        _, _, _, written, dropped = HEADER.unpack_from(self.shm.buf, 0)
+        return written, dropped
+    
+    
+    def write(self, frame):
+        """
+        Copies a completed frame to a free slot (ingest process). Returns the frame's sequence number and
+        slot, or None if the frame was dropped.
+        """
+        buf = self.shm.buf
+        length = len(frame.data)
+        with self.lock:
+            slot = None
+            if length <= self.slot_size:
+                for i in range(self.slots):
+                    candidate = (self._next_slot + i) % self.slots
+                    if not self.busy[candidate]:
+                        slot = candidate
+                        break
+            magic, slots, slot_size, written, dropped = HEADER.unpack_from(buf, 0)
+            if slot is None:
+                HEADER.pack_into(buf, 0, magic, slots, slot_size, written, dropped + 1)
+                return None
+            # Marked as being written, so the mirror process can't claim it
+            struct.pack_into('<Q', buf, self._slot_headers_offs + (slot * SLOT_HEADER.size), 0)
+        self._next_slot = slot + 1
+        start = self._slots_offs + (slot * self.slot_size)
+        buf[start:start + length] = frame.data
+        self._seq += 1
+        x, y, z = frame.position or (NO_COORDINATE, NO_COORDINATE, NO_COORDINATE)
+        with self.lock:
+            SLOT_HEADER.pack_into(buf, self._slot_headers_offs + (slot * SLOT_HEADER.size), self._seq, frame.index & 0xffffffff,
+                                  length, frame.timestamp, frame.t_first, frame.t_complete, frame.width, frame.height, x, y, z)
+            magic, slots, slot_size, written, dropped = HEADER.unpack_from(buf, 0)
+            HEADER.pack_into(buf, 0, magic, slots, slot_size, written + 1, dropped)
+        return self._seq, slot
+    
+    
+    def write_stats(self, spade_client):
+        """
+        Stores the ingest process's SpadeClient statistics
+        """
+        values = [getattr(spade_client, name) for name in STATS] + [spade_client.total(name) for name in SpadeClient.STREAM_COUNTERS]
+        STATS_STRUCT.pack_into(self.shm.buf, self._stats_offs, *(-1 if v is None else v for v in values))
+    
+    
+    def read_stats(self, spade_client, totals_base=None):
+        """
+        Copies the ingest process's statistics to a SpadeClient in the mirror process. totals_base holds
+        totals from earlier ingest processes, which are added to this one's.
+        """
+        values = STATS_STRUCT.unpack_from(self.shm.buf, self._stats_offs)
+        for name, value in zip(STATS, values):
+            setattr(spade_client, name, None if value < 0 else value)
+        for name, total in zip(SpadeClient.STREAM_COUNTERS, values[len(STATS):]):
+            base = 0 if totals_base is None else totals_base[name]
+            spade_client.stream_totals[name] = base + total - (getattr(spade_client, name) or 0)
+    
+    
+    def frame(self, seq, slot):
+        """
+        Claims the slot of a frame that was written to the ring (mirror process). Returns the frame (which
+        the caller must release), or None if the slot has already been reused.
+        """
+        with self.lock:
+            fields = SLOT_HEADER.unpack_from(self.shm.buf, self._slot_headers_offs + (slot * SLOT_HEADER.size))
+            if fields[0] != seq:
+                return None
+            self.busy[slot] = 1
+        return RingFrame(self, slot, fields)
+    
+    
+    def view(self, slot, length):
+        start = self._slots_offs + (slot * self.slot_size)
+        return self.shm.buf[start:start + length].toreadonly()
+    
+    
+    def retain(self, frame):
+        with self._refs_lock:
+            assert frame._refs > 0, f'Attempt to retain released frame {frame.index}'
+            frame._refs += 1
+    
+    
+    def release(self, frame):
+        with self._refs_lock:
+            assert frame._refs > 0, f'Attempt to release frame {frame.index} more times than it was retained'
+            frame._refs -= 1
+            if frame._refs > 0:
+                return
+        if self.release_hook is not None:
+            self.release_hook(frame)
+        try:
+            frame.data.release()
+        except BufferError:
+            # Still exported somewhere; unmapped once that's collected
+            pass
+        with self.lock:
+            self.busy[frame.slot] = 0
+    
+    
+    def close(self, unlink=False):
+        self.busy.release()
+        try:
+            self.shm.close()
+        except BufferError:
+            # Frames (or accelerometer samples) are still referenced; the memory is unmapped when they're
+            # collected (or at exit)
+            pass
+        if unlink:
+            self.shm.unlink()
+
+
+class RingFrame:
+    """
+    Completed frame in a FrameRing slot, as seen by the mirror process. Reference-counted like pooled
+    JpgFrames; the slot can only be reused once the last reference has been released.
+    """
+    
+    def __init__(self, ring, slot, fields):
+        _, index, length, timestamp, t_first, t_complete, width, height, x, y, z = fields
+        self.ring = ring
+        self.slot = slot
+        self._refs = 1
+        self.index = index
+        self.width = width
+        self.height = height
+        self.position = None if NO_COORDINATE in (x, y, z) else (x, y, z)
+        self.timestamp = timestamp
+        self.t_first = t_first
+        self.t_complete = t_complete
+        self.data = ring.view(slot, length)  # Read-only view of the JPEG in shared memory (valid until the frame is released)
+        self.cache = {}
+        return
+    
+    
+    def retain(self):
+        self.ring.retain(self)
+        return self
+    
+    
+    def release(self):
+        self.ring.release(self)
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class IngestProcess:
+    """
+    Runs a SpadeClient's stream ingest in a child process and publishes the frames it completes to the
+    client's broadcaster. Replaces the client's ingest thread (and accelerometer ring) once created.
+    """
+    POLL_INTERVAL = 0.5  # Seconds between the ingest process's statistics updates (and checks on the stream)
+    
+    def __init__(self, spade_client, slots=FrameRing.SLOTS, slot_size=FrameRing.SLOT_SIZE):
+        self.spade_client = spade_client
+        self.ring = FrameRing(slots, slot_size)
+        self.ring.release_hook = spade_client._frame_released
+        spade_client.accel = self.ring.accel
+        self.streaming = False
+        self._lock = threading.Lock()  # Guards the process, its connection and the stream generation
+        self._process = None
+        self._conn = None
+        self._generation = 0  # Incremented with each stream started, so replies about earlier streams are ignored
+        self._replies = queue.Queue()
+        self._closed = False
+        # Statistics
+        self.frames_overwritten = 0  # Frames whose slot was reused before this process could claim it
+        self.restarts = 0
+        self._totals_base = dict.fromkeys(SpadeClient.STREAM_COUNTERS, 0)  # Stream totals from earlier ingest processes
+        spade_client.metrics.add_collector(self._collect_metrics)
+        # Also closed when the mirror exits without disconnecting (e.g., on Ctrl-C), so that the ring's shared
+        # memory is freed and the process's exit isn't reported as a failure
+        atexit.register(self.close)
+        return
+    
+    
+    def start(self):
+        """
+        Starts the ingest process (or restarts it, if it exited)
+        """
+        with self._lock:
+            if self._process is not None:
+                if self._process.is_alive():
+                    return
+                self.restarts += 1
+                self._conn.close()
+                # The new process counts from zero
+                self._totals_base = {name: self.spade_client.total(name) for name in SpadeClient.STREAM_COUNTERS}
+            spade_client = self.spade_client
+            settings = {
+                'server': spade_client.server,
+                'stream_timeout': spade_client.stream_timeout,
+                'debug_parse': spade_client.debug_parse,
+                'rcvbuf_sz': spade_client.rcvbuf_sz,
+                'recv_batch': len(spade_client.recv_ring),
+                'jitter_latency': spade_client.jitter_buffer.latency,
+                'fps': spade_client.jitter_buffer.fps,
+                'command_timeout': spade_client.command_timeout,
+                'command_retries': spade_client.command_retries,
+                'interface': spade_client.interface,
+            }
+            self._conn, child_conn = _context.Pipe()
+            self._process = _context.Process(target=_run, name=f'SpadeIngest-{spade_client.server}', daemon=True,
+                                                    args=(settings, self.ring.name, self.ring.slots, self.ring.slot_size, self.ring.lock, child_conn))
+            self._process.start()
+            child_conn.close()
+            threading.Thread(target=self._pump, args=(self._conn,), name=f'SpadeIngestPump-{spade_client.server}', daemon=True).start()
+    
+    
+    def start_stream(self):
+        """
+        Starts the stream in the ingest process, if it isn't already running. Raises IOError if it can't be
+        started.
+        """
+        if self.streaming:
+            return
+        self.start()
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+            process = self._process
+            self._conn.send((MSG_START, generation))
+        while True:
+            try:
+                reply = self._replies.get(timeout=self.__class__.POLL_INTERVAL)
+            except queue.Empty:
+                if not process.is_alive():
+                    raise IOError(f'[ERROR] Ingest process exited with code {process.exitcode}')
+                continue
+            if reply[1] != generation:
+                # About an earlier stream
+                continue
+            if reply[0] == MSG_ERROR:
+                raise IOError(reply[2])
+            return
+    
+    
+    def stop_stream(self):
+        self.streaming = False
+        self.spade_client.streaming = False
+        with self._lock:
+            if self._process is None or not self._process.is_alive():
+                return
+            try:
+                self._conn.send((MSG_STOP, self._generation))
+            except OSError:
+                # The process just exited
+                pass
+    
+    
+    def close(self):
+        """
+        Ends the ingest process and frees the shared memory
+        """
+        self.stop_stream()
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            process = self._process
+            self._process = None
+            if process is not None:
+                try:
+                    self._conn.send((MSG_EXIT, None))
+                except OSError:
+                    pass
+                process.join(self.__class__.POLL_INTERVAL * 4)
+                if process.is_alive():
+                    process.terminate()
+                self._conn.close()
+        self.ring.close(unlink=True)
+    
+    
+    def _pump(self, conn):
+        """
+        Receives the ingest process's messages, publishing each frame it writes to the ring
+        """
+        spade_client = self.spade_client
+        ring = self.ring
+        try:
+            while True:
+                message = conn.recv()
+                kind = message[0]
+                if kind == MSG_FRAME:
+                    frame = ring.frame(message[1], message[2])
+                    spade_client.last_datagram_time = time.monotonic()
+                    if frame is None:
+                        self.frames_overwritten += 1
+                        continue
+                    with frame:
+                        spade_client._assembly_latency.observe(frame.t_complete - frame.t_first)
+                        spade_client.broadcaster.publish(frame)
+                    continue
+                if message[1] != self._generation:
+                    # About an earlier stream
+                    continue
+                if kind == MSG_STATS:
+                    ring.read_stats(spade_client, self._totals_base)
+                elif kind == MSG_STARTED:
+                    self.streaming = True
+                    spade_client.streaming = True
+                    spade_client.last_datagram_time = time.monotonic()
+                    self._replies.put(message)
+                elif kind == MSG_ERROR:
+                    self._replies.put(message)
+                elif kind == MSG_ENDED:
+                    ring.read_stats(spade_client, self._totals_base)
+                    self.streaming = False
+                    spade_client.streaming = False
+                    # Wake any consumers that are waiting for frames that will never arrive
+                    spade_client.broadcaster.close()
+        except (EOFError, OSError):
+            # The ingest process exited (or was closed)
+            pass
+        if self.streaming:
+            print(f'[ERROR] Ingest process for {spade_client.server} exited')
+            self.streaming = False
+            spade_client.streaming = False
+            spade_client.broadcaster.close()
+    
+    
+    def _collect_metrics(self):
+        written, dropped = self.ring.counters
+        yield 'spade_ingest_ring_frames_written_total', 'counter', 'Frames written to the shared-memory frame ring by the ingest process', None, written
+        yield 'spade_ingest_ring_frames_dropped_total', 'counter', 'Frames the ingest process dropped because no ring slot was free (or large enough)', None, dropped
+        yield 'spade_ingest_ring_frames_overwritten_total', 'counter', 'Frames whose ring slot was reused before they could be published', None, self.frames_overwritten
+        yield 'spade_ingest_ring_slots_busy', 'gauge', 'Ring slots holding frames that are still referenced', None, sum(self.ring.busy)
+        yield 'spade_ingest_process_restarts_total', 'counter', 'Times the ingest process was restarted after exiting', None, self.restarts
+
+
+def _run(settings, name, slots, slot_size, lock, conn):
+    """
+    Main function of the ingest process
+    """
+    # Interrupts are handled by the mirror process (which then ends this one)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    parent_pid = os.getppid()
+    ring = FrameRing(slots, slot_size, name=name, lock=lock)
+    spade_client = SpadeClient(**settings)
+    spade_client.accel = ring.accel
+    send_lock = threading.Lock()
+    
+    def publish(frame):
+        written = ring.write(frame)
+        if written is not None:
+            with send_lock:
+                conn.send((MSG_FRAME,) + written)
+    
+    # Completed frames are still reordered and paced by the jitter buffer, but then go to the ring instead
+    # of the broadcaster
+    spade_client.jitter_buffer.output = publish
+    generation = None  # Generation of the running stream (None if it isn't running)
+    try:
+        while os.getppid() == parent_pid:
+            # (Checks the mirror process too, in case the connection isn't closed when the mirror process is
+            # killed, e.g. because another process holds a copy of its end)
+            if conn.poll(IngestProcess.POLL_INTERVAL):
+                command, command_generation = conn.recv()
+                if command == MSG_EXIT:
+                    break
+                if command == MSG_STOP:
+                    spade_client.stop_stream(wait=True)
+                    if generation is not None:
+                        # Final statistics of the stream
+                        ring.write_stats(spade_client)
+                        with send_lock:
+                            conn.send((MSG_STATS, generation))
+                    generation = None
+                elif command == MSG_START:
+                    try:
+                        spade_client.start_stream()
+                    except Exception as e:
+                        generation = None
+                        with send_lock:
+                            conn.send((MSG_ERROR, command_generation, str(e)))
+                        continue
+                    generation = command_generation
+                    with send_lock:
+                        conn.send((MSG_STARTED, generation))
+            if generation is not None:
+                ring.write_stats(spade_client)
+                with send_lock:
+                    if spade_client.streaming:
+                        conn.send((MSG_STATS, generation))
+                    else:
+                        # The ingest thread failed
+                        conn.send((MSG_ENDED, generation))
+                        generation = None
+    except (EOFError, OSError):
+        # The mirror process exited
+        pass
+    finally:
+        spade_client.stop_stream(wait=True)
+        ring.accel.release()
+        ring.close()
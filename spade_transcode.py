@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# Author: Sean Pesce
+
+# Downscaled and re-encoded variants of the live stream, for viewers that don't need the device's
+# full-resolution frames (e.g., small tiles), served at /stream?scale=<factor>&quality=<1-95>&fps=<rate>.
+#
+# Each distinct variant is produced by a single pipeline that's shared by all of its viewers, and is torn
+# down when its last viewer leaves. Frames are encoded on a bounded worker pool, and encoded outputs are
+# kept in an LRU cache, so a source frame is only encoded once per scale and quality (even for variants
+# that differ only in frame rate). A pipeline only ever waits on its latest source frame, so when the pool
+# is saturated, variants drop frames rather than queueing work.
+#
+# Re-encoding requires Pillow; without it, only frame-rate-limited variants are available.
+
+
+import collections
+import concurrent.futures
+import os
+import threading
+import urllib.parse
+
+from io import BytesIO
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from spade_mirror import FrameBroadcaster, FrameSubscriber, HttpHandler
+
+
+class VariantFrame:
+    """
+    Transcoded copy of a JpgFrame. Holds its own (immutable) data, so unlike pooled frames, it doesn't need
+    to be reference-counted; retain() and release() only exist so it can be published like any other frame.
+    """
+    
+    def __init__(self, source, data, width, height):
+        self.index = source.index
+        self.width = width
+        self.height = height
+        self.position = source.position
+        self.t_complete = source.t_complete
+        self.timestamp = source.timestamp
+        self.data = data
+        self.cache = {}
+        return
+    
+    
+    def retain(self):
+        return self
+    
+    
+    def release(self):
+        pass
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class VariantPipeline:
+    """
+    Produces a single variant of the stream from its own subscription to the source frames, and publishes
+    the results to the variant's viewers
+    """
+    
+    def __init__(self, transcoder, variant):
+        self.transcoder = transcoder
+        self.variant = variant  # (scale, quality, fps)
+        self.broadcaster = FrameBroadcaster()
+        self.closed = False  # Set once the pipeline stops publishing (under the transcoder's lock)
+        self._lock = threading.Lock()
+        self._source = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name=f'SpadeVariant-{Transcoder.variant_name(variant)}', daemon=True)
+        # Statistics
+        self.frames_published = 0
+        self.frames_skipped = 0  # Source frames skipped to limit the frame rate
+        return
+    
+    
+    def start(self):
+        self._thread.start()
+    
+    
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            if self._source is not None:
+                self._source.close()
+    
+    
+    def _run(self):
+        transcoder = self.transcoder
+        try:
+            # Subscribed from this thread, since the subscription might have to go through an event loop
+            # (see Recorder.start)
+            source = transcoder._subscribe(1)
+        except Exception as e:
+            print(f'[ERROR] Variant {Transcoder.variant_name(self.variant)} failed to start the stream: {e}')
+            transcoder._end(self)
+            return
+        with self._lock:
+            self._source = source
+            if self._stopped:
+                source.close()
+        scale, quality, fps = self.variant
+        next_timestamp = None
+        try:
+            while True:
+                frame = source.get()
+                if frame is None:
+                    # Stream ended (or the pipeline was stopped)
+                    break
+                with frame:
+                    if fps is not None:
+                        if next_timestamp is not None and frame.timestamp < next_timestamp:
+                            self.frames_skipped += 1
+                            continue
+                        next_timestamp = max(frame.timestamp, (next_timestamp or 0) + (1 / fps))
+                    try:
+                        output = transcoder.encode(frame, scale, quality)
+                    except OSError as e:
+                        # Undecodable frame
+                        print(f'[ERROR] Failed to transcode frame {frame.index}: {e}')
+                        continue
+                with output:
+                    self.broadcaster.publish(output)
+                self.frames_published += 1
+        except Exception as e:
+            print(f'[ERROR] Variant {Transcoder.variant_name(self.variant)} failed: {e}')
+        finally:
+            transcoder._unsubscribe(source)
+            transcoder._end(self)
+
+
+class Transcoder:
+    """
+    Manages the variant pipelines, the worker pool they encode frames on, and the cache of encoded frames
+    """
+    WORKERS = min(4, os.cpu_count() or 1)
+    CACHE_MAX_BYTES = 16 * 1024 * 1024
+    DEFAULT_QUALITY = 75
+    RESAMPLE = Image.BILINEAR if Image is not None else None
+    
+    def __init__(self, spade_client, workers=WORKERS, cache_max_bytes=CACHE_MAX_BYTES):
+        self.spade_client = spade_client
+        self.workers = max(1, int(workers))
+        self.cache_max_bytes = int(cache_max_bytes)
+        self._lock = threading.Lock()
+        self._pipelines = {}  # Variant -> VariantPipeline
+        self._cache = collections.OrderedDict()  # (ETag, scale, quality) -> VariantFrame, least recently used first
+        self._cache_bytes = 0
+        self._pending = {}  # (ETag, scale, quality) -> Future, for frames being encoded
+        self._executor = None
+        self._subscribe = spade_client.subscribe
+        self._unsubscribe = spade_client.unsubscribe
+        # Statistics
+        self.frames_encoded = 0
+        self.cache_hits = 0
+        self.bytes_sent = 0  # Bytes sent to viewers of variants that have since unsubscribed
+        spade_client.metrics.add_collector(self._collect_metrics)
+        return
+    
+    
+    @staticmethod
+    def parse(query):
+        """
+        Returns the variant requested by a /stream query string as (scale, quality, fps), or None for the
+        full-resolution stream. Raises ValueError for invalid parameters.
+        """
+        params = urllib.parse.parse_qs(query)
+        if not any(k in params for k in ('scale', 'quality', 'fps')):
+            return None
+        scale = float(params['scale'][0]) if 'scale' in params else 1.0
+        quality = int(params['quality'][0]) if 'quality' in params else None
+        fps = float(params['fps'][0]) if 'fps' in params else None
+        if not 0 < scale <= 1:
+            raise ValueError('scale must be greater than 0 and at most 1')
+        if quality is not None and not 1 <= quality <= 95:
+            raise ValueError('quality must be between 1 and 95')
+        if fps is not None and not fps > 0:
+            raise ValueError('fps must be greater than 0')
+        return scale, quality, fps
+    
+    
+    @staticmethod
+    def variant_name(variant):
+        scale, quality, fps = variant
+        name = f'{scale:g}x-q{quality or "src"}'
+        if fps is not None:
+            name += f'-{fps:g}fps'
+        return name
+    
+    
+    @staticmethod
+    def supports(variant):
+        """
+        Whether a variant can be produced (re-encoding requires Pillow)
+        """
+        scale, quality, _ = variant
+        return Image is not None or (scale == 1 and quality is None)
+    
+    
+    def start(self, subscribe=None, unsubscribe=None):
+        """
+        Starts the worker pool. subscribe(queue_max) and unsubscribe(subscriber) are used for the pipelines'
+        source subscriptions, as for Recorder.start.
+        """
+        if subscribe is not None:
+            self._subscribe = subscribe
+        if unsubscribe is not None:
+            self._unsubscribe = unsubscribe
+        with self._lock:
+            if self._executor is None:
+                # Threads are only spawned once frames are submitted
+                self._executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix='SpadeTranscode')
+    
+    
+    def stop(self):
+        with self._lock:
+            pipelines = list(self._pipelines.values())
+            executor = self._executor
+            self._executor = None
+        for pipeline in pipelines:
+            pipeline.stop()
+        if executor is not None:
+            executor.shutdown(wait=True)
+    
+    
+    def subscribe(self, variant, subscriber=None):
+        """
+        Subscribes to a variant of the stream, starting its pipeline if it isn't already running
+        """
+        if subscriber is None:
+            subscriber = FrameSubscriber()
+        with self._lock:
+            pipeline = self._pipelines.get(variant)
+            if pipeline is None or pipeline.closed:
+                pipeline = VariantPipeline(self, variant)
+                self._pipelines[variant] = pipeline
+                pipeline.start()
+            return pipeline.broadcaster.subscribe(subscriber)
+    
+    
+    def unsubscribe(self, variant, subscriber):
+        """
+        Ends a subscription to a variant, tearing down its pipeline once no viewers remain. Must be called
+        exactly once for each subscriber.
+        """
+        with self._lock:
+            self.bytes_sent += subscriber.bytes_sent
+            pipeline = self._pipelines.get(variant)
+            if pipeline is None:
+                # The pipeline already ended
+                subscriber.close()
+                return
+            pipeline.broadcaster.unsubscribe(subscriber)
+            if len(pipeline.broadcaster) > 0:
+                return
+            del self._pipelines[variant]
+        pipeline.stop()
+    
+    
+    def _end(self, pipeline):
+        """
+        Called by a pipeline once it stops publishing; ends its viewers' subscriptions
+        """
+        with self._lock:
+            pipeline.closed = True
+            if self._pipelines.get(pipeline.variant) is pipeline:
+                del self._pipelines[pipeline.variant]
+        pipeline.broadcaster.close()
+    
+    
+    def encode(self, frame, scale, quality):
+        """
+        Returns a VariantFrame holding a frame scaled by scale and re-encoded with the given JPEG quality,
+        from the cache if possible. Concurrent requests for the same output share a single encoding job.
+        The caller must release the returned frame.
+        """
+        if scale == 1 and quality is None:
+            # Frame-rate-limited variants publish the source frame itself, without copying its data
+            return frame.retain()
+        key = (HttpHandler.ETAG(frame), scale, quality)
+        with self._lock:
+            output = self._cache.get(key)
+            if output is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return output
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                if self._executor is None:
+                    raise RuntimeError('Transcoder is stopped')
+                future = self._executor.submit(self.__class__._encode, frame.data, scale, quality or self.__class__.DEFAULT_QUALITY)
+                self._pending[key] = future
+        try:
+            data, width, height = future.result()
+        finally:
+            if owner:
+                with self._lock:
+                    del self._pending[key]
+        output = VariantFrame(frame, data, width, height)
+        if owner:
+            with self._lock:
+                self.frames_encoded += 1
+                self._cache[key] = output
+                self._cache_bytes += len(data)
+                while self._cache_bytes > self.cache_max_bytes and len(self._cache) > 1:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cache_bytes -= len(evicted.data)
+        return output
+    
+    
+    @classmethod
+    def _encode(cls, data, scale, quality):
+        """
+        Runs on the worker pool; Pillow releases the GIL while decoding, resizing and encoding
+        """
+        img = Image.open(BytesIO(data))
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        # Lets the JPEG decoder skip detail that won't survive the downscale (reducing by up to 8x)
+        img.draft(img.mode, size)
+        if img.size != size:
+            img = img.resize(size, cls.RESAMPLE)
+        out = BytesIO()
+        img.save(out, format='JPEG', quality=quality)
+        return out.getvalue(), size[0], size[1]
+    
+    
+    def _collect_metrics(self):
+        with self._lock:
+            pipelines = list(self._pipelines.values())
+            cache_entries = len(self._cache)
+            cache_bytes = self._cache_bytes
+        yield 'spade_variant_frames_encoded_total', 'counter', 'Frames re-encoded for variant streams', None, self.frames_encoded
+        yield 'spade_variant_cache_hits_total', 'counter', 'Variant frames served from the transcode cache', None, self.cache_hits
+        yield 'spade_variant_cache_entries', 'gauge', 'Encoded frames in the transcode cache', None, cache_entries
+        yield 'spade_variant_cache_bytes', 'gauge', 'Size of the encoded frames in the transcode cache', None, cache_bytes
+        yield 'spade_variant_bytes_served_total', 'counter', 'Bytes of variant stream data sent to all viewers', None, self.bytes_sent + sum(s.bytes_sent for p in pipelines for s in p.broadcaster.subscribers)
+        for p in pipelines:
+            labels = {'variant': self.__class__.variant_name(p.variant)}
+            yield 'spade_variant_viewers', 'gauge', 'Connected viewers of each variant stream', labels, len(p.broadcaster)
+            yield 'spade_variant_frames_published', 'gauge', 'Frames published by each variant pipeline', labels, p.frames_published
@@ -1,42 +1,10 @@
 #!/usr/bin/env python3
 # Author: Sean Pesce
 
-import os
-import platform
 import socket
 import sys
 
 
-def ping(host, timeout=1):
-    """
-    Returns True if the target host sent an ICMP response within the specified timeout interval
-    """
-    # Protect against command injection
-    if type(host) != str:
-        raise TypeError(f'Non-string type for "host" argument: {type(host)}')
-    # Alphabet for IP addresses and host names
-    safe_alphabet = '.:0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ-_'
-    for c in host:
-        if c not in safe_alphabet:
-            raise ValueError(f'Invalid character in "host" argument: "{c}"')
-    host = socket.gethostbyname(host)
-    # Determine argument syntax (Linux vs. Windows vs. MacOS)
-    count_flag = 'c'
-    dev_null = '/dev/null'
-    quote_char = '\''
-    wait_flag = 'w'
-    if 'windows' in platform.system().lower():
-        count_flag = 'n'
-        dev_null = 'NUL'
-        quote_char = '"'
-    if 'darwin' in platform.system().lower():
-        wait_flag = 'W'
-
-    cmd = f'ping -{count_flag} 1 -{wait_flag} {int(timeout)} {quote_char}{host}{quote_char} 2>&1 > {dev_null}'
-    retcode = os.system(cmd)
-    return retcode == 0
-
-
 def udp_send(host, port, data, response_len=4096):
     try:
         #print(f'[Sending data to {host}:{int(port)}]\n{data}\n')
@@ -52,6 +20,38 @@ def udp_send(host, port, data, response_len=4096):
     return response
 
 
+def sendmsg_all(sock, buffers):
+    """
+    Sends every buffer in order with vectored writes (one sendmsg() system call if the socket accepts all of
+    the data at once). Returns the number of sendmsg() calls made.
+    """
+    buffers = [memoryview(b).cast('B') for b in buffers if len(b) > 0]
+    calls = 0
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        calls += 1
+        # Skip whatever was sent
+        while sent > 0:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+    return calls
+
+
+def bind_to_interface(sock, interface):
+    """
+    Restricts a socket to a single network interface (Linux only), so that devices with the same address on
+    different interfaces can be told apart
+    """
+    so_bindtodevice = getattr(socket, 'SO_BINDTODEVICE', 25 if sys.platform.startswith('linux') else None)
+    if so_bindtodevice is None:
+        raise OSError('Binding to a network interface is only supported on Linux')
+    sock.setsockopt(socket.SOL_SOCKET, so_bindtodevice, interface.encode('ascii') + b'\0')
+
+
 def decode_battery_percentage(val):
     """
     Parses a battery charge percentage from the value returned in GetBattery UDP messages.
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# Author: Sean Pesce
+
+# Minimal WebSocket (RFC 6455) support for the /ws route, which pushes each frame to the viewer as a single
+# binary message: a FRAME_HEADER followed by the JPEG data. Viewers acknowledge each frame they've drawn by
+# sending its index back (as a text message, or as a little-endian uint32 binary message); once a viewer has
+# `window` unacknowledged frames, newer frames replace each other in its queue until it catches up.
+
+
+import base64
+import collections
+import hashlib
+import struct
+
+
+GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xa
+
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_TOO_BIG = 1009
+
+# Frame index, arrival timestamp (Unix time), width, height, and X/Y/Z accelerometer coordinates
+# (NO_COORDINATE if unknown), all little-endian
+FRAME_HEADER = struct.Struct('<IdHHHHH')
+NO_COORDINATE = 0xffff
+
+MESSAGE_MAX = 4096    # Maximum size of a message from a viewer (only acknowledgements are expected)
+WINDOW = 2            # Default number of unacknowledged frames a viewer can have in flight
+ACK_TIMEOUT = 5.0     # Seconds without an acknowledgement before a viewer's unacknowledged frames are written off
+POLL_INTERVAL = 0.1   # Seconds between checks for viewer messages while waiting for a frame
+
+
+class ProtocolError(Exception):
+    def __init__(self, message, code=CLOSE_PROTOCOL_ERROR):
+        super().__init__(message)
+        self.code = code
+
+
+class AckWindow:
+    """
+    Tracks the frames sent to a viewer that it hasn't acknowledged yet. Not thread-safe.
+    """
+    
+    def __init__(self, size):
+        self.size = int(size)  # 0 to never wait for acknowledgements
+        self._unacked = collections.deque()
+        return
+    
+    
+    def __len__(self):
+        return len(self._unacked)
+    
+    
+    @property
+    def full(self):
+        return self.size > 0 and len(self._unacked) >= self.size
+    
+    
+    def sent(self, index):
+        if self.size > 0:
+            self._unacked.append(index)
+    
+    
+    def ack(self, index):
+        """
+        Acknowledges a frame (and every frame sent before it). Unknown indices are ignored.
+        """
+        if index not in self._unacked:
+            return
+        while self._unacked.popleft() != index:
+            pass
+    
+    
+    def reset(self):
+        self._unacked.clear()
+
+
+def accept_key(key):
+    """
+    Returns the Sec-WebSocket-Accept value for a handshake's Sec-WebSocket-Key
+    """
+    return base64.b64encode(hashlib.sha1(key.strip().encode('latin-1') + GUID).digest()).decode('ascii')
+
+
+def is_handshake(headers):
+    """
+    Whether a request's headers (a mapping with case-insensitive keys) ask for a WebSocket upgrade
+    """
+    return (headers.get('upgrade', '').lower() == 'websocket'
+            and 'upgrade' in (t.strip() for t in headers.get('connection', '').lower().split(','))
+            and headers.get('sec-websocket-version', '').strip() == '13'
+            and headers.get('sec-websocket-key') is not None)
+
+
+def frame_header(opcode, length):
+    """
+    Returns the header of an unfragmented, unmasked (server-to-client) message with a payload of length bytes
+    """
+    if length < 126:
+        return struct.pack('!BB', 0x80 | opcode, length)
+    if length < 0x10000:
+        return struct.pack('!BBH', 0x80 | opcode, 126, length)
+    return struct.pack('!BBQ', 0x80 | opcode, 127, length)
+
+
+def close_message(code=CLOSE_NORMAL):
+    payload = struct.pack('!H', code)
+    return frame_header(OP_CLOSE, len(payload)) + payload
+
+
+def frame_message_header(frame):
+    """
+    Returns everything that precedes a frame's JPEG data in its binary message
+    """
+    x, y, z = frame.position or (NO_COORDINATE, NO_COORDINATE, NO_COORDINATE)
+    header = FRAME_HEADER.pack(frame.index & 0xffffffff, frame.timestamp, frame.width, frame.height, x, y, z)
+    return frame_header(OP_BINARY, len(header) + len(frame.data)) + header
+
+
+def parse_ack(opcode, payload):
+    """
+    Returns the frame index acknowledged by a viewer's message, or None if it isn't an acknowledgement
+    """
+    try:
+        if opcode == OP_TEXT:
+            return int(payload.decode('ascii'))
+        if opcode == OP_BINARY and len(payload) == 4:
+            return struct.unpack('<I', payload)[0]
+    except (UnicodeDecodeError, ValueError):
+        pass
+    return None
+
+
+def _parse_header(head):
+    """
+    Parses the first two bytes of a message from a viewer. Returns the opcode and the length field.
+    """
+    fin = head[0] & 0x80
+    opcode = head[0] & 0x0f
+    if not head[1] & 0x80:
+        raise ProtocolError('Unmasked message from client')
+    if not fin and opcode >= OP_CLOSE:
+        raise ProtocolError('Fragmented control message')
+    return opcode, head[1] & 0x7f
+
+
+class MessageParser:
+    """
+    Incrementally parses the messages (or message fragments) sent by a viewer, independently of how the
+    data is received
+    """
+    
+    def __init__(self):
+        self._buf = bytearray()
+        return
+    
+    
+    def feed(self, data):
+        self._buf += data
+    
+    
+    def messages(self):
+        """
+        Yields the opcode and unmasked payload of each complete message received so far. Raises
+        ProtocolError for invalid messages.
+        """
+        buf = self._buf
+        while len(buf) >= 2:
+            opcode, length = _parse_header(buf)
+            pos = 2
+            if length == 126:
+                if len(buf) < 4:
+                    return
+                length = struct.unpack_from('!H', buf, 2)[0]
+                pos = 4
+            elif length == 127:
+                if len(buf) < 10:
+                    return
+                length = struct.unpack_from('!Q', buf, 2)[0]
+                pos = 10
+            if length > MESSAGE_MAX:
+                raise ProtocolError(f'Message too big ({length} bytes)', CLOSE_TOO_BIG)
+            end = pos + 4 + length
+            if len(buf) < end:
+                return
+            mask = buf[pos:pos + 4]
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(buf[pos + 4:end]))
+            del buf[:end]
+            yield opcode, payload
+
+
+def handle_messages(parser, window):
+    """
+    Processes the messages parsed so far, applying acknowledgements to the window. Returns the data to send
+    back to the viewer (pongs and close replies), and whether the viewer closed the connection.
+    """
+    replies = b''
+    try:
+        for opcode, payload in parser.messages():
+            if opcode == OP_CLOSE:
+                return replies + close_message(), True
+            if opcode == OP_PING:
+                replies += frame_header(OP_PONG, len(payload)) + payload
+                continue
+            index = parse_ack(opcode, payload)
+            if index is not None:
+                window.ack(index)
+    except ProtocolError as e:
+        print(f'[ERROR] Invalid WebSocket message: {e}')
+        return replies + close_message(e.code), True
+    return replies, False
+
+
+# Viewer for /ws: draws each frame to a canvas as soon as it's decoded, then acknowledges it. Query
+# parameters (e.g., ?window=1) are passed through to /ws (the /ws next to /live, so it also works under a
+# hub's /devices/<name>/).
+LIVE_PAGE = """<!DOCTYPE html>
+<html><head><title>Spade</title>
+<style>body { margin: 0; background: #000; color: #ccc; font: 12px monospace; } canvas { display: block; margin: auto; max-width: 100vw; max-height: 100vh; } #stats { position: fixed; top: 4px; left: 4px; }</style>
+</head><body><canvas id="view"></canvas><div id="stats"></div>
+<script>
+const HEADER_SIZE = %d;
+const canvas = document.getElementById('view');
+const ctx = canvas.getContext('2d');
+const stats = document.getElementById('stats');
+function connect() {
+    const ws = new WebSocket((location.protocol === 'https:' ? 'wss://' : 'ws://') + location.host + location.pathname.replace(/live$/, 'ws') + location.search);
+    ws.binaryType = 'arraybuffer';
+    let drawing = Promise.resolve();
+    ws.onmessage = (event) => {
+        // Frames are drawn in order, even though decoding is asynchronous
+        drawing = drawing.then(async () => {
+            const header = new DataView(event.data, 0, HEADER_SIZE);
+            const index = header.getUint32(0, true);
+            const timestamp = header.getFloat64(4, true);
+            try {
+                const bitmap = await createImageBitmap(new Blob([new Uint8Array(event.data, HEADER_SIZE)], {type: 'image/jpeg'}));
+                if (canvas.width !== bitmap.width || canvas.height !== bitmap.height) {
+                    canvas.width = bitmap.width;
+                    canvas.height = bitmap.height;
+                }
+                ctx.drawImage(bitmap, 0, 0);
+                bitmap.close();
+            } finally {
+                // Acknowledged even if the frame couldn't be decoded, so the server doesn't stall
+                ws.send(String(index));
+            }
+            stats.textContent = `Frame ${index}  |  ${Math.max(0, Date.now() - timestamp * 1000).toFixed(0)} ms`;
+        }).catch((e) => console.error(e));
+    };
+    ws.onclose = () => setTimeout(connect, 1000);
+}
+connect();
+</script>
+</body></html>
+""" % FRAME_HEADER.size
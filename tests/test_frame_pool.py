@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# Author: Sean Pesce
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from spade_mirror import FramePool
+
+
+class FramePoolTest(unittest.TestCase):
+    TIMEOUT = 5.0
+    
+    def test_acquire_beyond_prealloc(self):
+        pool = FramePool(prealloc=2)
+        frames = []
+        # Acquired in a separate thread, so a deadlock fails the test rather than hanging it
+        thread = threading.Thread(target=lambda: frames.extend(pool.acquire() for i in range(5)), daemon=True)
+        thread.start()
+        thread.join(self.__class__.TIMEOUT)
+        self.assertFalse(thread.is_alive(), 'FramePool.acquire deadlocked')
+        self.assertEqual(len(frames), 5)
+        self.assertEqual(pool.allocated, 5)
+        self.assertEqual(pool.in_use, 5)
+        # Creating empty frames doesn't count as resizing them
+        self.assertEqual(pool.resizes, 0)
+        for frame in frames:
+            frame.release()
+        self.assertEqual(pool.in_use, 0)
+        self.assertEqual(pool.stats['free'], min(5, pool.max_free))
+
+
+if __name__ == '__main__':
+    unittest.main()